@@ -0,0 +1,223 @@
+""" Single-sample gene set scoring """
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.stats import rankdata
+
+from Orange.data import Table, Domain, ContinuousVariable
+from Orange.data.util import get_unique_names
+
+from orangecontrib.bioinformatics.widgets.utils.data import TableAnnotation
+
+__all__ = ["SCORING_AUCELL", "SCORING_SSGSEA", "score_gene_sets"]
+
+SCORING_AUCELL = "AUCell"
+SCORING_SSGSEA = "ssGSEA"
+
+
+def _gene_ids(data):
+    """
+    Return gene ids of columns. Variable names are used for tables
+    without gene id annotation.
+    """
+    gene_id_attribute = data.attributes.get(TableAnnotation.gene_id_attribute)
+    if gene_id_attribute is None:
+        return [var.name for var in data.domain.attributes]
+    return [str(var.attributes.get(gene_id_attribute, "?")) for var in data.domain.attributes]
+
+
+def _membership(gene_ids, gene_sets):
+    """
+    Return a sparse (genes x sets) membership matrix and the number of genes of
+    each set that are present in the data.
+    """
+    column = {}
+    for i, gene in enumerate(gene_ids):
+        column.setdefault(gene, i)
+
+    rows, cols = [], []
+    for j, gene_set in enumerate(gene_sets):
+        set_columns = {column[g] for g in map(str, gene_set.genes) if g in column}
+        rows.extend(set_columns)
+        cols.extend([j] * len(set_columns))
+
+    membership = sp.csr_matrix(
+        (np.ones(len(rows)), (np.array(rows, dtype=int), np.array(cols, dtype=int))),
+        shape=(len(gene_ids), len(gene_sets)),
+    )
+    return membership, np.asarray(membership.sum(axis=0)).ravel()
+
+
+def rank_rows(x):
+    """
+    Rank values within each row in decreasing order (the highest value gets
+    rank 1); tied values get their average rank.
+
+    Sparse matrices are ranked without densification: only nonzero values are
+    sorted and all zeros of a row share the average rank of the zero block.
+
+    Parameters
+    ----------
+    x : np.ndarray or scipy.sparse.spmatrix
+        Matrix of values (cells x genes)
+
+    Returns
+    -------
+    np.ndarray or scipy.sparse.csr_matrix
+        Ranks with the same structure as ``x``
+    np.ndarray or None
+        The rank of zeros in each row for sparse ``x``, None otherwise
+    """
+    if not sp.issparse(x):
+        return rankdata(-np.asarray(x, dtype=float), axis=1), None
+
+    x = sp.csr_matrix(x, dtype=float, copy=True)
+    x.sum_duplicates()
+    x.eliminate_zeros()
+    n_rows, n_cols = x.shape
+    row_nnz = np.diff(x.indptr)
+    rows = np.repeat(np.arange(n_rows), row_nnz)
+
+    order = np.lexsort((-x.data, rows))
+    data = x.data[order]
+    position = np.arange(len(data)) - x.indptr[rows]
+
+    # negative values come after all zeros of the row
+    n_zeros = n_cols - row_nnz
+    position += np.where(data < 0, n_zeros[rows], 0)
+
+    # average positions of equal values
+    if len(data):
+        group_start = np.flatnonzero(np.r_[True, (rows[1:] != rows[:-1]) | (data[1:] != data[:-1])])
+        group_end = np.r_[group_start[1:], len(data)] - 1
+        average = (position[group_start] + position[group_end]) / 2
+        position = np.repeat(average, group_end - group_start + 1)
+
+    ranks = sp.csr_matrix((position + 1, x.indices[order], x.indptr), shape=x.shape)
+    n_positive = np.bincount(rows[data > 0], minlength=n_rows)
+    zero_rank = n_positive + (n_zeros + 1) / 2
+    return ranks, zero_rank
+
+
+def _set_sums(ranks, zero_rank, fun, membership, set_sizes, nonzero_in_sets):
+    """Sum ``fun(rank)`` over genes of each set for each row."""
+    if zero_rank is None:
+        return fun(ranks) @ membership
+
+    values = ranks.copy()
+    values.data = fun(values.data)
+    zero_values = fun(zero_rank)
+    sums = np.asarray((values @ membership).todense())
+    return sums + zero_values[:, None] * (set_sizes - nonzero_in_sets)
+
+
+def _aucell(ranks, zero_rank, membership, set_sizes, nonzero_in_sets, max_rank):
+    def recovery(r):
+        return np.maximum(max_rank + 1 - r, 0)
+
+    area = _set_sums(ranks, zero_rank, recovery, membership, set_sizes, nonzero_in_sets)
+    # area if the set genes were ranked first
+    top = np.minimum(set_sizes, max_rank)
+    return area / (top * max_rank - top * (top - 1) / 2)
+
+
+def _ssgsea(ranks, zero_rank, membership, set_sizes, nonzero_in_sets, alpha):
+    n_genes = ranks.shape[1]
+
+    def sums(power):
+        # increasing ranks: the highest value gets rank n_genes
+        return _set_sums(
+            ranks, zero_rank, lambda r: (n_genes + 1 - r) ** power, membership, set_sizes, nonzero_in_sets
+        )
+
+    # the running sum (Barbie et al., 2009) summed over all genes; each hit (miss)
+    # adds its weight at its own position and at all positions after it
+    hits, weights, weighted_hits = sums(1), sums(alpha), sums(alpha + 1)
+    return weighted_hits / weights - (n_genes * (n_genes + 1) / 2 - hits) / (n_genes - set_sizes)
+
+
+def _score_chunk(x, method, membership, set_sizes, max_rank, alpha):
+    ranks, zero_rank = rank_rows(x)
+    nonzero_in_sets = None
+    if zero_rank is not None:
+        structure = ranks.copy()
+        structure.data = np.ones_like(structure.data)
+        nonzero_in_sets = np.asarray((structure @ membership).todense())
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if method == SCORING_AUCELL:
+            return _aucell(ranks, zero_rank, membership, set_sizes, nonzero_in_sets, max_rank)
+        else:
+            return _ssgsea(ranks, zero_rank, membership, set_sizes, nonzero_in_sets, alpha)
+
+
+def score_gene_sets(data, gene_sets, method=SCORING_AUCELL, auc_max_rank=0.05, alpha=0.25, chunk_size=1000, n_jobs=1):
+    """
+    Score each gene set in each cell from within-cell ranks of genes.
+
+    Cells are ranked and scored in chunks of ``chunk_size`` rows, so memory
+    used besides the output does not depend on the number of cells. Sparse
+    data is never densified.
+
+    Example:
+
+    >>> from orangecontrib.bioinformatics.geneset import load_gene_sets
+    >>> gene_sets = load_gene_sets(('Marker Genes', 'Panglao'), '9606')
+    >>> scores = score_gene_sets(data, gene_sets, method=SCORING_AUCELL)
+
+    With the gene sets component in widgets:
+
+    >>> scores = score_gene_sets(data, self.gs_selection_component.selected_gene_sets)
+
+    Parameters
+    ----------
+    data : Orange.data.Table
+        Tabular data with gene expressions (cells x genes). Genes are matched
+        by the gene id annotation or by variable names when it is missing.
+    gene_sets : GeneSets
+        Gene sets to score
+    method : str, optional (default=SCORING_AUCELL)
+        SCORING_AUCELL gives the normalized area under the recovery curve of
+        set genes within the top ``auc_max_rank`` genes of a cell.
+        SCORING_SSGSEA gives the single-sample GSEA enrichment score.
+    auc_max_rank : int or float, optional (default=0.05)
+        The number of top genes for AUCell, or a fraction of all genes
+    alpha : float, optional (default=0.25)
+        Rank weight exponent of ssGSEA
+    chunk_size : int, optional (default=1000)
+        Number of cells scored together
+    n_jobs : int, optional (default=1)
+        Number of threads that score chunks
+
+    Returns
+    -------
+    Orange.data.Table
+        Scores with one variable for each gene set. Sets without genes in the
+        data have unknown scores.
+    """
+    if method not in (SCORING_AUCELL, SCORING_SSGSEA):
+        raise ValueError("Unknown scoring method: {}".format(method))
+
+    gene_sets = list(gene_sets)
+    membership, set_sizes = _membership(_gene_ids(data), gene_sets)
+    n_genes = len(data.domain.attributes)
+    max_rank = auc_max_rank if auc_max_rank >= 1 else max(int(round(auc_max_rank * n_genes)), 1)
+
+    def score(start):
+        return _score_chunk(data.X[start : start + chunk_size], method, membership, set_sizes, max_rank, alpha)
+
+    scores = np.full((len(data), len(gene_sets)), np.nan)
+    starts = range(0, len(data), chunk_size)
+    if n_jobs == 1:
+        for start in starts:
+            scores[start : start + chunk_size] = score(start)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            for start, chunk_scores in zip(starts, executor.map(score, starts)):
+                scores[start : start + chunk_size] = chunk_scores
+    scores[:, set_sizes == 0] = np.nan
+
+    names = get_unique_names([], [gene_set.name or gene_set.gs_id for gene_set in gene_sets])
+    domain = Domain([ContinuousVariable(name) for name in names])
+    return Table(domain, scores)
@@ -1,25 +1,56 @@
 """ Cluster analysis module """
+import os
 import threading
+import multiprocessing
 import concurrent.futures
-from typing import Union
+from typing import List, Tuple, Union, Callable, Optional
 from operator import attrgetter
-from functools import partial
+from functools import reduce, partial
+from multiprocessing.util import Finalize
 
 import numpy as np
+import scipy.sparse as sp
 
 from AnyQt.QtCore import Qt, Slot, QThread, QVariant, QAbstractListModel
 
 from Orange.widgets.gui import ProgressBar
 from Orange.widgets.utils.concurrent import FutureWatcher, ThreadExecutor, methodinvoke
 
-from orangecontrib.bioinformatics.geneset import GeneSet
+from orangecontrib.bioinformatics.geneset import GeneSet, reference_counts
 from orangecontrib.bioinformatics.ncbi.gene import Gene
-from orangecontrib.bioinformatics.utils.statistics import FDR, ALT_GREATER
+from orangecontrib.bioinformatics.de.pseudobulk import log_cpm, aggregate_rows
+from orangecontrib.bioinformatics.utils.statistics import (
+    FDR,
+    ALT_GREATER,
+    GroupStatistics,
+    _rank_sums,
+    score_t_test,
+    _count_at_least,
+    stratified_z_test,
+    moderated_variance,
+    score_mann_whitney,
+    score_welch_t_test,
+    score_moderated_t_test,
+    t_test_from_statistics,
+    score_hypergeometric_test,
+    mann_whitney_from_rank_sums,
+    hypergeometric_test_from_counts,
+    moderated_t_test_from_statistics,
+)
 from orangecontrib.bioinformatics.widgets.utils.gui import gene_scoring_method
 
 DISPLAY_GENE_COUNT = 20
 DISPLAY_GENE_SETS_COUNT = 5
 
+#: Aggregations of batches in :obj:`score_cluster`
+AGGREGATE_MAX = 'max'
+AGGREGATE_STRATIFIED = 'stratified'
+
+
+def _has_nonzero(x):
+    # type: (Union[np.ndarray, sp.spmatrix]) -> bool
+    return x.count_nonzero() > 0 if sp.issparse(x) else x.any()
+
 
 class ClusterGene(Gene):
     __slots__ = ['score', 'p_val', 'fdr']
@@ -42,6 +73,186 @@ class ClusterGeneSet(GeneSet):
         super().__init__()
 
 
+class ClusterStatistics:
+    """
+    Statistics of genes in each (cluster, batch) group of rows, computed once and
+    shared by all comparisons of clusters.
+
+    Scores of tests that depend only on group statistics (t-tests, hypergeometric test)
+    are computed from cached statistics. Mann-Whitney test of a cluster against the rest
+    of its batch uses ranks within the batch, which are computed once for all clusters.
+    Other scoring functions are called on rows of the compared groups.
+    """
+
+    def __init__(self, table_x, rows_by_cluster, rows_by_batch=None):
+        # type: (Union[np.ndarray, sp.spmatrix], np.ndarray, Optional[np.ndarray]) -> None
+        if not isinstance(rows_by_batch, np.ndarray):
+            rows_by_batch = np.zeros((table_x.shape[0],))
+
+        self.table_x = table_x
+        self.clusters, cluster_codes = np.unique(rows_by_cluster, return_inverse=True)
+        self.batches, batch_codes = np.unique(rows_by_batch, return_inverse=True)
+
+        codes = cluster_codes * len(self.batches) + batch_codes
+        order = np.argsort(codes, kind='mergesort')
+        bounds = np.searchsorted(codes[order], np.arange(len(self.clusters) * len(self.batches) + 1))
+        self._rows = {
+            (cluster, batch): order[bounds[i * len(self.batches) + j] : bounds[i * len(self.batches) + j + 1]]
+            for i, cluster in enumerate(self.clusters)
+            for j, batch in enumerate(self.batches)
+        }
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, key, compute):
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = compute()
+            return self._cache[key]
+
+    def rows(self, clusters, batch):
+        # type: (List[int], int) -> np.ndarray
+        """ Indices of rows in the given clusters and batch. """
+        return np.sort(np.concatenate([self._rows[(c, batch)] for c in clusters]))
+
+    def group_statistics(self, clusters, batch):
+        # type: (List[int], int) -> GroupStatistics
+        """ Statistics of genes in the given clusters and batch. """
+        group = [
+            self._cached(
+                ('statistics', c, batch), lambda c=c: GroupStatistics.from_data(self.table_x[self._rows[(c, batch)]])
+            )
+            for c in clusters
+        ]
+        return reduce(GroupStatistics.merge, group)
+
+    def expressed(self, clusters, batch):
+        # type: (List[int], int) -> np.ndarray
+        """ Numbers of rows in the given clusters and batch that express each gene. """
+        return sum(
+            self._cached(('expressed', c, batch), lambda c=c: _count_at_least(self.table_x[self._rows[(c, batch)]], 1))
+            for c in clusters
+        )
+
+    def rank_sums(self, cluster, batch):
+        # type: (int, int) -> Tuple[np.ndarray, np.ndarray]
+        """ Sums of ranks of genes in the cluster, ranked within the batch, and tie terms of the batch. """
+
+        def compute():
+            rows = self.rows(self.clusters, batch)
+            labels = np.searchsorted(self.clusters, self._cluster_of_rows(batch, rows))
+            return _rank_sums(self.table_x[rows], labels, len(self.clusters))
+
+        rank_sums, tie_terms = self._cached(('ranks', batch), compute)
+        return rank_sums[np.searchsorted(self.clusters, cluster)], tie_terms
+
+    def _cluster_of_rows(self, batch, rows):
+        clusters = np.empty(self.table_x.shape[0], dtype=self.clusters.dtype)
+        for c in self.clusters:
+            clusters[self._rows[(c, batch)]] = c
+        return clusters[rows]
+
+    def score(self, score_function, cluster, others, batch, alternative):
+        # type: (Callable, int, List[int], int, str) -> Optional[Tuple[np.ndarray, np.ndarray]]
+        """
+        Score genes of the cluster against the union of other clusters within the batch.
+
+        :return: (scores, p_values) or None if either group has no nonzero values
+        """
+        if cluster not in self.clusters or not others:
+            return None
+
+        a, b = self.group_statistics([cluster], batch), self.group_statistics(others, batch)
+        if not (np.any(a.squares != 0) and np.any(b.squares != 0)):
+            return None
+
+        if score_function is score_t_test:
+            return t_test_from_statistics(a, b, alternative)
+        elif score_function is score_welch_t_test:
+            return t_test_from_statistics(a, b, alternative, equal_var=False)
+        elif score_function is score_moderated_t_test:
+            return moderated_t_test_from_statistics(a, b, alternative)
+        elif score_function is score_hypergeometric_test:
+            return hypergeometric_test_from_counts(
+                self.expressed([cluster], batch), a.n[0], self.expressed(others, batch), b.n[0], alternative
+            )
+        elif score_function is score_mann_whitney and len(others) == len(self.clusters) - 1:
+            rank_sums, tie_terms = self.rank_sums(cluster, batch)
+            return mann_whitney_from_rank_sums(rank_sums, int(a.n[0]), int(b.n[0]), tie_terms, alternative)
+
+        return score_function(
+            self.table_x[self.rows([cluster], batch)], self.table_x[self.rows(others, batch)], alternative=alternative
+        )
+
+    def stratum(self, score_function, cluster, others, batch):
+        # type: (Callable, int, List[int], int) -> Optional[Tuple[np.ndarray, np.ndarray]]
+        """
+        Deviations of the statistic of the cluster against the union of other clusters within the batch
+        from its expectation under the null hypothesis, and their variances:
+
+        - t-tests: differences of means with Mantel-Haenszel weights ``n1 * n2 / n``,
+        - Mann-Whitney test: rank sums scaled by ``1 / (n + 1)`` (van Elteren),
+        - hypergeometric test: numbers of expressing rows in the cluster (Cochran-Mantel-Haenszel).
+
+        :return: (deviations, variances) or None if either group is empty
+        """
+        if cluster not in self.clusters or not others:
+            return None
+
+        a, b = self.group_statistics([cluster], batch), self.group_statistics(others, batch)
+        n1, n2 = a.n[0], b.n[0]
+        n = n1 + n2
+        if not (n1 and n2):
+            return None
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if score_function in (score_t_test, score_welch_t_test, score_moderated_t_test):
+                if score_function is score_t_test:
+                    var = ((n1 - 1) * a.var() + (n2 - 1) * b.var()) / (n - 2) * (1 / n1 + 1 / n2)
+                elif score_function is score_welch_t_test:
+                    var = a.var() / n1 + b.var() / n2
+                else:
+                    var = moderated_variance(a, b)[0] * (1 / n1 + 1 / n2)
+                weight = n1 * n2 / n
+                deviations, variances = weight * (a.mean - b.mean), weight ** 2 * var
+            elif score_function is score_mann_whitney:
+                if len(others) == len(self.clusters) - 1:
+                    rank_sums, tie_terms = self.rank_sums(cluster, batch)
+                else:
+                    rows = self.rows([cluster] + list(others), batch)
+                    labels = np.isin(rows, self._rows[(cluster, batch)], invert=True).astype(int)
+                    rank_sums, tie_terms = _rank_sums(self.table_x[rows], labels, 2)
+                    rank_sums = rank_sums[0]
+                deviations = (rank_sums - n1 * (n + 1) / 2) / (n + 1)
+                variances = n1 * n2 / 12 * ((n + 1) - tie_terms / (n * (n - 1))) / (n + 1) ** 2
+            elif score_function is score_hypergeometric_test:
+                expressed_a = self.expressed([cluster], batch)
+                expressed = expressed_a + self.expressed(others, batch)
+                deviations = expressed_a - n1 * expressed / n
+                variances = n1 * n2 * expressed * (n - expressed) / (n ** 2 * (n - 1))
+            else:
+                raise NotImplementedError("Stratified scoring is not implemented for %s" % score_function.__name__)
+
+        # strata without variance (e.g. with a single row) do not contribute
+        valid = np.isfinite(variances) & np.isfinite(deviations)
+        return np.where(valid, deviations, 0), np.where(valid, variances, 0)
+
+    def stratified_score(self, score_function, cluster, others, alternative):
+        # type: (Callable, int, List[int], str) -> Optional[Tuple[np.ndarray, np.ndarray]]
+        """
+        Score genes of the cluster against the union of other clusters with a test stratified by batches
+        (see :obj:`stratum`), which compares rows only within batches but pools the evidence of all batches.
+
+        :return: (z statistics, p_values) or None if the groups share no batch
+        """
+        strata = [self.stratum(score_function, cluster, others, batch) for batch in self.batches]
+        strata = [stratum for stratum in strata if stratum is not None]
+        if not strata:
+            return None
+        deviations, variances = reduce(lambda s, t: (s[0] + t[0], s[1] + t[1]), strata)
+        return stratified_z_test(deviations, variances, alternative)
+
+
 class Cluster:
 
     CLUSTER_VS_REST = False
@@ -103,22 +314,22 @@ class Cluster:
         else:
             self.filtered_gene_sets = filtered_list
 
-    def gene_set_enrichment(self, gene_sets, selected_sets, genes, ref_genes):
+    def gene_set_enrichment(self, gene_sets, selected_sets, genes, ref_genes, ref_counts=None):
         self.gene_sets = []
 
         if not genes:
             return
 
-        # calculate gene set enrichment
-        for gene_set in gene_sets:
-
-            if gene_set.hierarchy not in selected_sets:
-                continue
+        selected = gene_sets.select(selected_sets)
+        if ref_counts is None:
+            ref_counts = reference_counts(selected, ref_genes)
 
+        # calculate gene set enrichment
+        for gene_set in selected:
             gs = ClusterGeneSet()
-            enrichment_result = gene_set.set_enrichment(ref_genes, genes.intersection(genes))
-            gs.count = len(enrichment_result.query)
-            gs.p_val = enrichment_result.p_value
+            query, p_value, _ = gene_set.count_enrichment(len(ref_genes), ref_counts[gene_set], genes)
+            gs.count = len(query)
+            gs.p_val = p_value
             gs.name = gene_set.name
             gs.gs_id = gene_set.gs_id
             self.gene_sets.append(gs)
@@ -159,51 +370,15 @@ class Cluster:
         :param rows_by_batch:
         :return:
         """
-        aggregation = kwargs.get('aggregation', 'max')
-        alternative = kwargs.get('alternative', ALT_GREATER)
-        rows_by_batch = kwargs.get('rows_by_batch', None)
-        if not isinstance(rows_by_batch, np.ndarray):
-            rows_by_batch = np.zeros((len(table_x),))
-        uniq_batches = set(rows_by_batch)
-
-        # Determine clusters
-        self.method_used = method.name
-        uniq_clusters = set(rows_by_cluster) - {self.index}
-        this_cluster = self.index
-        if design == self.CLUSTER_VS_REST:
-            rows_by_cluster = rows_by_cluster == self.index
-            uniq_clusters = {False}
-            this_cluster = True
-
-        calculated_p_values = np.ones(
-            (table_x.shape[1], len(uniq_clusters), len(uniq_batches))  # genes  # other clusters
-        )  # batches
-
-        calculated_scores = np.ones(
-            (table_x.shape[1], len(uniq_clusters), len(uniq_batches))  # genes  # other clusters
-        )  # batches
-
-        for bi, b in enumerate(uniq_batches):
-            for ci, c in enumerate(uniq_clusters):
-                cluster = table_x[np.logical_and(rows_by_cluster == this_cluster, rows_by_batch == b)]
-                rest = table_x[np.logical_and(rows_by_cluster == c, rows_by_batch == b)]
-                if cluster.any() and rest.any():
-                    scores, p_values = method.score_function(cluster, rest, alternative=alternative)
-                    scores[np.isnan(p_values)] = 0
-                    calculated_scores[:, ci, bi] = scores
-                    p_values[np.isnan(p_values)] = 1
-                    calculated_p_values[:, ci, bi] = p_values
-
-        if aggregation == 'max':
-            max_p_values = np.max(calculated_p_values, axis=(1, 2))
-            max_p_indexes = np.where(np.max(calculated_p_values, axis=(1, 2), keepdims=True) == calculated_p_values)
-            # this holds true only if max_p_indexes.ndim == 3
-            scores = calculated_scores[max_p_indexes[0], max_p_indexes[1], max_p_indexes[2]]
-            fdr_values = FDR(max_p_values.tolist())
-            self.__update_gene_objects(scores, max_p_values, fdr_values)
-        else:
-            raise NotImplementedError("Aggregation %s is not implemented" % aggregation)
-        return
+        self.set_scores(
+            method.name, *score_cluster(self.index, table_x, rows_by_cluster, method.score_function, design, **kwargs)
+        )
+
+    def set_scores(self, method_name, scores, p_vals, fdr_vals):
+        # type: (str, np.ndarray, np.ndarray, np.ndarray) -> None
+        """ Set scores of genes computed with :obj:`score_cluster`. """
+        self.method_used = method_name
+        self.__update_gene_objects(scores, p_vals, fdr_vals)
 
     def to_html(self):
         gene_sets = '(no enriched gene sets)'
@@ -257,6 +432,150 @@ class Cluster:
         return html_string
 
 
+def score_cluster(index, table_x, rows_by_cluster, score_function, design, **kwargs):
+    # type: (int, Union[np.ndarray, sp.spmatrix], np.ndarray, Callable, bool, ...) -> Tuple[np.ndarray, ...]
+    """
+    Score genes of the cluster against other clusters (or the rest) and keep the scores of the comparison
+    with the highest p-value for each gene.
+
+    With :obj:`AGGREGATE_MAX`, clusters are compared within each batch and the comparison in the batch with
+    the highest p-value is kept. With :obj:`AGGREGATE_STRATIFIED`, each comparison is a single test
+    stratified by batches (see :obj:`ClusterStatistics.stratified_score`), with z statistics as scores.
+
+    :param aggregation: :obj:`AGGREGATE_MAX` (default) or :obj:`AGGREGATE_STRATIFIED`
+    :param statistics: :obj:`ClusterStatistics` shared by clusters (computed if not given)
+    :return: (scores, p-values, FDR values) of genes
+    """
+    aggregation = kwargs.get('aggregation', AGGREGATE_MAX)
+    alternative = kwargs.get('alternative', ALT_GREATER)
+    rows_by_batch = kwargs.get('rows_by_batch', None)
+    statistics = kwargs.get('statistics', None)
+    if aggregation not in (AGGREGATE_MAX, AGGREGATE_STRATIFIED):
+        raise NotImplementedError("Aggregation %s is not implemented" % aggregation)
+    if statistics is None:
+        statistics = ClusterStatistics(table_x, rows_by_cluster, rows_by_batch)
+
+    # Determine clusters
+    other_clusters = [c for c in statistics.clusters if c != index]
+    if design == Cluster.CLUSTER_VS_REST:
+        # compare with all other clusters at once
+        comparisons = [other_clusters]
+    else:
+        comparisons = [[c] for c in other_clusters]
+
+    # scores of comparisons with the highest p-values so far; the first one is kept on ties
+    n_genes = table_x.shape[1]
+    max_p_values = np.full(n_genes, -np.inf)
+    scores = np.zeros(n_genes)
+    for others in comparisons:
+        if aggregation == AGGREGATE_STRATIFIED:
+            results = [statistics.stratified_score(score_function, index, others, alternative)]
+        else:
+            results = (statistics.score(score_function, index, others, b, alternative) for b in statistics.batches)
+        for result in results:
+            if result is None:
+                comparison_scores, p_values = np.ones(n_genes), np.ones(n_genes)
+            else:
+                comparison_scores, p_values = result
+                comparison_scores = np.where(np.isnan(p_values), 0, comparison_scores)
+                p_values = np.where(np.isnan(p_values), 1, p_values)
+            higher = p_values > max_p_values
+            max_p_values[higher] = p_values[higher]
+            scores[higher] = comparison_scores[higher]
+
+    return scores, max_p_values, FDR(max_p_values)
+
+
+#: State of worker processes that score clusters: shared memory blocks, data and cluster statistics
+_worker_state = {}
+
+
+def _has_shared_memory():
+    # type: () -> bool
+    """ Shared memory (:obj:`multiprocessing.shared_memory`) is available only in Python 3.8+. """
+    try:
+        from multiprocessing import shared_memory  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _share_array(array, blocks):
+    # type: (np.ndarray, List[multiprocessing.shared_memory.SharedMemory]) -> Tuple[str, Tuple[int, ...], str]
+    """ Copy the array to a new shared memory block and return its descriptor. """
+    from multiprocessing import shared_memory
+
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    blocks.append(block)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block.name, array.shape, array.dtype.str
+
+
+def _attach_array(descriptor, blocks):
+    # type: (Tuple[str, Tuple[int, ...], str], List[multiprocessing.shared_memory.SharedMemory]) -> np.ndarray
+    from multiprocessing import shared_memory
+
+    name, shape, dtype = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    blocks.append(block)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def _share_matrix(x, blocks):
+    # type: (Union[np.ndarray, sp.spmatrix], List[multiprocessing.shared_memory.SharedMemory]) -> tuple
+    """ Copy a dense or sparse matrix to shared memory; sparse matrices are shared in CSR format. """
+    if sp.issparse(x):
+        x = sp.csr_matrix(x)
+        return 'csr', x.shape, [_share_array(a, blocks) for a in (x.data, x.indices, x.indptr)]
+    return 'dense', x.shape, [_share_array(np.asarray(x), blocks)]
+
+
+def _attach_matrix(descriptor, blocks):
+    # type: (tuple, List[multiprocessing.shared_memory.SharedMemory]) -> Union[np.ndarray, sp.csr_matrix]
+    kind, shape, arrays = descriptor
+    arrays = [_attach_array(a, blocks) for a in arrays]
+    if kind == 'csr':
+        return sp.csr_matrix(tuple(arrays), shape=shape, copy=False)
+    return arrays[0]
+
+
+def _init_worker(x_descriptor, rows_by_cluster, rows_by_batch):
+    blocks = []
+    table_x = _attach_matrix(x_descriptor, blocks)
+    _worker_state.update(
+        blocks=blocks,
+        table_x=table_x,
+        rows_by_cluster=rows_by_cluster,
+        statistics=ClusterStatistics(table_x, rows_by_cluster, rows_by_batch),
+    )
+    # shared memory is attached for the lifetime of the worker and closed when it exits
+    Finalize(None, _close_worker, exitpriority=0)
+
+
+def _close_worker():
+    blocks = _worker_state.pop('blocks', [])
+    try:
+        # arrays that use shared memory must be released before it is closed
+        _worker_state.clear()
+    finally:
+        for block in blocks:
+            block.close()
+
+
+def _score_cluster_in_worker(item, score_function, design, kwargs):
+    position, index = item
+    scores = score_cluster(
+        index,
+        _worker_state['table_x'],
+        _worker_state['rows_by_cluster'],
+        score_function,
+        design,
+        statistics=_worker_state['statistics'],
+        **kwargs,
+    )
+    return position, scores
+
+
 class Task:
     future = None
     watcher = None
@@ -317,11 +636,74 @@ class ClusterModel(QAbstractListModel):
         except Exception as ex:
             raise ex
 
-    def _score_genes(self, callback, **kwargs):
+    def _score_genes(self, callback, n_jobs=1, pseudobulk=False, **kwargs):
+        if pseudobulk and kwargs.get('rows_by_batch', None) is not None:
+            # batches are replicates of pseudobulk samples of clusters
+            sums, rows_by_cluster, _, _ = aggregate_rows(
+                kwargs['table_x'], kwargs['rows_by_cluster'], kwargs.pop('rows_by_batch')
+            )
+            kwargs.update(table_x=log_cpm(sums), rows_by_cluster=rows_by_cluster)
+            kwargs.pop('statistics', None)
+
+        if n_jobs is None or n_jobs < 0:
+            n_jobs = os.cpu_count() or 1
+        if n_jobs > 1 and len(self.get_rows()) > 1 and _has_shared_memory():
+            self._score_genes_in_processes(callback, n_jobs, **kwargs)
+            return
+
+        # statistics of clusters are computed once and shared by all clusters
+        kwargs.setdefault(
+            'statistics',
+            ClusterStatistics(kwargs['table_x'], kwargs['rows_by_cluster'], kwargs.get('rows_by_batch', None)),
+        )
         for item in self.get_rows():
             item.cluster_scores(**kwargs)
             callback()
 
+    def _score_genes_in_processes(self, callback, n_jobs, table_x, rows_by_cluster, method, design, **kwargs):
+        """
+        Score clusters in worker processes. Data is passed to workers through shared memory once,
+        and each worker computes cluster statistics once for all clusters it scores. Workers are
+        terminated when the task is cancelled, without waiting for clusters that are being scored.
+        """
+        rows_by_batch = kwargs.pop('rows_by_batch', None)
+        kwargs.pop('statistics', None)
+        items = self.get_rows()
+        score = partial(_score_cluster_in_worker, score_function=method.score_function, design=design, kwargs=kwargs)
+
+        blocks = []
+        try:
+            x_descriptor = _share_matrix(table_x, blocks)
+            pool = multiprocessing.get_context('spawn').Pool(
+                min(n_jobs, len(items)),
+                initializer=_init_worker,
+                initargs=(x_descriptor, rows_by_cluster, rows_by_batch),
+            )
+            try:
+                results = pool.imap_unordered(score, enumerate(item.index for item in items))
+                for _ in items:
+                    while True:
+                        if self._task is not None and self._task.cancelled:
+                            raise KeyboardInterrupt()
+                        try:
+                            position, scores = results.next(timeout=0.1)
+                            break
+                        except multiprocessing.TimeoutError:
+                            pass
+                    items[position].set_scores(method.name, *scores)
+                    callback()
+                pool.close()
+            except BaseException:
+                # stop scoring all clusters, including those in progress, after cancellation or errors
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
     @Slot(bool)
     def progress_advance(self, finish):
         # GUI should be updated in main thread. That's why wex are calling advance method here
@@ -349,6 +731,11 @@ class ClusterModel(QAbstractListModel):
         :param data_x:
         :param rows_by_cluster:
         :param method:
+        :param n_jobs: number of worker processes that score clusters in parallel
+                       (``None`` or ``-1`` for all processors); clusters are scored in a thread by default
+                       and on Python < 3.8, which lacks shared memory
+        :param pseudobulk: sum counts of cells of each cluster in each batch and score genes of these
+                           pseudobulk samples (log2 CPM) with batches as replicates
 
 
         Note:
@@ -386,9 +773,12 @@ class ClusterModel(QAbstractListModel):
 
         """
 
+        # reference counts are shared by all clusters
+        ref_counts = reference_counts(gs_object.select(gene_sets), reference_genes)
+
         for item in self.get_rows():
             genes = [gene.gene_id for gene in item.filtered_genes]
-            item.gene_set_enrichment(gs_object, gene_sets, set(genes), reference_genes)
+            item.gene_set_enrichment(gs_object, gene_sets, set(genes), reference_genes, ref_counts=ref_counts)
 
     def apply_gene_filters(self, p_val=None, fdr=None, count=None):
         [item.filter_enriched_genes(p_val, fdr, max_gene_count=count) for item in self.get_rows()]
@@ -0,0 +1,224 @@
+""" Differential expression of genes """
+from typing import Callable, Optional, NamedTuple
+
+import numpy as np
+
+from Orange.data import Table, Domain, Variable, StringVariable, DiscreteVariable, ContinuousVariable
+
+from orangecontrib.bioinformatics.de.scoring import (
+    LabelStatistics,
+    score_groups,
+    score_anova_f,
+    score_anova_p,
+    score_ttest_p,
+    score_ttest_t,
+    permutation_test,
+    score_fold_change,
+    score_welch_ttest_p,
+    score_welch_ttest_t,
+    score_mann_whitney_p,
+    score_mann_whitney_u,
+    hypergeometric_test_p,
+    score_log_fold_change,
+    score_signal_to_noise,
+    score_kruskal_wallis_h,
+    score_kruskal_wallis_p,
+    score_moderated_ttest_p,
+    score_moderated_ttest_t,
+    hypergeometric_test_score,
+)
+from orangecontrib.bioinformatics.de.pseudobulk import log_cpm, pseudobulk, aggregate_rows
+from orangecontrib.bioinformatics.utils.statistics import FDR, ALT_TWO, ALT_LESS
+from orangecontrib.bioinformatics.widgets.utils.data import TableAnnotation
+
+__all__ = [
+    "METHODS",
+    "TWO_SAMPLE_TEST",
+    "MULTI_SAMPLE_TEST",
+    "rank_genes",
+    "variable_labels",
+    "column_labels",
+    "pseudobulk",
+    "aggregate_rows",
+    "log_cpm",
+]
+
+#: Two-sample tests compare samples with target values with all other samples
+TWO_SAMPLE_TEST = "two-sample"
+#: Multi-sample tests compare samples with each value
+MULTI_SAMPLE_TEST = "multi-sample"
+
+
+class Method(NamedTuple):
+    score: Callable
+    #: p-values of the test, or None for scores without p-values
+    p_value: Optional[Callable]
+    test_type: str
+
+
+#: Methods of :obj:`rank_genes`
+METHODS = {
+    "Fold Change": Method(score_fold_change, None, TWO_SAMPLE_TEST),
+    "log2(Fold Change)": Method(score_log_fold_change, None, TWO_SAMPLE_TEST),
+    "T-test": Method(score_ttest_t, score_ttest_p, TWO_SAMPLE_TEST),
+    "Welch T-test": Method(score_welch_ttest_t, score_welch_ttest_p, TWO_SAMPLE_TEST),
+    "Moderated T-test": Method(score_moderated_ttest_t, score_moderated_ttest_p, TWO_SAMPLE_TEST),
+    "Signal to Noise Ratio": Method(score_signal_to_noise, None, TWO_SAMPLE_TEST),
+    "Mann-Whitney": Method(score_mann_whitney_u, score_mann_whitney_p, TWO_SAMPLE_TEST),
+    "Hypergeometric Test": Method(hypergeometric_test_score, hypergeometric_test_p, TWO_SAMPLE_TEST),
+    "ANOVA": Method(score_anova_f, score_anova_p, MULTI_SAMPLE_TEST),
+    "Kruskal-Wallis": Method(score_kruskal_wallis_h, score_kruskal_wallis_p, MULTI_SAMPLE_TEST),
+}
+
+
+def variable_labels(table, var):
+    """
+    Return the index of the value of a discrete variable for each row of
+    the table (the number of values for unknown values) and the values.
+    """
+    values, _ = table.get_column_view(var)
+    values = np.asarray(values, dtype=float)
+    return np.where(np.isnan(values), len(var.values), values).astype(int), list(var.values)
+
+
+def column_labels(table, key):
+    """
+    Return the index of the value of the column label `key` for each column
+    of the table (the number of values for columns without the label) and
+    the sorted values.
+    """
+    values = sorted({var.attributes[key] for var in table.domain.attributes if key in var.attributes})
+    index = {value: i for i, value in enumerate(values)}
+    labels = np.array([index.get(var.attributes.get(key), len(values)) for var in table.domain.attributes], dtype=int)
+    return labels, values
+
+
+def _genes_in_columns(table):
+    gene_id_attribute = table.attributes.get(TableAnnotation.gene_id_attribute)
+    metas = [StringVariable('Gene')]
+    columns = [[var.name for var in table.domain.attributes]]
+    if gene_id_attribute is not None:
+        metas.append(StringVariable(gene_id_attribute))
+        columns.append([str(var.attributes.get(gene_id_attribute, '')) for var in table.domain.attributes])
+
+    attributes = {TableAnnotation.gene_as_attr_name: False}
+    if gene_id_attribute is not None:
+        attributes[TableAnnotation.gene_id_column] = gene_id_attribute
+    if TableAnnotation.tax_id in table.attributes:
+        attributes[TableAnnotation.tax_id] = table.attributes[TableAnnotation.tax_id]
+    return metas, np.array(columns, dtype=object).T, attributes
+
+
+def rank_genes(
+    table, split, method="T-test", permutations=0, n_jobs=1, target=None, threshold=1, seed=0, replicates=None
+):
+    """
+    Score differential expression of all genes between groups of samples.
+
+    Example:
+
+    >>> result = rank_genes(data, 'cell type', method='Mann-Whitney', target='T cell', permutations=1000)
+    >>> result.get_column_view('FDR')[0]
+
+    Parameters
+    ----------
+    table : Orange.data.Table
+        Gene expressions. Samples are rows if `split` is a variable, and
+        columns if it is a column label.
+    split : Orange.data.DiscreteVariable or str
+        A discrete variable (or its name) that splits rows, or a column label
+        that splits columns into groups of samples
+    method : str, optional (default="T-test")
+        One of :obj:`METHODS`
+    permutations : int, optional (default=0)
+        The number of random permutations of samples between groups for
+        empirical p-values
+    n_jobs : int, optional (default=1)
+        The number of processes that score permutations of methods that are
+        not computed from group statistics; -1 for all processors
+    target : str or list of str, optional
+        Values of samples compared with all other samples in two-sample
+        tests; the first value by default
+    threshold : float, optional (default=1)
+        The expression threshold of the hypergeometric test
+    seed : int, optional (default=0)
+        Seed of random permutations
+    replicates : Orange.data.DiscreteVariable or str, optional
+        A discrete variable (or its name) with replicates (samples, batches
+        or donors) of cells. If given, counts of cells are summed for each
+        value of `split` and replicate (see :obj:`pseudobulk`), normalized
+        to log2 counts per million, and genes are ranked between these
+        pseudobulk samples.
+
+    Returns
+    -------
+    Orange.data.Table
+        A table with a row for each gene with its score, p-value, FDR and,
+        with permutations, the empirical p-value and the family-wise error
+        rate with the step-down max-T adjustment. Methods without p-values
+        have unknown p-values; their empirical p-values are two-sided.
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown method: {}".format(method))
+    method = METHODS[method]
+
+    if isinstance(split, str) and split in table.domain:
+        split = table.domain[split]
+    if replicates is not None:
+        if not isinstance(split, Variable):
+            raise ValueError("Replicates require a split variable")
+        table = pseudobulk(table, split, replicates, normalize=True)
+    if isinstance(split, Variable):
+        if not isinstance(split, DiscreteVariable):
+            raise ValueError("Split variable must be discrete")
+        x = table.X
+        labels, values = variable_labels(table, split)
+        gene_metas, gene_names, attributes = _genes_in_columns(table)
+    else:
+        x = table.X.T
+        labels, values = column_labels(table, split)
+        gene_metas, gene_names, attributes = list(table.domain.metas), table.metas, dict(table.attributes)
+    if len(values) < 2:
+        raise ValueError("Split must have at least two values")
+
+    if method.test_type == TWO_SAMPLE_TEST:
+        if target is None:
+            target = [values[0]]
+        elif isinstance(target, str):
+            target = [target]
+        unknown = set(target) - set(values)
+        if unknown:
+            raise ValueError("Unknown target values: {}".format(", ".join(map(str, sorted(unknown)))))
+        selected = [values.index(value) for value in target]
+        groups = [selected, [i for i in range(len(values) + 1) if i not in selected]]
+    else:
+        groups = [[i] for i in range(len(values))]
+
+    statistics = LabelStatistics(x, labels, len(values))
+    indices = [statistics.indices(group) for group in groups]
+    if not all(len(ind) for ind in indices):
+        raise ValueError("Each group must contain at least one sample")
+
+    scores, _ = score_groups(statistics, method.score, groups, threshold)
+    p_values = np.full(len(scores), np.nan)
+    if method.p_value is not None:
+        p_values, _ = score_groups(statistics, method.p_value, groups, threshold)
+    fdr = np.full(len(scores), np.nan)
+    valid = np.isfinite(p_values)
+    fdr[valid] = FDR(p_values[valid])
+    columns = [("Score", scores), ("P-value", p_values), ("FDR", fdr)]
+
+    if permutations:
+        # p-values of tests are more extreme when lower
+        score_func, alternative, observed = method.score, ALT_TWO, scores
+        if method.p_value is not None:
+            score_func, alternative, observed = method.p_value, ALT_LESS, p_values
+        _, empirical, adjusted = permutation_test(
+            x, indices, score_func, observed, permutations, alternative, threshold, seed=seed, n_jobs=n_jobs
+        )
+        columns += [("Permutation p-value", empirical), ("FWER (max-T)", adjusted)]
+
+    domain = Domain([ContinuousVariable(name) for name, _ in columns], metas=gene_metas)
+    result = Table.from_numpy(domain, np.column_stack([values for _, values in columns]), metas=gene_names)
+    result.attributes = attributes
+    return result
@@ -0,0 +1,128 @@
+""" Pseudobulk aggregation of cells by group and replicate """
+import numpy as np
+import scipy.sparse as sp
+
+from Orange.data import Table, Domain, Variable, DiscreteVariable, ContinuousVariable
+from Orange.data.util import get_unique_names
+
+__all__ = ["aggregate_rows", "log_cpm", "pseudobulk"]
+
+
+def aggregate_rows(x, rows_by_group, rows_by_sample=None):
+    """
+    Sum rows of `x` for each combination of group and sample.
+
+    Rows are summed with a product of a sparse one-hot (pseudobulk samples
+    x rows) matrix and `x`, so sparse data is never densified; only the
+    much smaller aggregated matrix is dense. Rows with unknown (NaN) group
+    or sample are skipped.
+
+    Parameters
+    ----------
+    x : np.ndarray or scipy.sparse.spmatrix
+        Counts (cells x genes)
+    rows_by_group : np.ndarray
+        The group (e.g. cluster or cell type index) of each row
+    rows_by_sample : np.ndarray, optional
+        The sample (e.g. batch or donor index) of each row; all rows
+        belong to the same sample if not given
+
+    Returns
+    -------
+    np.ndarray
+        Sums of rows of each pseudobulk sample (pseudobulk samples x genes)
+    np.ndarray
+        The group of each pseudobulk sample
+    np.ndarray
+        The sample of each pseudobulk sample
+    np.ndarray
+        The number of rows summed in each pseudobulk sample
+    """
+    rows_by_group = np.asarray(rows_by_group, dtype=float)
+    if rows_by_sample is None:
+        rows_by_sample = np.zeros(len(rows_by_group))
+    rows_by_sample = np.asarray(rows_by_sample, dtype=float)
+
+    known = np.flatnonzero(~(np.isnan(rows_by_group) | np.isnan(rows_by_sample)))
+    pairs, pseudo_samples = np.unique(
+        np.column_stack((rows_by_group[known], rows_by_sample[known])), axis=0, return_inverse=True
+    )
+    pseudo_samples = pseudo_samples.ravel()
+
+    design = sp.csr_matrix((np.ones(len(known)), (pseudo_samples, known)), shape=(len(pairs), x.shape[0]))
+    sums = design @ x
+    if sp.issparse(sums):
+        sums = sums.toarray()
+    counts = np.bincount(pseudo_samples, minlength=len(pairs))
+    return np.asarray(sums, dtype=float), pairs[:, 0].astype(int), pairs[:, 1].astype(int), counts
+
+
+def log_cpm(sums):
+    """
+    Normalize summed counts of each pseudobulk sample to counts per
+    million and return their binary logarithm (with a pseudocount of 1).
+    """
+    library_sizes = sums.sum(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cpm = np.where(library_sizes > 0, sums / library_sizes * 1e6, 0)
+    return np.log2(cpm + 1)
+
+
+def _discrete_variable(table, var):
+    if isinstance(var, str) and var in table.domain:
+        var = table.domain[var]
+    if not isinstance(var, DiscreteVariable):
+        raise ValueError("{} is not a discrete variable".format(var.name if isinstance(var, Variable) else var))
+    return var
+
+
+def pseudobulk(table, group, sample, normalize=False):
+    """
+    Sum expressions of cells in each group for each sample (replicate).
+
+    Differential expression of pseudobulk samples accounts for variability
+    between replicates, which tests that treat each cell as an independent
+    sample ignore, and is much faster on the aggregated table.
+
+    Example:
+
+    >>> bulk = pseudobulk(data, 'cell type', 'donor', normalize=True)
+    >>> result = rank_genes(bulk, 'cell type', target='T cell')
+
+    Parameters
+    ----------
+    table : Orange.data.Table
+        Gene expression counts with cells in rows and genes in columns
+    group : Orange.data.DiscreteVariable or str
+        A discrete variable (or its name) with groups of cells, such as
+        clusters or cell types
+    sample : Orange.data.DiscreteVariable or str
+        A discrete variable (or its name) with samples, batches or donors
+    normalize : bool, optional (default=False)
+        Return log2 counts per million instead of sums
+
+    Returns
+    -------
+    Orange.data.Table
+        A table with a row for each combination of group and sample with
+        at least one cell. The group is the class variable; the sample
+        and the number of cells are meta attributes. Cells with unknown
+        group or sample are skipped.
+    """
+    group = _discrete_variable(table, group)
+    sample = _discrete_variable(table, sample)
+    if group is sample:
+        raise ValueError("Group and sample must not be the same variable")
+
+    sums, groups, samples, counts = aggregate_rows(
+        table.X, table.get_column_view(group)[0], table.get_column_view(sample)[0]
+    )
+    if normalize:
+        sums = log_cpm(sums)
+
+    names = [var.name for var in table.domain.variables + table.domain.metas]
+    cells = ContinuousVariable(get_unique_names(names, "Cells"))
+    domain = Domain(table.domain.attributes, group, metas=[sample, cells])
+    result = Table.from_numpy(domain, sums, groups, np.column_stack((samples, counts)).astype(object))
+    result.attributes = dict(table.attributes)
+    return result
@@ -0,0 +1,551 @@
+""" Scores of differential expression of genes between groups of samples """
+import time
+import threading
+from functools import reduce, partial
+
+import numpy as np
+
+from orangecontrib.bioinformatics.utils.statistics import (
+    ALT_TWO,
+    GroupStatistics,
+    nanstd,
+    nanmean,
+    _rank_sums,
+    score_t_test,
+    _count_at_least,
+    score_mann_whitney,
+    score_welch_t_test,
+    score_kruskal_wallis,
+    score_moderated_t_test,
+    t_test_from_statistics,
+    f_oneway_from_statistics,
+    score_hypergeometric_test,
+    mann_whitney_from_rank_sums,
+    kruskal_wallis_from_rank_sums,
+    hypergeometric_test_from_counts,
+    moderated_t_test_from_statistics,
+)
+from orangecontrib.bioinformatics.utils.permutation import PermutationPValues, permutation_scores
+
+
+def score_fold_change(a, b, **kwargs):
+    """
+    Calculate the fold change between `a` and `b` samples.
+
+    Parameters
+    ----------
+    a, b : array
+        Arrays containing the samples
+    axis : int
+        Axis over which to compute the FC
+
+    Returns
+    -------
+    FC : array
+        The FC scores
+    """
+    axis = kwargs.get('axis', 0)
+
+    mean_a = nanmean(a, axis=axis)
+    mean_b = nanmean(b, axis=axis)
+    res = mean_a / mean_b
+    warning = None
+    if np.any(res < 0):
+        res[res < 0] = float("nan")
+        warning = "Negative fold change scores were ignored. You should use another scoring method."
+    return res, warning
+
+
+def score_log_fold_change(a, b, **kwargs):
+    """
+    Return the log2(FC).
+
+    See Also
+    --------
+    score_fold_change
+
+    """
+    axis = kwargs.get('axis', 0)
+    s, w = score_fold_change(a, b, axis=axis)
+    return np.log2(s), w
+
+
+def score_ttest(a, b, **kwargs):
+    axis = kwargs.get('axis', 0)
+    T, P = score_t_test(a, b, axis=axis)
+    return T, P
+
+
+def score_ttest_t(a, b, **kwargs):
+    axis = kwargs.get('axis', 0)
+    T, _ = score_ttest(a, b, axis=axis)
+    return T
+
+
+def score_ttest_p(a, b, **kwargs):
+    axis = kwargs.get('axis', 0)
+    _, P = score_ttest(a, b, axis=axis)
+    return P
+
+
+def score_welch_ttest_t(a, b, **kwargs):
+    axis = kwargs.get('axis', 0)
+    T, _ = score_welch_t_test(a, b, axis=axis)
+    return T
+
+
+def score_welch_ttest_p(a, b, **kwargs):
+    axis = kwargs.get('axis', 0)
+    _, P = score_welch_t_test(a, b, axis=axis)
+    return P
+
+
+def score_moderated_ttest_t(a, b, **kwargs):
+    axis = kwargs.get('axis', 0)
+    T, _ = score_moderated_t_test(a, b, axis=axis)
+    return T
+
+
+def score_moderated_ttest_p(a, b, **kwargs):
+    axis = kwargs.get('axis', 0)
+    _, P = score_moderated_t_test(a, b, axis=axis)
+    return P
+
+
+def score_anova(*arrays, **kwargs):
+    axis = kwargs.get('axis', 0)
+    F, P = f_oneway(*arrays, axis=axis)
+    return F, P
+
+
+def score_anova_(*arrays, **kwargs):
+    axis = kwargs.get('axis', 0)
+
+    if not len(arrays) > 1:
+        raise TypeError("Need at least 2 positional arguments")
+
+    if not 0 <= axis < 2:
+        raise ValueError("0 <= axis < 2")
+
+    if not all(arrays[i].ndim == arrays[i + 1].ndim for i in range(len(arrays) - 2)):
+        raise ValueError("All arrays must have the same number of dimensions")
+
+    if axis >= arrays[0].ndim:
+        raise ValueError()
+
+    return f_oneway(*arrays, axis=axis)
+
+
+def f_oneway(*arrays, **kwargs):
+    """
+    Perform a 1-way ANOVA
+
+    Like `scipy.stats.f_oneway` but accept 2D arrays, with `axis`
+    specifying over which axis to operate (in which axis the samples
+    are stored). Scores of all features are computed from sums and
+    sums of squares of groups, without concatenating the groups;
+    sparse matrices are not densified.
+
+    Parameters
+    ----------
+    A1, A2, ... : array_like
+        The samples for each group.
+    axis : int
+        The axis which contain the samples.
+
+    Returns
+    -------
+    F : array
+        F scores
+    P : array
+        P values
+
+    See also
+    --------
+    scipy.stats.f_oneway
+    """
+    axis = kwargs.get('axis', 0)
+    if all(np.ndim(a) == 1 for a in arrays):
+        F, P = f_oneway(*[np.c_[a] for a in arrays], axis=0)
+        return F[0], P[0]
+
+    return f_oneway_from_statistics([GroupStatistics.from_data(a, axis) for a in arrays])
+
+
+def score_anova_f(*arrays, **kwargs):
+    axis = kwargs.get('axis', 0)
+    F, _ = score_anova(*arrays, axis=axis)
+    return F
+
+
+def score_anova_p(*arrays, **kwargs):
+    axis = kwargs.get('axis', 0)
+    _, P = score_anova(*arrays, axis=axis)
+    return P
+
+
+def score_signal_to_noise(a, b, **kwargs):
+    axis = kwargs.get('axis', 0)
+    mean_a = nanmean(a, axis=axis)
+    mean_b = nanmean(b, axis=axis)
+
+    std_a = nanstd(a, axis=axis, ddof=1)
+    std_b = nanstd(b, axis=axis, ddof=1)
+
+    return (mean_a - mean_b) / (std_a + std_b)
+
+
+def score_mann_whitney_u(a, b, **kwargs):
+    axis = kwargs.get('axis', 0)
+    U, _ = score_mann_whitney(a, b, axis=axis)
+    return U
+
+
+def score_mann_whitney_p(a, b, **kwargs):
+    axis = kwargs.get('axis', 0)
+    _, P = score_mann_whitney(a, b, axis=axis)
+    return P
+
+
+def score_kruskal_wallis_h(*arrays, **kwargs):
+    axis = kwargs.get('axis', 0)
+    H, _ = score_kruskal_wallis(*arrays, axis=axis)
+    return H
+
+
+def score_kruskal_wallis_p(*arrays, **kwargs):
+    axis = kwargs.get('axis', 0)
+    _, P = score_kruskal_wallis(*arrays, axis=axis)
+    return P
+
+
+def hypergeometric_test_score(*args, **kwargs):
+
+    expression_treshold = kwargs.get('treshold', None)
+    scores, _ = score_hypergeometric_test(*args, expression_treshold)
+    return scores
+
+
+def hypergeometric_test_p(*args, **kwargs):
+    expression_treshold = kwargs.get('treshold', None)
+    _, p_values = score_hypergeometric_test(*args, expression_treshold)
+    return p_values
+
+
+def scores_only(score_func, *arrays, **kwargs):
+    """ Return scores of score functions that also return warnings or p-values. """
+    ss = score_func(*arrays, **kwargs)
+    return ss[0] if isinstance(ss, tuple) else ss
+
+
+def statistic_fold_change(a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = a.mean / b.mean
+    scores[scores < 0] = np.nan
+    return scores
+
+
+def statistic_log_fold_change(a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.log2(statistic_fold_change(a, b))
+
+
+def statistic_ttest_t(a, b):
+    T, _ = t_test_from_statistics(a, b)
+    return T
+
+
+def statistic_ttest_p(a, b):
+    _, P = t_test_from_statistics(a, b)
+    return P
+
+
+def statistic_welch_ttest_t(a, b):
+    T, _ = t_test_from_statistics(a, b, equal_var=False)
+    return T
+
+
+def statistic_welch_ttest_p(a, b):
+    _, P = t_test_from_statistics(a, b, equal_var=False)
+    return P
+
+
+def statistic_anova_f(*groups):
+    F, _ = f_oneway_from_statistics(groups)
+    return F
+
+
+def statistic_anova_p(*groups):
+    _, P = f_oneway_from_statistics(groups)
+    return P
+
+
+def statistic_signal_to_noise(a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (a.mean - b.mean) / (np.sqrt(a.var(ddof=1)) + np.sqrt(b.var(ddof=1)))
+
+
+#: Scores that are computed from statistics of groups (:obj:`GroupStatistics`). Scores of
+#: label permutations are computed for blocks of permutations at once.
+STATISTICS_SCORES = {
+    score_fold_change: statistic_fold_change,
+    score_log_fold_change: statistic_log_fold_change,
+    score_ttest_t: statistic_ttest_t,
+    score_ttest_p: statistic_ttest_p,
+    score_welch_ttest_t: statistic_welch_ttest_t,
+    score_welch_ttest_p: statistic_welch_ttest_p,
+    score_anova_f: statistic_anova_f,
+    score_anova_p: statistic_anova_p,
+    score_signal_to_noise: statistic_signal_to_noise,
+}
+
+#: Scores computed from ranks within all samples
+RANK_SCORES = (score_mann_whitney_u, score_mann_whitney_p, score_kruskal_wallis_h, score_kruskal_wallis_p)
+
+#: Scores of the moderated t-test, whose prior is estimated from statistics of all genes
+MODERATED_T_TEST_SCORES = (score_moderated_ttest_t, score_moderated_ttest_p)
+
+#: Null scores of at most this many permutations are kept for the histogram and thresholds;
+#: permutation p-values are computed from all permutations.
+NULL_DISTRIBUTION_PERMUTATIONS = 1000
+
+
+class LabelStatistics:
+    """
+    Statistics of genes in samples with each value of a label, computed once per
+    table and shared by all splits of label values into groups.
+
+    Scores that depend only on group statistics are computed from merged statistics
+    of label values, so changing the target values or the test type does not need
+    another pass over the data. Tables with unknown values are scored from the data
+    (the statistics skip unknown values, unlike most score functions).
+    """
+
+    def __init__(self, x, labels, n_values):
+        """
+        Parameters
+        ----------
+        x : array or sparse matrix
+            The data (samples x genes)
+        labels : array
+            The index of the label value of each sample; samples without
+            a value have index `n_values`
+        n_values : int
+            The number of label values
+        """
+        self.x = x
+        self.labels = labels
+        self.n_values = n_values
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, key, compute):
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = compute()
+            return self._cache[key]
+
+    def indices(self, values):
+        """Return indices of samples with the given label values."""
+        return np.flatnonzero(np.isin(self.labels, values))
+
+    def _label_statistics(self):
+        # statistics of each label value and whether the data has unknown values
+        def compute():
+            # rows of one label value are copied at a time, never the whole data
+            groups = [
+                GroupStatistics.from_data(self.x[self.labels == v], ignore_nan=True) for v in range(self.n_values + 1)
+            ]
+            sizes = np.bincount(self.labels, minlength=self.n_values + 1)
+            return groups, any(np.any(g.n < size) for g, size in zip(groups, sizes))
+
+        return self._cached('statistics', compute)
+
+    def group_statistics(self, values):
+        """Return statistics of samples with the given label values."""
+        groups, _ = self._label_statistics()
+        return reduce(GroupStatistics.merge, [groups[v] for v in values])
+
+    def score(self, score_func, groups, threshold=1):
+        """
+        Score genes of groups of label values.
+
+        Parameters
+        ----------
+        score_func : callable
+            One of the widget's score functions
+        groups : list of lists of int
+            Label values of each group; groups of two-sample tests
+            together contain all samples
+        threshold : float
+            The expression threshold of the hypergeometric test
+
+        Returns
+        -------
+        (scores, warning) : (array, str or None)
+            Scores, or None if the score is not computed from statistics
+        """
+        warning = None
+        if score_func in (hypergeometric_test_score, hypergeometric_test_p):
+            expressed = self._cached(
+                ('expressed', threshold),
+                lambda: [_count_at_least(self.x[self.labels == v], threshold) for v in range(self.n_values + 1)],
+            )
+            n = np.bincount(self.labels, minlength=self.n_values + 1)
+            a, b = groups
+            scores, p_values = hypergeometric_test_from_counts(
+                sum(expressed[v] for v in a), n[a].sum(), sum(expressed[v] for v in b), n[b].sum()
+            )
+            return (scores if score_func is hypergeometric_test_score else p_values), warning
+        elif score_func in RANK_SCORES:
+            # ranks within all samples are only valid if the groups contain all samples
+            n = np.bincount(self.labels, minlength=self.n_values + 1)
+            if sum(n[values].sum() for values in groups) != len(self.labels):
+                return None
+            rank_sums, tie_terms = self._cached('ranks', lambda: _rank_sums(self.x, self.labels, self.n_values + 1))
+            group_rank_sums = np.array([rank_sums[values].sum(axis=0) for values in groups])
+            sizes = np.array([n[values].sum() for values in groups])
+            if score_func in (score_mann_whitney_u, score_mann_whitney_p):
+                scores, p_values = mann_whitney_from_rank_sums(group_rank_sums[0], *sizes, tie_terms)
+                return (scores if score_func is score_mann_whitney_u else p_values), warning
+            else:
+                scores, p_values = kruskal_wallis_from_rank_sums(group_rank_sums, sizes, tie_terms)
+                return (scores if score_func is score_kruskal_wallis_h else p_values), warning
+
+        if score_func not in STATISTICS_SCORES and score_func not in MODERATED_T_TEST_SCORES:
+            return None
+        _, unknowns = self._label_statistics()
+        if unknowns:
+            return None
+
+        statistics = [self.group_statistics(values) for values in groups]
+        if score_func in MODERATED_T_TEST_SCORES:
+            scores, p_values = moderated_t_test_from_statistics(*statistics)
+            return (scores if score_func is score_moderated_ttest_t else p_values), warning
+        if score_func in (score_fold_change, score_log_fold_change):
+            a, b = statistics
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if np.any(a.mean / b.mean < 0):
+                    warning = "Negative fold change scores were ignored. You should use another scoring method."
+        return STATISTICS_SCORES[score_func](*statistics), warning
+
+
+def score_groups(statistics, score_func, groups, threshold=1):
+    """
+    Score genes of groups of label values, from cached statistics of label
+    values when the score allows it and from the data otherwise.
+
+    Parameters
+    ----------
+    statistics : LabelStatistics
+        Statistics of label values of the data
+    score_func : callable
+        A score function, ``score_func(*arrays, axis=0, treshold=threshold)``
+    groups : list of lists of int
+        Label values of each group
+    threshold : float
+        The expression threshold of the hypergeometric test
+
+    Returns
+    -------
+    (scores, warning) : (array, str or None)
+    """
+    result = statistics.score(score_func, groups, threshold)
+    if result is None:
+        arrays = [statistics.x[statistics.indices(values)] for values in groups]
+        result = score_func(*arrays, axis=0, treshold=threshold)
+        if not isinstance(result, tuple):
+            result = result, None
+    return result
+
+
+def permutation_test(
+    x,
+    indices,
+    score_func,
+    scores,
+    n_permutations,
+    alternative=ALT_TWO,
+    threshold=1,
+    seed=0,
+    n_jobs=1,
+    callback=None,
+    partial_results=None,
+):
+    """
+    Score genes under random permutations of samples between groups and
+    compute empirical p-values of observed scores.
+
+    Scores that are computed from group statistics (:obj:`STATISTICS_SCORES`)
+    are computed for blocks of permutations in this process; other scores are
+    computed in `n_jobs` worker processes.
+
+    Parameters
+    ----------
+    x : array or sparse matrix
+        The data (samples x genes)
+    indices : list of arrays
+        Indices of samples in each group
+    score_func : callable
+        A score function, ``score_func(*arrays, axis=0, treshold=threshold)``
+    scores : array
+        Observed scores of genes
+    n_permutations : int
+        The number of permutations
+    alternative : str
+        ALT_GREATER if high scores are extreme, ALT_LESS if low scores are
+        extreme and ALT_TWO for both; fold changes are compared on log scale
+    threshold : float
+        The expression threshold of the hypergeometric test
+    seed : int
+        Seed of random permutations
+    n_jobs : int
+        The number of worker processes; -1 for all processors
+    callback : callable, optional
+        Called with the number of scored permutations
+    partial_results : callable, optional
+        Called with null scores of permutations scored so far, at most once per second
+
+    Returns
+    -------
+    null_scores : array
+        Scores of at most :obj:`NULL_DISTRIBUTION_PERMUTATIONS` permutations (permutations x genes)
+    p_values : array
+        Empirical p-values of genes
+    adjusted_p_values : array
+        Westfall-Young step-down max-T adjusted p-values (family-wise error rate)
+    """
+
+    def extremeness(values):
+        # fold change is centered on 1.0
+        if score_func is score_fold_change:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return np.log2(values)
+        return values
+
+    if score_func in STATISTICS_SCORES:
+        # all permutations are scored at once from group sums
+        tasks = permutation_scores(x, indices, n_permutations, statistic=STATISTICS_SCORES[score_func], seed=seed)
+    else:
+        score = partial(scores_only, score_func, axis=0, treshold=threshold)
+        tasks = permutation_scores(x, indices, n_permutations, score=score, seed=seed, n_jobs=n_jobs)
+
+    p_values = PermutationPValues(extremeness(scores), alternative)
+    null_scores = np.empty((min(n_permutations, NULL_DISTRIBUTION_PERMUTATIONS), len(scores)))
+    done = np.zeros(len(null_scores), dtype=bool)
+    last_update = time.monotonic()
+    try:
+        for start, task_scores in tasks:
+            assert task_scores.shape[1:] == scores.shape
+            p_values.update(extremeness(task_scores))
+            kept = task_scores[: max(len(null_scores) - start, 0)]
+            null_scores[start : start + len(kept)] = kept
+            done[start : start + len(kept)] = True
+            if callback is not None:
+                callback(len(task_scores))
+            if partial_results is not None and time.monotonic() - last_update > 1 and not done.all():
+                partial_results(null_scores[done])
+                last_update = time.monotonic()
+    finally:
+        tasks.close()
+    return null_scores, p_values.p_values, p_values.adjusted_p_values
@@ -1,5 +1,9 @@
 """ GeneSet module """
-from typing import Tuple
+import os
+import json
+import hashlib
+from typing import Dict, Tuple, Iterable
+from collections import defaultdict
 
 from orangecontrib.bioinformatics.utils import serverfiles
 from orangecontrib.bioinformatics.geneset.utils import (
@@ -8,6 +12,7 @@ from orangecontrib.bioinformatics.geneset.utils import (
     GeneSetException,
     NoGeneSetsException,
     filename,
+    _gmt_source,
     filename_parse,
 )
 
@@ -66,3 +71,100 @@ def load_gene_sets(hierarchy, tax_id):
     """
     file_path = serverfiles.localpath_download(DOMAIN, filename(hierarchy, tax_id))
     return GeneSets.from_gmt_file_format(file_path)
+
+
+def reference_hash(reference):
+    # type: (Iterable[str]) -> str
+    """ Return a hash of the reference gene universe (independent of gene order). """
+    sha = hashlib.sha1()
+    for gene in sorted({str(gene) for gene in reference}):
+        sha.update(gene.encode('utf-8'))
+        sha.update(b'\n')
+    return sha.hexdigest()
+
+
+def _counts_cache_path(gmt_path):
+    # type: (str) -> str
+    return '{}.counts.json'.format(gmt_path[:-4])
+
+
+def _load_counts(cache_path, gmt_path, ref_hash):
+    # type: (str, str, str) -> Dict[str, Tuple[int, int]]
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as cache_file:
+            cached = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+    # counts are valid only for the GMT file and the reference they were computed from
+    if cached.get('gmt_mtime') != os.path.getmtime(gmt_path) or cached.get('reference') != ref_hash:
+        return {}
+    return {gs_id: tuple(entry) for gs_id, entry in cached.get('counts', {}).items()}
+
+
+def _store_counts(cache_path, gmt_path, ref_hash, counts):
+    # type: (str, str, str, Dict[str, Tuple[int, int]]) -> None
+    tmp_path = cache_path + '.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as cache_file:
+            json.dump({'gmt_mtime': os.path.getmtime(gmt_path), 'reference': ref_hash, 'counts': counts}, cache_file)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # the cache is an optimization, a read-only cache directory is not an error
+        pass
+
+
+def reference_counts(gene_sets, reference):
+    # type: (GeneSets, Iterable[str]) -> Dict[GeneSet, int]
+    """ Return the number of reference genes in each gene set.
+
+    Counts of gene sets read from server files (see :func:`load_gene_sets`) are stored next to
+    their GMT files together with :func:`reference_hash` of the reference, so repeated enrichments
+    with the same reference (for example all genes of the organism) do not intersect each set with
+    the reference again. Only counts for the last reference are kept. Counts of other gene sets,
+    and of gene sets whose genes were assigned after reading, are always computed.
+
+    :param gene_sets: gene sets
+    :param reference: reference genes
+    :rtype: :obj:`dict` of (:obj:`GeneSet`, :obj:`int`)
+
+    Example
+    --------
+        >>> counts = reference_counts(gene_sets, reference)
+        >>> gene_set.count_enrichment(len(reference), counts[gene_set], query)
+    """
+    reference = set(reference)
+    ref_hash = None
+    counts = {}
+
+    by_source = defaultdict(list)
+    for gene_set in gene_sets:
+        by_source[gene_set._source, gene_set.hierarchy, gene_set.organism].append(gene_set)
+
+    for (source, hierarchy, organism), sets in by_source.items():
+        gmt_path = None
+        if source is not None and hierarchy and organism:
+            gmt_path = serverfiles.localpath(DOMAIN, filename(hierarchy, organism))
+
+        if gmt_path is None or not os.path.isfile(gmt_path) or source != _gmt_source(gmt_path):
+            counts.update((gene_set, len(gene_set.genes & reference)) for gene_set in sets)
+            continue
+
+        if ref_hash is None:
+            ref_hash = reference_hash(reference)
+
+        cache_path = _counts_cache_path(gmt_path)
+        cached = _load_counts(cache_path, gmt_path, ref_hash)
+        missing = [gene_set for gene_set in sets if gene_set.gs_id not in cached]
+
+        if missing:
+            for gene_set in missing:
+                cached[gene_set.gs_id] = len(gene_set.genes), len(gene_set.genes & reference)
+            _store_counts(cache_path, gmt_path, ref_hash, cached)
+
+        for gene_set in sets:
+            size, count = cached[gene_set.gs_id]
+            # guard against genes that were changed in place after reading
+            counts[gene_set] = count if size == len(gene_set.genes) else len(gene_set.genes & reference)
+
+    return counts
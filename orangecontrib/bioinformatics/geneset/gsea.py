@@ -0,0 +1,249 @@
+""" Preranked gene set enrichment analysis """
+import os
+from typing import Dict, List, Tuple, Callable, Optional, Sequence, NamedTuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from orangecontrib.bioinformatics.geneset.utils import GeneSet, GeneSets
+
+#: Number of permutations computed by a single task. Tasks (and their random streams) do not depend
+#: on the number of workers, so results are reproducible for any ``n_jobs``.
+PERMUTATIONS_PER_TASK = 50
+
+#: Permutations within a task are scored in batches of about this many gene set hits to bound memory use.
+BATCH_ELEMENTS = 2 ** 21
+
+gsea_result = NamedTuple(
+    'gsea_result',
+    [
+        ('es', float),
+        ('nes', float),
+        ('p_value', float),
+        ('fdr', float),
+        ('size', int),
+        ('leading_edge', set),
+    ],
+)
+
+
+def _segment_enrichment_scores(positions, weights, starts, sizes, n_genes):
+    # type: (np.ndarray, np.ndarray, np.ndarray, np.ndarray, int) -> np.ndarray
+    """Enrichment scores of all gene sets at once.
+
+    Hit positions of gene sets are concatenated along the last axis and sorted within each
+    segment (gene set) given by ``starts`` and ``sizes``. Leading axis enumerates rankings
+    (observed ranking or permutations).
+
+    :return: array of shape (rankings, gene sets)
+    """
+    cum_weights = np.cumsum(weights, axis=1)
+    set_weights = np.add.reduceat(weights, starts, axis=1)
+
+    # cumulative weight within each segment
+    before_segment = np.zeros_like(set_weights)
+    before_segment[:, 1:] = cum_weights[:, starts[1:] - 1]
+    cum_weights -= np.repeat(before_segment, sizes, axis=1)
+
+    rank_in_set = np.arange(positions.shape[1]) - np.repeat(starts, sizes)
+    misses = (positions - rank_in_set) / np.repeat(n_genes - sizes, sizes)
+    set_weights = np.repeat(set_weights, sizes, axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # running sum at each hit and just before it
+        at_hit = cum_weights / set_weights - misses
+        before_hit = (cum_weights - weights) / set_weights - misses
+
+    max_dev = np.maximum.reduceat(at_hit, starts, axis=1)
+    min_dev = np.minimum.reduceat(before_hit, starts, axis=1)
+    return np.where(np.abs(max_dev) >= np.abs(min_dev), max_dev, min_dev)
+
+
+def _null_enrichment_scores(seed, n_perm, genes_flat, starts, sizes, abs_scores):
+    # type: (np.random.SeedSequence, int, np.ndarray, np.ndarray, np.ndarray, np.ndarray) -> np.ndarray
+    """Enrichment scores of ``n_perm`` gene label permutations, shape (gene sets, n_perm)."""
+    rng = np.random.default_rng(seed)
+    n_genes = len(abs_scores)
+    offsets = np.repeat(np.arange(len(sizes), dtype=np.int64) * n_genes, sizes)
+    batch_size = max(1, BATCH_ELEMENTS // len(genes_flat))
+
+    null = np.empty((len(sizes), n_perm))
+    for start in range(0, n_perm, batch_size):
+        batch = min(batch_size, n_perm - start)
+        permutations = np.array([rng.permutation(n_genes) for _ in range(batch)])
+        positions = permutations[:, genes_flat] + offsets
+        positions.sort(axis=1)
+        positions -= offsets
+
+        scores = _segment_enrichment_scores(positions, abs_scores[positions], starts, sizes, n_genes)
+        null[:, start : start + batch] = scores.T
+    return null
+
+
+def _normalize(es, null):
+    # type: (np.ndarray, np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]
+    """Return normalized scores, normalized null scores and nominal p-values."""
+    positive_null = null >= 0
+    negative_null = ~positive_null
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        positive_mean = np.where(positive_null, null, 0).sum(axis=1) / positive_null.sum(axis=1)
+        negative_mean = -np.where(negative_null, null, 0).sum(axis=1) / negative_null.sum(axis=1)
+
+        nes = np.where(es >= 0, es / positive_mean, es / negative_mean)
+        null_nes = np.where(positive_null, null / positive_mean[:, None], null / negative_mean[:, None])
+
+        p_values = np.where(
+            es >= 0,
+            (positive_null & (null >= es[:, None])).sum(axis=1) / positive_null.sum(axis=1),
+            (negative_null & (null <= es[:, None])).sum(axis=1) / negative_null.sum(axis=1),
+        )
+    return nes, null_nes, p_values
+
+
+def _fdr(nes, null_nes):
+    # type: (np.ndarray, np.ndarray) -> np.ndarray
+    """False discovery rates comparing each NES to the NES of all gene sets under permutations."""
+    null_nes = null_nes[np.isfinite(null_nes)]
+    null_positive = np.sort(null_nes[null_nes >= 0])
+    null_negative = np.sort(null_nes[null_nes < 0])
+    observed_positive = np.sort(nes[nes >= 0])
+    observed_negative = np.sort(nes[nes < 0])
+
+    def fraction_above(sorted_values, values):
+        return (len(sorted_values) - np.searchsorted(sorted_values, values, side='left')) / max(len(sorted_values), 1)
+
+    def fraction_below(sorted_values, values):
+        return np.searchsorted(sorted_values, values, side='right') / max(len(sorted_values), 1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fdr = np.where(
+            nes >= 0,
+            fraction_above(null_positive, nes) / fraction_above(observed_positive, nes),
+            fraction_below(null_negative, nes) / fraction_below(observed_negative, nes),
+        )
+    fdr[np.isnan(nes)] = np.nan
+    return np.minimum(fdr, 1)
+
+
+def _leading_edge(es, positions, weights, n_genes):
+    # type: (float, np.ndarray, np.ndarray, int) -> np.ndarray
+    """Positions of leading edge genes: hits before the peak (positive ES) or after it (negative ES)."""
+    cum_weights = np.cumsum(weights) / weights.sum()
+    misses = (positions - np.arange(len(positions))) / (n_genes - len(positions))
+
+    if es >= 0:
+        return positions[: np.argmax(cum_weights - misses) + 1]
+    else:
+        return positions[np.argmin(cum_weights - weights / weights.sum() - misses) :]
+
+
+def gsea_preranked(
+    gene_sets,  # type: GeneSets
+    genes,  # type: Sequence[str]
+    scores,  # type: Sequence[float]
+    permutations=1000,  # type: int
+    weight=1.0,  # type: float
+    min_size=15,  # type: int
+    max_size=500,  # type: int
+    seed=0,  # type: int
+    n_jobs=1,  # type: Optional[int]
+    callback=None,  # type: Optional[Callable[[float], None]]
+):
+    # type: (...) -> Dict[GeneSet, gsea_result]
+    """Preranked gene set enrichment analysis (Subramanian et al., 2005).
+
+    Genes are ranked by decreasing score. Enrichment scores of all gene sets are computed at once,
+    and the null distribution is obtained with gene label permutations, which are split into tasks
+    of :data:`PERMUTATIONS_PER_TASK` permutations with independent random streams.
+
+    :param gene_sets: gene sets
+    :param genes: unique gene ids
+    :param scores: gene scores (for example t-statistics or log fold changes)
+    :param permutations: number of gene label permutations
+    :param weight: exponent of score weights in the running sum (0 gives the Kolmogorov-Smirnov statistic)
+    :param min_size: ignore gene sets with less ranked genes
+    :param max_size: ignore gene sets with more ranked genes
+    :param seed: seed of the random number generator
+    :param n_jobs: number of worker processes (``None`` or ``-1`` for all processors)
+    :param callback: called with the fraction of permutations done
+    :rtype: :obj:`dict` of (:obj:`GeneSet`, :obj:`gsea_result`)
+
+    Example
+    --------
+        >>> results = gsea_preranked(gene_sets, genes, t_scores, permutations=1000, n_jobs=-1)
+        >>> significant = [gs for gs, res in results.items() if res.fdr < 0.25]
+    """
+    scores = np.asarray(scores, dtype=float)
+    if len(genes) != len(scores):
+        raise ValueError('genes and scores must have the same length')
+
+    order = np.argsort(-scores, kind='mergesort')
+    ranked_genes = [str(genes[i]) for i in order]
+    abs_scores = np.abs(scores[order]) ** weight
+    position = {gene: pos for pos, gene in enumerate(ranked_genes)}
+    n_genes = len(ranked_genes)
+
+    selected = []  # type: List[GeneSet]
+    hits = []  # type: List[np.ndarray]
+    for gene_set in sorted(gene_sets, key=GeneSet.sort_key):
+        gs_hits = np.array(sorted({position[g] for g in map(str, gene_set.genes) if g in position}), dtype=np.int64)
+        if min_size <= len(gs_hits) <= max_size and len(gs_hits) < n_genes:
+            selected.append(gene_set)
+            hits.append(gs_hits)
+
+    if not selected:
+        return {}
+
+    sizes = np.array([len(h) for h in hits])
+    starts = np.r_[0, np.cumsum(sizes)[:-1]]
+    positions = np.concatenate(hits)[None, :]
+    es = _segment_enrichment_scores(positions, abs_scores[positions], starts, sizes, n_genes)[0]
+
+    # the same genes in permuted positions give random gene sets of the same size
+    genes_flat = positions[0]
+    tasks = [
+        (seed_seq, min(PERMUTATIONS_PER_TASK, permutations - start))
+        for seed_seq, start in zip(
+            np.random.SeedSequence(seed).spawn(-(-permutations // PERMUTATIONS_PER_TASK)),
+            range(0, permutations, PERMUTATIONS_PER_TASK),
+        )
+    ]
+
+    null = np.empty((len(selected), permutations))
+    if n_jobs is None or n_jobs < 0:
+        n_jobs = os.cpu_count() or 1
+
+    def store(task_index, result):
+        start = task_index * PERMUTATIONS_PER_TASK
+        null[:, start : start + result.shape[1]] = result
+        if callback is not None:
+            callback(min(start + result.shape[1], permutations) / permutations)
+
+    if n_jobs == 1 or len(tasks) < 2:
+        for i, (seed_seq, n_perm) in enumerate(tasks):
+            store(i, _null_enrichment_scores(seed_seq, n_perm, genes_flat, starts, sizes, abs_scores))
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(tasks))) as executor:
+            futures = [
+                executor.submit(_null_enrichment_scores, seed_seq, n_perm, genes_flat, starts, sizes, abs_scores)
+                for seed_seq, n_perm in tasks
+            ]
+            for i, future in enumerate(futures):
+                store(i, future.result())
+
+    nes, null_nes, p_values = _normalize(es, null)
+    fdr = _fdr(nes, null_nes)
+
+    results = {}
+    for i, (gene_set, gs_hits) in enumerate(zip(selected, hits)):
+        leading_edge = _leading_edge(es[i], gs_hits, abs_scores[gs_hits], n_genes)
+        results[gene_set] = gsea_result(
+            float(es[i]),
+            float(nes[i]),
+            float(p_values[i]),
+            float(fdr[i]),
+            len(gs_hits),
+            {ranked_genes[pos] for pos in leading_edge},
+        )
+    return results
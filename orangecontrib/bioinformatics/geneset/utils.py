@@ -1,5 +1,7 @@
 """ GeneSets utility functions """
-from typing import List, Tuple, NamedTuple
+import os
+from typing import Set, List, Tuple, Iterable, NamedTuple, DefaultDict
+from collections import abc, defaultdict
 
 import numpy as np
 
@@ -45,6 +47,8 @@ def filename_parse(fn):  # type: (str) -> (Tuple[Tuple[str, str], str])
 
 
 GENE_SET_ATTRIBUTES = ('gs_id', 'hierarchy', 'organism', 'name', 'genes', 'description', 'link')
+# cached values derived from the attributes above and the GMT file a gene set was read from, see GeneSet.__setattr__
+GENE_SET_CACHE = ('_hash', '_sort_key', '_source')
 HYPERGEOMETRIC = Hypergeometric()
 
 # change this when python 3.4 is not supported anymore
@@ -54,11 +58,16 @@ enrichment_result = NamedTuple(
 
 
 class GeneSet:
-    __slots__ = GENE_SET_ATTRIBUTES
+    __slots__ = GENE_SET_ATTRIBUTES + GENE_SET_CACHE
 
     def __init__(self, gs_id=None, hierarchy=None, organism=None, name=None, genes=None, description=None, link=None):
         """Object representing a single set of genes
 
+        Gene sets are identified by ``(hierarchy, gs_id)``. Hash value and sort key are
+        computed once and reset when ``gs_id``, ``hierarchy`` or ``name`` change. Gene sets
+        read from a GMT file remember the file until ``gs_id``, ``hierarchy``, ``organism``
+        or ``genes`` are assigned.
+
         :param gs_id: Short gene set ID.
         :param hierarchy: Hierarchy should be formated as a tuple, for example ``("GO", "biological_process")``
         :param organism: Organism as a NCBI taxonomy ID.
@@ -76,18 +85,60 @@ class GeneSet:
         self.description = description
         self.link = link
 
+    def __setattr__(self, attr, value):
+        object.__setattr__(self, attr, value)
+
+        if attr == 'gs_id':
+            object.__setattr__(self, '_hash', None)
+            object.__setattr__(self, '_sort_key', None)
+        elif attr == 'hierarchy':
+            object.__setattr__(self, '_hash', None)
+        elif attr == 'name':
+            object.__setattr__(self, '_sort_key', None)
+
+        if attr in ('gs_id', 'hierarchy', 'organism', 'genes'):
+            object.__setattr__(self, '_source', None)
+
+    def __getstate__(self):
+        # hash values of strings are not stable across processes, so cached values are never pickled
+        return {
+            attr: getattr(self, attr)
+            for cls in type(self).__mro__
+            for attr in getattr(cls, '__slots__', ())
+            if attr not in GENE_SET_CACHE and hasattr(self, attr)
+        }
+
+    def __setstate__(self, state):
+        object.__setattr__(self, '_hash', None)
+        object.__setattr__(self, '_sort_key', None)
+        object.__setattr__(self, '_source', None)
+
+        for attr, value in state.items():
+            setattr(self, attr, value)
+
     def __hash__(self):
-        return self.gs_id.__hash__() + self.name.__hash__()
+        if self._hash is None:
+            object.__setattr__(self, '_hash', hash((self.hierarchy, self.gs_id)))
+        return self._hash
 
     def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            if self.__slots__ == other.__slots__:
-                return all(getattr(self, attr) == getattr(other, attr) for attr in self.__slots__)
+        if self is other:
+            return True
+
+        if other.__class__ is not self.__class__:
+            return NotImplemented
 
-        return False
+        return self.__hash__() == other.__hash__() and self.gs_id == other.gs_id and self.hierarchy == other.hierarchy
+
+    def sort_key(self):
+        # type: () -> str
+        """ Key used to order gene sets (by name, then by id). Use with ``sorted(gene_sets, key=GeneSet.sort_key)``. """
+        if self._sort_key is None:
+            object.__setattr__(self, '_sort_key', self.name + self.gs_id)
+        return self._sort_key
 
     def __lt__(self, other):
-        return (self.name + self.gs_id) < (other.name + other.gs_id)
+        return self.sort_key() < other.sort_key()
 
     def set_enrichment(self, reference, query):  # type: (List, List) -> enrichment_result
         """
@@ -97,19 +148,31 @@ class GeneSet:
         """
 
         assert len(reference) > 0
-        query_mapped = self.genes.intersection(query)
         reference_mapped = self.genes.intersection(reference)
+        query_mapped, p_value, enrichment = self.count_enrichment(len(reference), len(reference_mapped), query)
+        return enrichment_result(query_mapped, set(reference_mapped), p_value, enrichment)
+
+    def count_enrichment(self, reference_size, reference_count, query):
+        # type: (int, int, Set[str]) -> Tuple[Set[str], float, float]
+        """Like :obj:`set_enrichment`, but with a known number of reference genes in this gene set
+        (see :func:`orangecontrib.bioinformatics.geneset.reference_counts`), so the gene set is not
+        intersected with the reference.
+
+        :param reference_size: number of reference genes
+        :param reference_count: number of reference genes in this gene set
+        :param query: query genes
+        :return: query genes in this gene set, p-value and enrichment score
+        """
+
+        assert reference_size > 0
+        query_mapped = self.genes.intersection(query)
 
         query_p = len(query_mapped) / len(query) if query else np.nan
-        ref_p = len(reference_mapped) / len(reference) if reference else np.nan
+        ref_p = reference_count / reference_size
         enrichment = query_p / ref_p if ref_p else np.nan
 
-        return enrichment_result(
-            set(query_mapped),
-            set(reference_mapped),
-            HYPERGEOMETRIC.p_value(len(query_mapped), len(reference), len(reference_mapped), len(query)),
-            enrichment,
-        )
+        p_value = HYPERGEOMETRIC.p_value(len(query_mapped), reference_size, reference_count, len(query))
+        return set(query_mapped), p_value, enrichment
 
     def gmt_description(self):
         """Represent GeneSet as line in GMT file format
@@ -135,21 +198,102 @@ class GeneSet:
 
 
 class GeneSets(set):
-    """A collection of gene sets: contains :obj:`GeneSet` objects."""
+    """A collection of gene sets: contains :obj:`GeneSet` objects.
+
+    Gene sets are additionally indexed by their hierarchy. The index is kept up to date
+    by all methods and in-place operators that modify the collection.
+    """
 
     def __init__(self, sets=None):
         # type: (List[GeneSet]) -> None
         super().__init__()
+        self._hierarchy_index = defaultdict(set)  # type: DefaultDict[Tuple[str, ...], Set[GeneSet]]
 
         if sets:
             self.update(ensure_type(sets, list))
 
+    def add(self, g_set):
+        # type: (GeneSet) -> None
+        super().add(g_set)
+        self._hierarchy_index[g_set.hierarchy].add(g_set)
+
     def update(self, sets):
         # type: (List[GeneSet]) -> None
 
         for g_set in sets:
             self.add(ensure_type(g_set, GeneSet))
 
+    def remove(self, g_set):
+        # type: (GeneSet) -> None
+        super().remove(g_set)
+        self._unindex(g_set)
+
+    def discard(self, g_set):
+        # type: (GeneSet) -> None
+        if g_set in self:
+            self.remove(g_set)
+
+    def pop(self):
+        # type: () -> GeneSet
+        g_set = super().pop()
+        self._unindex(g_set)
+        return g_set
+
+    def clear(self):
+        super().clear()
+        self._hierarchy_index.clear()
+
+    def difference_update(self, *others):
+        super().difference_update(*others)
+        self._reindex()
+
+    def intersection_update(self, *others):
+        super().intersection_update(*others)
+        self._reindex()
+
+    def symmetric_difference_update(self, other):
+        super().symmetric_difference_update(other)
+        self._reindex()
+
+    def __ior__(self, other):
+        if not isinstance(other, abc.Set):
+            return NotImplemented
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        if super().__isub__(other) is NotImplemented:
+            return NotImplemented
+        self._reindex()
+        return self
+
+    def __iand__(self, other):
+        if super().__iand__(other) is NotImplemented:
+            return NotImplemented
+        self._reindex()
+        return self
+
+    def __ixor__(self, other):
+        if super().__ixor__(other) is NotImplemented:
+            return NotImplemented
+        self._reindex()
+        return self
+
+    def _reindex(self):
+        # type: () -> None
+        """ Rebuild the hierarchy index from gene sets in the collection. """
+        self._hierarchy_index = defaultdict(set)
+        for g_set in self:
+            self._hierarchy_index[g_set.hierarchy].add(g_set)
+
+    def _unindex(self, g_set):
+        # type: (GeneSet) -> None
+        sets = self._hierarchy_index.get(g_set.hierarchy)
+        if sets is not None:
+            sets.discard(g_set)
+            if not sets:
+                del self._hierarchy_index[g_set.hierarchy]
+
     def common_org(self):
         """ Return a common organism. """
         if len(self) == 0:
@@ -164,7 +308,7 @@ class GeneSets(set):
 
     def hierarchies(self):
         """ Return all hierarchies. """
-        return {g_set.hierarchy for g_set in self}
+        return set(self._hierarchy_index)
 
     def common_hierarchy(self):
         """ Return a common hierarchy. """
@@ -176,32 +320,28 @@ class GeneSets(set):
             for org in hierarchies:
                 return org
 
+    def select(self, hierarchies):
+        # type: (Iterable[Tuple[str, ...]]) -> GeneSets
+        """Return gene sets that belong to any of the given hierarchies.
+
+        :param hierarchies: selected hierarchies, for example ``[('GO', 'biological_process')]``
+        :rtype: :obj:`GeneSets`
+        """
+        selected = GeneSets()
+        for hier in set(hierarchies):
+            selected.update(self._hierarchy_index.get(hier, ()))
+        return selected
+
     def delete_sets_by_hierarchy(self, hier):
-        selected_sets = self.map_hierarchy_to_sets().get(hier, None)
-        if selected_sets:
-            for gene_set in selected_sets:
-                self.remove(gene_set)
+        for gene_set in list(self._hierarchy_index.get(hier, ())):
+            self.remove(gene_set)
 
     def map_hierarchy_to_sets(self):
-        try:
-            split_by_hier = {hier: GeneSets() for hier in self.hierarchies()}
-            for gs in self:
-                split_by_hier[gs.hierarchy].update([gs])
-            return split_by_hier
-
-        except GeneSetException:
-            return {}
+        return {hier: GeneSets(list(sets)) for hier, sets in self._hierarchy_index.items()}
 
     def split_by_hierarchy(self):
         """ Split gene sets by hierarchies. Return a list of :class:`GeneSets` objects. """
-
-        try:
-            split_by_hier = {hier: GeneSets() for hier in self.hierarchies()}
-            [split_by_hier[gs.hierarchy].update([gs]) for gs in self]
-            return list(split_by_hier.values())
-
-        except GeneSetException:
-            return []
+        return list(self.map_hierarchy_to_sets().values())
 
     def genes(self):
         """
@@ -224,7 +364,7 @@ class GeneSets(set):
         """
 
         with open(file_path, 'w') as gmt_file:
-            for gene_set in sorted(self):
+            for gene_set in sorted(self, key=GeneSet.sort_key):
                 genes = sorted(map(str, gene_set.genes), key=lambda x: int(x))
                 line = '\t'.join([gene_set.gs_id, gene_set.gmt_description()] + genes)
                 gmt_file.write(line + '\n')
@@ -237,6 +377,7 @@ class GeneSets(set):
         :rtype: :obj:`GeneSets`
         """
         index = {label: index for index, label in enumerate(GENE_SET_ATTRIBUTES)}
+        source = _gmt_source(file_path)
 
         with open(file_path, 'r', encoding='utf-8') as gmt_file:
             gene_sets = []
@@ -256,12 +397,18 @@ class GeneSets(set):
                     description=gs_info[index['description']],
                     link=gs_info[index['link']],
                 )
+                object.__setattr__(gene_set, '_source', source)
 
                 gene_sets.append(gene_set)
 
             return GeneSets(gene_sets)
 
 
+def _gmt_source(file_path):  # type: (str) -> Tuple[str, float]
+    """ Identify the current version of a GMT file by its absolute path and modification time. """
+    return os.path.abspath(file_path), os.path.getmtime(file_path)
+
+
 class NoGeneSetsException(Exception):
     """ Raised when provided taxonomy is not in orangecontrib.bio.ncbi.taxonomy.common_taxids """
 
@@ -715,15 +715,22 @@ class Annotations:
             else:
                 mapped_reference_genes = all_annotated_genes.intersection(reference)
 
-            res[term] = (
-                [gene for gene in mapped_genes],
-                prob.p_value(len(mapped_genes), len(reference), len(mapped_reference_genes), len(genes)),
-                len(mapped_reference_genes),
-            )
+            res[term] = ([gene for gene in mapped_genes], len(mapped_reference_genes))
 
             if progress_callback and i in milestones:
                 progress_callback(100.0 * i / len(terms))
 
+        p_values = prob.p_values(
+            [len(mapped_genes) for mapped_genes, _ in res.values()],
+            len(reference),
+            [ref_count for _, ref_count in res.values()],
+            len(genes),
+        )
+        res = {
+            term: (mapped_genes, float(p), ref_count)
+            for (term, (mapped_genes, ref_count)), p in zip(res.items(), p_values)
+        }
+
         if use_fdr:
             res = sorted(res.items(), key=lambda x: x[1][1])
             res = {
@@ -215,7 +215,15 @@ class Organism(object):
         for i, (p_id, entry) in enumerate(pItems):
             pathway = pathways_db.get_entry(p_id)
             entry[2].extend(reference.intersection(pathway.gene or []))
-            entry[1] = prob.p_value(len(entry[0]), len(reference), len(entry[2]), len(genes))
+
+        p_values = prob.p_values(
+            [len(entry[0]) for entry in allPathways.values()],
+            len(reference),
+            [len(entry[2]) for entry in allPathways.values()],
+            len(genes),
+        )
+        for entry, p_value in zip(allPathways.values(), p_values):
+            entry[1] = float(p_value)
         return dict([(pid, (genes, p, len(ref))) for pid, (genes, p, ref) in allPathways.items()])
 
     def get_genes_by_enzyme(self, enzyme):
@@ -0,0 +1,109 @@
+import unittest
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.stats import rankdata
+
+from Orange.data import Table, Domain, ContinuousVariable
+
+from orangecontrib.bioinformatics.geneset import GeneSet, GeneSets
+from orangecontrib.bioinformatics.widgets.utils.data import TableAnnotation
+from orangecontrib.bioinformatics.annotation.gene_set_scoring import (
+    SCORING_AUCELL,
+    SCORING_SSGSEA,
+    rank_rows,
+    score_gene_sets,
+)
+
+
+def naive_ssgsea(x, genes, alpha=0.25):
+    """ ssGSEA from the running sum over genes sorted by decreasing expression. """
+    order = np.argsort(-x, kind='mergesort')
+    ranks = len(x) + 1 - rankdata(-x)
+    hits = np.isin(order, genes)
+    weights = np.where(hits, ranks[order] ** alpha, 0)
+    running_sum = np.cumsum(weights) / weights.sum() - np.cumsum(~hits) / (~hits).sum()
+    return running_sum.sum()
+
+
+def naive_aucell(x, genes, max_rank):
+    ranks = rankdata(-x)
+    recovery = np.maximum(max_rank + 1 - ranks[genes], 0).sum()
+    top = min(len(genes), max_rank)
+    return recovery / (top * max_rank - top * (top - 1) / 2)
+
+
+class TestGeneSetScoring(unittest.TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        x = random_state.poisson(0.7, size=(30, 40)).astype(float)
+        x[:, :5] -= 1
+        self.x = x
+
+        genes = ['g{}'.format(i) for i in range(x.shape[1])]
+        domain = Domain([ContinuousVariable('var{}'.format(i)) for i in range(x.shape[1])])
+        for var, gene in zip(domain.attributes, genes):
+            var.attributes['Entrez ID'] = gene
+        self.data = Table(domain, x)
+        self.data.attributes[TableAnnotation.gene_id_attribute] = 'Entrez ID'
+
+        self.columns = [[0, 1, 2, 3], [5, 10, 15, 20, 25, 30], [7]]
+        self.gene_sets = [
+            GeneSet(gs_id=str(i), name='set {}'.format(i), hierarchy=('Test',), genes={genes[c] for c in columns})
+            for i, columns in enumerate(self.columns)
+        ]
+        self.gene_sets.append(GeneSet(gs_id='3', name='empty', hierarchy=('Test',), genes={'unknown'}))
+
+    def test_rank_rows(self):
+        dense, zero_rank = rank_rows(self.x)
+        self.assertIsNone(zero_rank)
+        np.testing.assert_equal(dense, np.array([rankdata(-row) for row in self.x]))
+
+        ranks, zero_rank = rank_rows(sp.csr_matrix(self.x))
+        ranks = ranks.toarray()
+        ranks[self.x == 0] = np.repeat(zero_rank, (self.x == 0).sum(axis=1))
+        np.testing.assert_equal(ranks, dense)
+
+    def test_ssgsea(self):
+        # without ties the running sum does not depend on the order of equal values
+        x = np.random.RandomState(1).normal(size=self.x.shape)
+        data = Table(self.data.domain, x)
+        data.attributes = self.data.attributes
+
+        scores = score_gene_sets(data, self.gene_sets, method=SCORING_SSGSEA)
+        self.assertEqual([var.name for var in scores.domain.attributes], ['set 0', 'set 1', 'set 2', 'empty'])
+        for i, columns in enumerate(self.columns):
+            expected = [naive_ssgsea(row, columns) for row in x]
+            np.testing.assert_almost_equal(scores.X[:, i], expected)
+        self.assertTrue(np.all(np.isnan(scores.X[:, 3])))
+
+    def test_aucell(self):
+        scores = score_gene_sets(self.data, self.gene_sets, method=SCORING_AUCELL, auc_max_rank=10)
+        for i, columns in enumerate(self.columns):
+            expected = [naive_aucell(row, columns, 10) for row in self.x]
+            np.testing.assert_almost_equal(scores.X[:, i], expected)
+        self.assertTrue(np.all(scores.X[:, :3] <= 1))
+
+    def test_sparse_chunks(self):
+        sparse_data = self.data.copy()
+        with sparse_data.unlocked():
+            sparse_data.X = sp.csr_matrix(sparse_data.X)
+
+        for method in (SCORING_AUCELL, SCORING_SSGSEA):
+            expected = score_gene_sets(self.data, self.gene_sets, method=method)
+            scores = score_gene_sets(sparse_data, self.gene_sets, method=method, chunk_size=7, n_jobs=2)
+            np.testing.assert_almost_equal(scores.X, expected.X)
+
+    def test_gene_names(self):
+        domain = Domain([ContinuousVariable('g{}'.format(i)) for i in range(self.x.shape[1])])
+        scores = score_gene_sets(Table(domain, self.x), GeneSets(self.gene_sets[:1]), method=SCORING_SSGSEA)
+        expected = score_gene_sets(self.data, self.gene_sets[:1], method=SCORING_SSGSEA)
+        np.testing.assert_almost_equal(scores.X, expected.X)
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            score_gene_sets(self.data, self.gene_sets, method='unknown')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.stats import rankdata, ttest_ind, mannwhitneyu
+
+from orangecontrib.bioinformatics.de.pseudobulk import log_cpm, aggregate_rows
+from orangecontrib.bioinformatics.cluster_analysis import Task, Cluster, ClusterModel, ClusterStatistics, score_cluster
+from orangecontrib.bioinformatics.utils.statistics import ALT_GREATER, score_t_test, score_mann_whitney
+from orangecontrib.bioinformatics.widgets.utils.gui.gene_scoring import GeneScoringWidget
+
+
+def naive_cluster_scores(x, rows_by_cluster, rows_by_batch, cluster, score_function, design):
+    """ Scores of genes against each other cluster (or the rest) in each batch; the one with max p-value is kept. """
+    others = [[c] for c in np.unique(rows_by_cluster) if c != cluster]
+    if design == Cluster.CLUSTER_VS_REST:
+        others = [sum(others, [])]
+
+    scores, p_values = [], []
+    for b in np.unique(rows_by_batch):
+        in_batch = rows_by_batch == b
+        for clusters in others:
+            s, p = score_function(
+                x[in_batch & (rows_by_cluster == cluster)],
+                x[in_batch & np.isin(rows_by_cluster, clusters)],
+                alternative=ALT_GREATER,
+            )
+            scores.append(np.where(np.isnan(p), 0, s))
+            p_values.append(np.where(np.isnan(p), 1, p))
+
+    scores, p_values = np.array(scores).T, np.array(p_values).T
+    index = np.argmax(p_values, axis=1)
+    return scores[np.arange(len(index)), index], p_values[np.arange(len(index)), index]
+
+
+class TestClusterScores(unittest.TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.x = random_state.poisson(1.5, size=(90, 12)).astype(float)
+        self.rows_by_cluster = random_state.randint(0, 3, size=90)
+        self.rows_by_batch = random_state.randint(0, 2, size=90)
+        self.x[self.rows_by_cluster == 1, :4] += 2
+
+    def test_cached_statistics(self):
+        binary = (self.x > 1).astype(float)
+
+        for method in GeneScoringWidget.scores:
+            x = binary if method.name == 'Hypergeometric Test' else self.x
+            statistics = ClusterStatistics(x, self.rows_by_cluster, self.rows_by_batch)
+            for design in (Cluster.CLUSTER_VS_REST, Cluster.CLUSTER_VS_CLUSTER):
+                cluster = Cluster('cluster 1', 1)
+                cluster.set_genes(['g{}'.format(i) for i in range(x.shape[1])], list(range(x.shape[1])))
+                cluster.cluster_scores(
+                    x,
+                    self.rows_by_cluster,
+                    method,
+                    design,
+                    rows_by_batch=self.rows_by_batch,
+                    statistics=statistics,
+                )
+
+                scores, p_values = naive_cluster_scores(
+                    x, self.rows_by_cluster, self.rows_by_batch, 1, method.score_function, design
+                )
+                np.testing.assert_almost_equal([gene.p_val for gene in cluster.genes], p_values)
+                np.testing.assert_almost_equal([gene.score for gene in cluster.genes], scores)
+
+    def test_sparse(self):
+        method = GeneScoringWidget.scores[1]
+        results = []
+        for x in (self.x, sp.csr_matrix(self.x)):
+            cluster = Cluster('cluster 1', 1)
+            cluster.set_genes(['g{}'.format(i) for i in range(x.shape[1])], list(range(x.shape[1])))
+            cluster.cluster_scores(x, self.rows_by_cluster, method, Cluster.CLUSTER_VS_REST)
+            results.append([gene.p_val for gene in cluster.genes])
+        np.testing.assert_almost_equal(results[0], results[1])
+
+    def test_process_pool(self):
+        method = GeneScoringWidget.scores[0]
+        kwargs = dict(
+            table_x=sp.csr_matrix(self.x),
+            rows_by_cluster=self.rows_by_cluster,
+            rows_by_batch=self.rows_by_batch,
+            method=method,
+            design=Cluster.CLUSTER_VS_CLUSTER,
+        )
+
+        results = []
+        for n_jobs, shared_memory in ((1, True), (2, True), (2, False)):
+            model = ClusterModel()
+            model.add_rows([Cluster('cluster {}'.format(i), i) for i in range(3)])
+            for cluster in model.get_rows():
+                cluster.set_genes(['g{}'.format(i) for i in range(self.x.shape[1])], list(range(self.x.shape[1])))
+
+            progress = []
+            # without shared memory (Python < 3.8) clusters are scored in a thread
+            with patch('orangecontrib.bioinformatics.cluster_analysis._has_shared_memory', return_value=shared_memory):
+                model._score_genes(lambda: progress.append(1), n_jobs=n_jobs, **kwargs)
+            self.assertEqual(len(progress), 3)
+            results.append([[gene.p_val for gene in cluster.genes] for cluster in model.get_rows()])
+            self.assertEqual({cluster.method_used for cluster in model.get_rows()}, {method.name})
+        np.testing.assert_almost_equal(results[0], results[1])
+        np.testing.assert_almost_equal(results[0], results[2])
+
+    def test_pseudobulk(self):
+        method = GeneScoringWidget.scores[0]
+        model = ClusterModel()
+        model.add_rows([Cluster('cluster {}'.format(i), i) for i in range(3)])
+        for cluster in model.get_rows():
+            cluster.set_genes(['g{}'.format(i) for i in range(self.x.shape[1])], list(range(self.x.shape[1])))
+        model._score_genes(
+            lambda: None,
+            table_x=sp.csr_matrix(self.x),
+            rows_by_cluster=self.rows_by_cluster,
+            rows_by_batch=self.rows_by_batch,
+            method=method,
+            design=Cluster.CLUSTER_VS_REST,
+            pseudobulk=True,
+        )
+
+        sums, rows_by_cluster, rows_by_batch, _ = aggregate_rows(self.x, self.rows_by_cluster, self.rows_by_batch)
+        np.testing.assert_equal(rows_by_cluster, np.repeat([0, 1, 2], 2))
+        np.testing.assert_equal(rows_by_batch, np.tile([0, 1], 3))
+        for cluster in model.get_rows():
+            _, p_values = naive_cluster_scores(
+                log_cpm(sums),
+                rows_by_cluster,
+                np.zeros(6),
+                cluster.index,
+                method.score_function,
+                Cluster.CLUSTER_VS_REST,
+            )
+            np.testing.assert_almost_equal([gene.p_val for gene in cluster.genes], p_values)
+
+    def test_process_pool_cancel(self):
+        model = ClusterModel()
+        model.add_rows([Cluster('cluster {}'.format(i), i) for i in range(3)])
+
+        def callback():
+            raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            model._score_genes(
+                callback,
+                n_jobs=2,
+                table_x=self.x,
+                rows_by_cluster=self.rows_by_cluster,
+                method=GeneScoringWidget.scores[0],
+                design=Cluster.CLUSTER_VS_REST,
+            )
+
+        # workers are stopped without waiting for results once the task is cancelled
+        model._task = Task()
+        model._task.cancelled = True
+        with self.assertRaises(KeyboardInterrupt):
+            model._score_genes(
+                lambda: None,
+                n_jobs=2,
+                table_x=self.x,
+                rows_by_cluster=self.rows_by_cluster,
+                method=GeneScoringWidget.scores[0],
+                design=Cluster.CLUSTER_VS_REST,
+            )
+
+    def test_stratified(self):
+        rows = self.rows_by_cluster == 1
+        for method in GeneScoringWidget.scores[:2]:
+            # a single batch gives the (normal approximation of the) test of all rows
+            scores, p_values, _ = score_cluster(
+                1,
+                self.x,
+                self.rows_by_cluster,
+                method.score_function,
+                Cluster.CLUSTER_VS_REST,
+                aggregation='stratified',
+            )
+            if method.score_function is score_t_test:
+                np.testing.assert_almost_equal(scores, ttest_ind(self.x[rows], self.x[~rows]).statistic)
+            else:
+                expected = mannwhitneyu(
+                    self.x[rows], self.x[~rows], alternative='greater', use_continuity=False, method='asymptotic'
+                )
+                np.testing.assert_almost_equal(p_values, expected.pvalue)
+
+            # scores within batches do not depend on batch effects
+            x = self.x + 10 * self.rows_by_batch[:, None]
+            for design in (Cluster.CLUSTER_VS_REST, Cluster.CLUSTER_VS_CLUSTER):
+                kwargs = dict(rows_by_batch=self.rows_by_batch, aggregation='stratified')
+                np.testing.assert_almost_equal(
+                    score_cluster(1, x, self.rows_by_cluster, method.score_function, design, **kwargs),
+                    score_cluster(1, self.x, self.rows_by_cluster, method.score_function, design, **kwargs),
+                )
+
+    def test_van_elteren(self):
+        statistics = ClusterStatistics(self.x, self.rows_by_cluster, self.rows_by_batch)
+        z, _ = statistics.stratified_score(score_mann_whitney, 1, [0], ALT_GREATER)
+
+        deviations, variances = 0, 0
+        for b in (0, 1):
+            a = self.x[(self.rows_by_batch == b) & (self.rows_by_cluster == 1)]
+            c = self.x[(self.rows_by_batch == b) & (self.rows_by_cluster == 0)]
+            n1, n = len(a), len(a) + len(c)
+            ranks = rankdata(np.vstack((a, c)), axis=0)
+            ties = np.array([sum(t ** 3 - t for t in np.unique(col, return_counts=True)[1]) for col in ranks.T])
+            deviations += (ranks[:n1].sum(axis=0) - n1 * (n + 1) / 2) / (n + 1)
+            variances += n1 * (n - n1) / 12 * ((n + 1) - ties / (n * (n - 1))) / (n + 1) ** 2
+        np.testing.assert_almost_equal(z, deviations / np.sqrt(variances))
+
+    def test_missing_cluster(self):
+        statistics = ClusterStatistics(self.x, self.rows_by_cluster)
+        self.assertIsNone(statistics.score(None, 5, [0, 1], 0.0, ALT_GREATER))
+
+
+if __name__ == '__main__':
+    unittest.main()
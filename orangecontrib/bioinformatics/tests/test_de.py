@@ -0,0 +1,213 @@
+import unittest
+
+import numpy as np
+import scipy.stats
+import scipy.sparse as sp
+
+from Orange.data import Table, Domain, DiscreteVariable, ContinuousVariable
+
+from orangecontrib.bioinformatics.de import METHODS, TWO_SAMPLE_TEST, log_cpm, pseudobulk, rank_genes
+from orangecontrib.bioinformatics.utils import statistics
+from orangecontrib.bioinformatics.de.scoring import (
+    STATISTICS_SCORES,
+    LabelStatistics,
+    f_oneway,
+    score_ttest_t,
+    score_kruskal_wallis_h,
+)
+from orangecontrib.bioinformatics.utils.statistics import GroupStatistics
+
+
+class TestFOneWay(unittest.TestCase):
+    def test_f_oneway(self):
+        g1 = np.array([0.1, -0.1, 0.2, -0.2])
+        g2 = g1 + 1
+        g3 = g1
+
+        f1, p1 = scipy.stats.f_oneway(g1, g2)
+        f, p = f_oneway(g1, g2)
+        np.testing.assert_almost_equal([f, p], [f1, p1])
+
+        f, p = f_oneway(np.c_[g1], np.c_[g2], axis=0)
+        np.testing.assert_almost_equal([f[0], p[0]], [f1, p1])
+
+        f1, p1 = scipy.stats.f_oneway(g1, g2, g3)
+        f, p = f_oneway(g1, g2, g3)
+        np.testing.assert_almost_equal([f, p], [f1, p1])
+
+        g1 = np.random.normal(size=(10, 30))
+        g2 = np.random.normal(loc=1, size=(10, 20))
+        g3 = np.random.normal(loc=2, size=(10, 10))
+
+        f, p = f_oneway(g1, g2, g3, axis=1)
+        self.assertEqual(f.shape, (10,))
+        self.assertEqual(p.shape, (10,))
+
+        fp1 = [scipy.stats.f_oneway(g1, g2, g3) for g1, g2, g3 in zip(g1, g2, g3)]
+
+        f1 = [f for f, _ in fp1]
+        p1 = [p for _, p in fp1]
+        np.testing.assert_almost_equal(f1, f)
+        np.testing.assert_almost_equal(p1, p)
+
+        f, p = f_oneway(g1.T, g2.T, g3.T, axis=0)
+        np.testing.assert_almost_equal(f1, f)
+        np.testing.assert_almost_equal(p1, p)
+
+
+class TestStatisticsScores(unittest.TestCase):
+    def test_statistics_scores(self):
+        """ Scores from group statistics (used for permutations) equal scores of data. """
+        random_state = np.random.RandomState(0)
+        arrays = [random_state.poisson(lam, size=(n, 20)).astype(float) for lam, n in [(2, 10), (3, 12), (2, 8)]]
+        groups = [GroupStatistics.from_data(a) for a in arrays]
+
+        for score, statistic in STATISTICS_SCORES.items():
+            n_groups = 3 if score.__name__.startswith('score_anova') else 2
+            expected = score(*arrays[:n_groups], axis=0)
+            expected = expected[0] if isinstance(expected, tuple) else expected
+            np.testing.assert_allclose(statistic(*groups[:n_groups]), expected, err_msg=score.__name__)
+
+
+class TestLabelStatistics(unittest.TestCase):
+    def test_label_statistics(self):
+        """ Scores from statistics of label values equal scores of data of groups. """
+        random_state = np.random.RandomState(0)
+        x = random_state.poisson(2, size=(40, 15)).astype(float)
+        # value 3 marks samples without a label value
+        labels = random_state.randint(0, 4, size=40)
+        statistics = LabelStatistics(x, labels, 3)
+
+        for name, method in METHODS.items():
+            if method.test_type == TWO_SAMPLE_TEST:
+                groups = [[0, 2], [1, 3]]
+            else:
+                groups = [[0], [1], [2, 3]]
+            arrays = [x[np.isin(labels, values)] for values in groups]
+            for score_func in filter(None, (method.score, method.p_value)):
+                scores = statistics.score(score_func, groups, threshold=2)
+                expected = score_func(*arrays, axis=0, treshold=2)
+                if isinstance(expected, tuple):
+                    expected = expected[0]
+                self.assertIsNotNone(scores, score_func.__name__)
+                np.testing.assert_allclose(scores[0], expected, err_msg=score_func.__name__)
+
+    def test_rank_sums_of_all_samples(self):
+        x = np.random.RandomState(0).poisson(2, size=(12, 5)).astype(float)
+        statistics = LabelStatistics(x, np.repeat([0, 1, 2, 3], 3), 3)
+        # samples without a label value are ranked too, so their groups must be scored from data
+        self.assertIsNone(statistics.score(score_kruskal_wallis_h, [[0], [1], [2]]))
+        self.assertIsNotNone(statistics.score(score_kruskal_wallis_h, [[0], [1], [2, 3]]))
+
+    def test_unknown_values(self):
+        x = np.random.RandomState(0).normal(size=(10, 4))
+        x[0, 0] = np.nan
+        statistics = LabelStatistics(x, np.repeat([0, 1], 5), 2)
+        self.assertIsNone(statistics.score(score_ttest_t, [[0], [1, 2]]))
+
+
+class TestRankGenes(unittest.TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.x = random_state.poisson(2, size=(30, 12)).astype(float)
+        self.y = np.repeat([0, 1, 2], 10)
+        self.x[self.y == 1, :3] += 3
+        domain = Domain(
+            [ContinuousVariable('g{}'.format(i)) for i in range(12)], DiscreteVariable('cell', values=('a', 'b', 'c'))
+        )
+        for i, var in enumerate(domain.attributes):
+            var.attributes['Entrez ID'] = str(i)
+        self.data = Table.from_numpy(domain, self.x, self.y)
+        self.data.attributes = {'gene_id_attribute': 'Entrez ID', 'taxonomy_id': '9606'}
+
+    def test_genes_in_columns(self):
+        result = rank_genes(self.data, 'cell', method='T-test', target='b')
+        t, p = scipy.stats.ttest_ind(self.x[self.y == 1], self.x[self.y != 1])
+        np.testing.assert_allclose(result.get_column_view('Score')[0], t)
+        np.testing.assert_allclose(result.get_column_view('P-value')[0], p)
+        np.testing.assert_allclose(result.get_column_view('FDR')[0], statistics.FDR(p))
+        self.assertEqual(list(result.get_column_view('Gene')[0]), [var.name for var in self.data.domain.attributes])
+        self.assertEqual(list(result.get_column_view('Entrez ID')[0]), [str(i) for i in range(12)])
+        self.assertEqual(result.attributes['gene_id_column'], 'Entrez ID')
+
+    def test_genes_in_rows(self):
+        domain = Domain([ContinuousVariable('s{}'.format(i)) for i in range(30)])
+        for var, label in zip(domain.attributes, self.y):
+            var.attributes['cell'] = 'abc'[label]
+        table = Table.from_numpy(domain, sp.csr_matrix(self.x.T))
+
+        result = rank_genes(table, 'cell', method='Kruskal-Wallis')
+        expected = [scipy.stats.kruskal(*[self.x[self.y == i, j] for i in range(3)]) for j in range(12)]
+        np.testing.assert_allclose(result.get_column_view('Score')[0], [h for h, _ in expected])
+        np.testing.assert_allclose(result.get_column_view('P-value')[0], [p for _, p in expected])
+
+    def test_permutations(self):
+        result = rank_genes(self.data, 'cell', method='T-test', target='b', permutations=200)
+        empirical = result.get_column_view('Permutation p-value')[0]
+        adjusted = result.get_column_view('FWER (max-T)')[0]
+        self.assertTrue(np.all(empirical[:3] < 0.01))
+        self.assertTrue(np.all(adjusted >= empirical))
+
+        results = [
+            rank_genes(self.data, 'cell', method='Mann-Whitney', permutations=150, n_jobs=n_jobs) for n_jobs in (1, 2)
+        ]
+        np.testing.assert_equal(results[0].X, results[1].X)
+
+        result = rank_genes(self.data, 'cell', method='Fold Change', permutations=50)
+        self.assertTrue(np.all(np.isnan(result.get_column_view('P-value')[0])))
+        self.assertFalse(np.any(np.isnan(result.get_column_view('Permutation p-value')[0])))
+
+    def test_arguments(self):
+        with self.assertRaises(ValueError):
+            rank_genes(self.data, 'cell', method='unknown')
+        with self.assertRaises(ValueError):
+            rank_genes(self.data, 'cell', target='d')
+        with self.assertRaises(ValueError):
+            rank_genes(self.data, 'tissue')
+
+
+class TestPseudobulk(unittest.TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.x = random_state.poisson(2, size=(60, 8)).astype(float)
+        self.cells = random_state.randint(0, 2, size=60).astype(float)
+        self.donors = random_state.randint(0, 3, size=60).astype(float)
+        self.cells[[0, 1]] = np.nan
+        self.x[self.cells == 1, :2] += 4
+        domain = Domain(
+            [ContinuousVariable('g{}'.format(i)) for i in range(8)],
+            DiscreteVariable('cell', values=('a', 'b')),
+            metas=[DiscreteVariable('donor', values=('d1', 'd2', 'd3'))],
+        )
+        self.data = Table.from_numpy(domain, self.x, self.cells, self.donors[:, None])
+
+    def test_pseudobulk(self):
+        for x in (self.x, sp.csr_matrix(self.x)):
+            data = Table.from_numpy(self.data.domain, x, self.data.Y, self.data.metas)
+            bulk = pseudobulk(data, 'cell', 'donor')
+            self.assertEqual(len(bulk), 6)
+            self.assertIs(bulk.domain.class_var, self.data.domain.class_var)
+            for row, cell, donor, count in zip(bulk.X, bulk.Y, bulk.metas[:, 0], bulk.metas[:, 1]):
+                rows = (self.cells == cell) & (self.donors == donor)
+                np.testing.assert_almost_equal(row, self.x[rows].sum(axis=0))
+                self.assertEqual(count, rows.sum())
+
+        normalized = pseudobulk(self.data, 'cell', 'donor', normalize=True)
+        np.testing.assert_almost_equal(normalized.X, log_cpm(pseudobulk(self.data, 'cell', 'donor').X))
+        np.testing.assert_almost_equal((2 ** normalized.X - 1).sum(axis=1), 1e6)
+
+        with self.assertRaises(ValueError):
+            pseudobulk(self.data, 'cell', 'cell')
+        with self.assertRaises(ValueError):
+            pseudobulk(self.data, 'cell', 'g0')
+
+    def test_rank_genes(self):
+        result = rank_genes(self.data, 'cell', target='b', replicates='donor')
+        bulk = pseudobulk(self.data, 'cell', 'donor', normalize=True)
+        t, _ = scipy.stats.ttest_ind(bulk.X[bulk.Y == 1], bulk.X[bulk.Y == 0])
+        np.testing.assert_allclose(result.get_column_view('Score')[0], t)
+        self.assertTrue(np.all(result.get_column_view('Score')[0][:2] > 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,18 @@
 import os
+import pickle
 import unittest
-from tempfile import mkstemp
+from tempfile import TemporaryDirectory, mkstemp
+from unittest.mock import patch
 
-from orangecontrib.bioinformatics.geneset import GeneSet, GeneSets, GeneSetException, filename, filename_parse
+from orangecontrib.bioinformatics import geneset
+from orangecontrib.bioinformatics.geneset import (
+    GeneSet,
+    GeneSets,
+    GeneSetException,
+    filename,
+    filename_parse,
+    reference_counts,
+)
 
 
 class TestGeneSets(unittest.TestCase):
@@ -72,6 +82,34 @@ class TestGeneSets(unittest.TestCase):
         self.assertNotEqual(gs1, gs2)
         self.assertTrue(gs1 == gs1)
 
+    def test_gene_set_identity(self):
+        gs1 = GeneSet(gs_id='test1', name='b', hierarchy=self.test_hierarchy, genes={'1', '2'})
+        gs2 = GeneSet(gs_id='test1', name='b', hierarchy=self.test_hierarchy, genes={'3'})
+        gs3 = GeneSet(gs_id='test1', name='a', hierarchy=('Test', 'test'))
+
+        # identity is (hierarchy, gs_id)
+        self.assertEqual(gs1, gs2)
+        self.assertEqual(hash(gs1), hash(gs2))
+        self.assertNotEqual(gs1, gs3)
+        self.assertEqual(len(GeneSets([gs1, gs2, gs3])), 2)
+        self.assertEqual(sorted([gs1, gs3]), [gs3, gs1])
+
+        # comparison with other types is left to the other operand
+        self.assertIs(gs1.__eq__('test1'), NotImplemented)
+        self.assertNotEqual(gs1, 'test1')
+
+        # cached values follow attribute changes
+        gs3.hierarchy = self.test_hierarchy
+        self.assertEqual(gs1, gs3)
+        self.assertEqual(hash(gs1), hash(gs3))
+        gs3.name = 'c'
+        self.assertEqual(sorted([gs1, gs3], key=GeneSet.sort_key), [gs1, gs3])
+
+        restored = pickle.loads(pickle.dumps(gs1))
+        self.assertEqual(restored, gs1)
+        self.assertEqual(restored.genes, gs1.genes)
+        self.assertEqual(hash(restored), hash(gs1))
+
     def test_gene_sets(self):
         gs1 = GeneSet(
             gs_id=self.test_gs_id,
@@ -96,6 +134,115 @@ class TestGeneSets(unittest.TestCase):
         split_by_hierarchy = sets.split_by_hierarchy()
         self.assertLess(len(split_by_hierarchy), len(sets))
 
+    def test_hierarchy_index(self):
+        gs1 = GeneSet(gs_id='test1', name='test_name1', hierarchy=self.test_hierarchy, organism='3702')
+        gs2 = GeneSet(gs_id='test2', name='test_name2', hierarchy=('Test', 'test'), organism='3702')
+        gs3 = GeneSet(gs_id='test3', name='test_name3', hierarchy=('Test', 'test'), organism='3702')
+
+        sets = GeneSets([gs1, gs2])
+        sets.add(gs3)
+        self.assertEqual(sets.hierarchies(), {self.test_hierarchy, ('Test', 'test')})
+        self.assertEqual(sets.select([('Test', 'test')]), {gs2, gs3})
+        self.assertEqual(sets.select([self.test_hierarchy, ('Foo',)]), {gs1})
+        self.assertEqual(len(sets.map_hierarchy_to_sets()[('Test', 'test')]), 2)
+
+        sets.remove(gs1)
+        self.assertEqual(sets.hierarchies(), {('Test', 'test')})
+        self.assertEqual(len(sets.select([self.test_hierarchy])), 0)
+
+        sets.delete_sets_by_hierarchy(('Test', 'test'))
+        self.assertEqual(len(sets), 0)
+        self.assertEqual(sets.hierarchies(), set())
+
+    def test_hierarchy_index_in_place_operators(self):
+        gs1 = GeneSet(gs_id='test1', hierarchy=self.test_hierarchy)
+        gs2 = GeneSet(gs_id='test2', hierarchy=('Test', 'test'))
+        gs3 = GeneSet(gs_id='test3', hierarchy=('Test', 'test'))
+        gs4 = GeneSet(gs_id='test4', hierarchy=('Other',))
+
+        sets = GeneSets([gs1])
+        sets |= {gs2, gs3}
+        self.assertEqual(sets.select([('Test', 'test')]), {gs2, gs3})
+
+        sets -= {gs2}
+        self.assertEqual(sets.select([('Test', 'test')]), {gs3})
+
+        sets &= {gs1, gs3, gs4}
+        self.assertEqual(sets.select([self.test_hierarchy, ('Test', 'test')]), {gs1, gs3})
+
+        sets ^= {gs3, gs4}
+        self.assertEqual(sets.hierarchies(), {self.test_hierarchy, ('Other',)})
+        self.assertEqual(sets.select([('Test', 'test')]), set())
+
+        sets.difference_update([gs1])
+        self.assertEqual(sets.select([self.test_hierarchy]), set())
+
+        sets.symmetric_difference_update([gs1, gs2])
+        self.assertEqual(sets.select([self.test_hierarchy, ('Test', 'test')]), {gs1, gs2})
+
+        sets.intersection_update([gs2, gs4])
+        self.assertEqual(sets.hierarchies(), {('Test', 'test'), ('Other',)})
+        self.assertEqual([len(s) for s in sets.split_by_hierarchy()], [1, 1])
+
+        sets.delete_sets_by_hierarchy(('Other',))
+        self.assertEqual(sets, {gs2})
+        self.assertIsInstance(sets, GeneSets)
+
+    def test_reference_counts(self):
+        gs1 = GeneSet(
+            gs_id='gs1', name='gs1', hierarchy=self.test_hierarchy, organism=self.test_organism, genes={'1', '2', '3'}
+        )
+        gs2 = GeneSet(
+            gs_id='gs2', name='gs2', hierarchy=self.test_hierarchy, organism=self.test_organism, genes={'3', '4'}
+        )
+        custom = GeneSet(gs_id='custom', hierarchy=('Custom',), genes={'1', '5'})
+        reference = ['1', '2', '3', '5']
+
+        with TemporaryDirectory() as tmp_dir:
+
+            def localpath(*path):
+                return os.path.join(tmp_dir, *path)
+
+            def cache_files():
+                return [f for f in os.listdir(localpath(geneset.DOMAIN)) if f.endswith('.counts.json')]
+
+            os.makedirs(localpath(geneset.DOMAIN))
+            gmt_path = localpath(geneset.DOMAIN, self.test_file)
+            GeneSets([gs1, gs2]).to_gmt_file_format(gmt_path)
+            server_sets = GeneSets.from_gmt_file_format(gmt_path)
+            server_gs1 = [gs for gs in server_sets if gs.gs_id == 'gs1'][0]
+
+            with patch.object(geneset.serverfiles, 'localpath', localpath):
+                counts = reference_counts(GeneSets(list(server_sets) + [custom]), reference)
+                self.assertEqual(counts, {gs1: 3, gs2: 1, custom: 2})
+                self.assertEqual(len(cache_files()), 1)
+
+                # cached counts are reused for the same reference regardless of gene order ...
+                with patch.object(geneset, '_store_counts') as store_counts:
+                    counts = reference_counts(server_sets, reversed(reference))
+                    self.assertEqual(counts, {gs1: 3, gs2: 1})
+                    store_counts.assert_not_called()
+
+                # ... but not for gene sets that were not read from the server file or were changed since
+                gs1.genes = {'1'}
+                self.assertEqual(reference_counts(GeneSets([gs1, gs2]), reference), {gs1: 1, gs2: 1})
+                server_gs1.genes.discard('1')
+                self.assertEqual(reference_counts(server_sets, reference), {gs1: 2, gs2: 1})
+                server_gs1.genes = {'1'}
+                self.assertEqual(reference_counts(server_sets, reference), {gs1: 1, gs2: 1})
+                counts = reference_counts(GeneSets.from_gmt_file_format(gmt_path), reference)
+                self.assertEqual(counts, {gs1: 3, gs2: 1})
+
+                # only counts for the last reference are kept
+                counts = reference_counts(GeneSets.from_gmt_file_format(gmt_path), reference[:2])
+                self.assertEqual(counts, {gs1: 2, gs2: 0})
+                self.assertEqual(len(cache_files()), 1)
+
+        query, p_value, enrichment = gs2.count_enrichment(len(reference), 1, ['3'])
+        result = gs2.set_enrichment(reference, ['3'])
+        self.assertEqual(result.reference, {'3'})
+        self.assertEqual((query, p_value, enrichment), (result.query, result.p_value, result.enrichment_score))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+
+import numpy as np
+
+from orangecontrib.bioinformatics.geneset import GeneSet, GeneSets
+from orangecontrib.bioinformatics.geneset.gsea import gsea_preranked
+
+
+def running_sum_es(hits, weights):
+    """ Enrichment score computed directly from the running sum. """
+    hit_weights = np.where(hits, weights, 0)
+    running_sum = np.cumsum(hit_weights) / hit_weights.sum() - np.cumsum(~hits) / (~hits).sum()
+    return running_sum[np.argmax(np.abs(running_sum))]
+
+
+class TestGSEA(unittest.TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(42)
+        self.genes = [str(i) for i in range(500)]
+        self.scores = random_state.normal(size=len(self.genes))
+        order = np.argsort(-self.scores)
+
+        self.gene_sets = GeneSets(
+            [
+                GeneSet(
+                    gs_id=str(i),
+                    name='set {}'.format(i),
+                    hierarchy=('Test',),
+                    genes=set(random_state.choice(self.genes, 30, replace=False)),
+                )
+                for i in range(20)
+            ]
+        )
+        self.top = GeneSet(gs_id='top', name='top', hierarchy=('Test',), genes={self.genes[i] for i in order[:20]})
+        self.bottom = GeneSet(
+            gs_id='bottom', name='bottom', hierarchy=('Test',), genes={self.genes[i] for i in order[-20:]}
+        )
+        self.gene_sets.update([self.top, self.bottom])
+
+    def test_enrichment_scores(self):
+        results = gsea_preranked(self.gene_sets, self.genes, self.scores, permutations=100)
+        self.assertEqual(len(results), len(self.gene_sets))
+
+        order = np.argsort(-self.scores)
+        weights = np.abs(self.scores[order])
+        for gene_set, result in results.items():
+            hits = np.array([self.genes[i] in gene_set.genes for i in order])
+            self.assertAlmostEqual(result.es, running_sum_es(hits, weights))
+            self.assertTrue(result.leading_edge <= gene_set.genes)
+
+        self.assertGreater(results[self.top].nes, 0)
+        self.assertLess(results[self.bottom].nes, 0)
+        self.assertEqual(results[self.top].leading_edge, self.top.genes)
+        self.assertLess(results[self.top].fdr, 0.05)
+        self.assertLess(results[self.bottom].fdr, 0.05)
+
+    def test_size_filter(self):
+        results = gsea_preranked(self.gene_sets, self.genes, self.scores, permutations=10, min_size=25)
+        self.assertNotIn(self.top, results)
+        self.assertEqual(len(results), len(self.gene_sets) - 2)
+
+    def test_reproducible(self):
+        kwargs = dict(permutations=120, seed=1)
+        single = gsea_preranked(self.gene_sets, self.genes, self.scores, n_jobs=1, **kwargs)
+        parallel = gsea_preranked(self.gene_sets, self.genes, self.scores, n_jobs=2, **kwargs)
+
+        for gene_set, result in single.items():
+            self.assertEqual(result, parallel[gene_set])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from orangecontrib.bioinformatics.utils import statistics
+from orangecontrib.bioinformatics.utils.permutation import (
+    PermutationPValues,
+    one_hot_design,
+    permuted_labels,
+    permutation_scores,
+    permutation_score_blocks,
+)
+
+
+def t_statistic(a, b):
+    return statistics.t_test_from_statistics(a, b)[0]
+
+
+def t_score(a, b):
+    return statistics.score_t_test(a, b)[0]
+
+
+class TestPermutation(unittest.TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.x = random_state.poisson(2, (40, 15)).astype(float)
+        self.indices = [np.arange(0, 30, 2), np.arange(1, 30, 2), np.arange(30, 38)]
+
+    def test_permuted_labels(self):
+        labels = np.repeat([0, 1, 2], [3, 4, 5])
+        permuted = permuted_labels(labels, 10, np.random.RandomState(0))
+        self.assertEqual(permuted.shape, (10, 12))
+        np.testing.assert_equal(np.sort(permuted, axis=1), np.tile(labels, (10, 1)))
+
+        design = one_hot_design(permuted, 3).toarray()
+        np.testing.assert_equal(design.reshape(10, 3, 12).argmax(axis=1), permuted)
+        np.testing.assert_equal(design.sum(axis=1), np.tile([3, 4, 5], 10))
+
+    def test_statistics_match_scores(self):
+        """ Scores from group statistics of a block equal scores of permuted data. """
+        blocks = permutation_score_blocks(
+            self.x, self.indices[:2], 25, statistic=t_statistic, random_state=np.random.RandomState(1), block_size=10
+        )
+        expected = permutation_score_blocks(
+            self.x, self.indices[:2], 25, score=t_score, random_state=np.random.RandomState(1), block_size=10
+        )
+        blocks, expected = list(blocks), list(expected)
+        self.assertEqual([len(b) for b in blocks], [10, 10, 5])
+        np.testing.assert_allclose(np.vstack(blocks), np.vstack(expected))
+
+    def test_sparse_and_unknown(self):
+        def f_statistic(*groups):
+            return statistics.f_oneway_from_statistics(groups)[0]
+
+        self.x[3, 4] = np.nan
+        null = [
+            np.vstack(list(permutation_score_blocks(x, self.indices, 20, statistic=f_statistic, block_size=7)))
+            for x in (self.x, csr_matrix(self.x))
+        ]
+        np.testing.assert_allclose(null[0], null[1])
+        self.assertEqual(null[0].shape, (20, 15))
+        self.assertTrue(np.all(np.isfinite(null[0])))
+
+    def test_reproducible(self):
+        """ Scores do not depend on the number of workers. """
+        results = []
+        for n_jobs in (1, 2):
+            null = np.empty((250, self.x.shape[1]))
+            tasks = permutation_scores(self.x, self.indices[:2], 250, score=t_score, seed=3, n_jobs=n_jobs)
+            for start, scores in tasks:
+                null[start : start + len(scores)] = scores
+            results.append(null)
+        np.testing.assert_equal(results[0], results[1])
+
+        statistic_null = np.vstack(
+            [scores for _, scores in permutation_scores(self.x, self.indices[:2], 250, statistic=t_statistic, seed=3)]
+        )
+        np.testing.assert_allclose(statistic_null, results[0])
+
+    def test_p_values(self):
+        observed = np.array([3.0, -2.5, 0.1, np.nan, 1.5, -4.0])
+        null = np.random.RandomState(1).normal(size=(300, len(observed)))
+
+        for alternative, extremeness in (
+            (statistics.ALT_TWO, np.abs),
+            (statistics.ALT_GREATER, lambda s: s),
+            (statistics.ALT_LESS, np.negative),
+        ):
+            p_values = PermutationPValues(observed, alternative)
+            for start in range(0, len(null), 70):
+                p_values.update(null[start : start + 70])
+
+            valid = ~np.isnan(observed)
+            obs, nulls = extremeness(observed[valid]), extremeness(null[:, valid])
+            expected = ((nulls >= obs).sum(axis=0) + 1) / (len(null) + 1)
+            np.testing.assert_allclose(p_values.p_values[valid], expected)
+
+            # step-down max-T: maximum over features not more extreme, then monotone in extremeness
+            order = np.argsort(-obs)
+            adjusted = np.empty(len(obs))
+            for i, feature in enumerate(order):
+                successive_max = nulls[:, order[i:]].max(axis=1)
+                adjusted[feature] = ((successive_max >= obs[feature]).sum() + 1) / (len(null) + 1)
+            adjusted[order] = np.maximum.accumulate(adjusted[order])
+            np.testing.assert_allclose(p_values.adjusted_p_values[valid], adjusted)
+            self.assertTrue(np.isnan(p_values.p_values[3]) and np.isnan(p_values.adjusted_p_values[3]))
+
+    def test_arguments(self):
+        with self.assertRaises(ValueError):
+            next(permutation_score_blocks(self.x, self.indices, 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
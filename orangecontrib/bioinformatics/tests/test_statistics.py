@@ -1,7 +1,13 @@
+import os
+import math
+import tempfile
 import unittest
 
 import numpy as np
+from scipy.stats import kruskal, ttest_ind, mannwhitneyu
 from scipy.stats import multivariate_normal as mvn
+from scipy.sparse import csr_matrix
+from scipy.special import comb
 
 from orangecontrib.bioinformatics.utils import statistics
 
@@ -33,6 +39,14 @@ class TestStatistics(unittest.TestCase):
         )
         self.assertIsNotNone(scores)
 
+        for alt in statistics.ALTERNATIVES:
+            scores, pvalues = statistics.score_hypergeometric_test(x[cluster], x[~cluster], alternative=alt)
+            sparse_scores, sparse_pvalues = statistics.score_hypergeometric_test(
+                csr_matrix(x[cluster]), csr_matrix(x[~cluster]), alternative=alt
+            )
+            np.testing.assert_almost_equal(sparse_pvalues, pvalues)
+            np.testing.assert_almost_equal(sparse_scores, scores)
+
     def test_alternatives(self):
         """ Test implemented alternative hypotheses. """
         np.random.seed(42)
@@ -90,6 +104,197 @@ class TestStatistics(unittest.TestCase):
                 assert np.isnan(p).sum() == 0
                 assert np.isnan(r).sum() == 0
 
+    def test_mann_whitney(self):
+        """ Compare vectorized Mann-Whitney U test with SciPy, for dense and sparse data. """
+        random_state = np.random.RandomState(0)
+        for n1, n2 in ((4, 7), (20, 30)):
+            # continuous values use exact p-values in small groups, counts have ties
+            for a, b in (
+                (random_state.normal(size=(n1, 20)), random_state.normal(0.5, size=(n2, 20))),
+                (random_state.poisson(0.5, (n1, 20)).astype(float), random_state.poisson(1, (n2, 20)).astype(float)),
+            ):
+                for alt in statistics.ALTERNATIVES:
+                    expected = [mannwhitneyu(a[:, i], b[:, i], alternative=alt) for i in range(a.shape[1])]
+                    for a_, b_ in ((a, b), (csr_matrix(a), csr_matrix(b))):
+                        u, p = statistics.score_mann_whitney(a_, b_, alternative=alt)
+                        np.testing.assert_allclose(u, [e[0] for e in expected])
+                        np.testing.assert_allclose(p, [e[1] for e in expected])
+
+        u, p = statistics.score_mann_whitney(a.T, b.T, axis=1)
+        np.testing.assert_allclose(p, [mannwhitneyu(a[:, i], b[:, i])[1] for i in range(a.shape[1])])
+
+    def test_kruskal_wallis(self):
+        """ Compare vectorized Kruskal-Wallis H test with SciPy, for dense and sparse data. """
+        random_state = np.random.RandomState(0)
+        arrays = [random_state.poisson(lam, (n, 20)).astype(float) for lam, n in ((0.5, 6), (1, 9), (1.5, 12))]
+        expected = np.array([kruskal(*[a[:, i] for a in arrays]) for i in range(20)])
+
+        for arrays_ in (arrays, [csr_matrix(a) for a in arrays]):
+            h, p = statistics.score_kruskal_wallis(*arrays_)
+            np.testing.assert_allclose(h, expected[:, 0])
+            np.testing.assert_allclose(p, expected[:, 1])
+
+        h, p = statistics.score_kruskal_wallis(*[csr_matrix(a.T) for a in arrays], axis=1)
+        np.testing.assert_allclose(p, expected[:, 1])
+
+    def test_sparse_scores(self):
+        """ Sparse matrices must give the same scores as dense arrays. """
+        random_state = np.random.RandomState(0)
+        a = random_state.poisson(1, (40, 30)).astype(float)
+        b = random_state.poisson(1.3, (60, 30)).astype(float)
+
+        for alt in statistics.ALTERNATIVES:
+            np.testing.assert_allclose(
+                statistics.score_t_test(csr_matrix(a), csr_matrix(b), alternative=alt),
+                statistics.score_t_test(a, b, alternative=alt),
+            )
+        np.testing.assert_allclose(
+            statistics.score_t_test(csr_matrix(a.T), csr_matrix(b.T), axis=1), statistics.score_t_test(a, b)
+        )
+        np.testing.assert_allclose(
+            statistics.score_fold_change(csr_matrix(a), csr_matrix(b)), statistics.score_fold_change(a, b)
+        )
+
+        for a_, b_ in ((a.T, b.T), (csr_matrix(a.T), csr_matrix(b.T))):
+            fold_change, t, p = statistics.score_fold_change_t_test(a_, b_, axis=1)
+            np.testing.assert_allclose(fold_change, statistics.score_fold_change(a, b, log=True))
+            np.testing.assert_allclose([t, p], ttest_ind(a, b))
+
+        a[3, 4] = np.nan
+        fold_change, t, p = statistics.score_fold_change_t_test(a, b)
+        np.testing.assert_allclose(fold_change, statistics.score_fold_change(a, b, log=True))
+        np.testing.assert_allclose([t, p], ttest_ind(a, b))
+        np.testing.assert_allclose(statistics.nanmean(csr_matrix(a)), np.nanmean(a, axis=0))
+        np.testing.assert_allclose(statistics.nanstd(csr_matrix(a), ddof=1), np.nanstd(a, axis=0, ddof=1))
+
+    def test_t_tests_from_statistics(self):
+        random_state = np.random.RandomState(0)
+        a = random_state.normal(0, 1, (5, 50))
+        b = random_state.normal(0.5, 2, (7, 50))
+
+        for alt in statistics.ALTERNATIVES:
+            np.testing.assert_allclose(
+                statistics.score_welch_t_test(a, b, alternative=alt),
+                ttest_ind(a, b, equal_var=False, alternative=alt),
+            )
+            np.testing.assert_allclose(
+                statistics.score_welch_t_test(csr_matrix(a.T), csr_matrix(b.T), axis=1, alternative=alt),
+                ttest_ind(a, b, equal_var=False, alternative=alt),
+            )
+
+        # statistics of merged groups equal statistics of joined data
+        merged = statistics.GroupStatistics.from_data(a).merge(statistics.GroupStatistics.from_data(b))
+        np.testing.assert_allclose(merged.mean, np.vstack((a, b)).mean(axis=0))
+        np.testing.assert_allclose(merged.var(), np.vstack((a, b)).var(axis=0, ddof=1))
+
+    def test_moderated_t_test(self):
+        # variances drawn from a scaled inverse chi-square prior with 4 degrees of freedom and scale 2
+        random_state = np.random.RandomState(0)
+        variances = 4 * 2 / random_state.chisquare(4, 5000)
+        a = random_state.normal(size=(3, 5000)) * np.sqrt(variances)
+        b = random_state.normal(size=(3, 5000)) * np.sqrt(variances)
+
+        stats_a, stats_b = statistics.GroupStatistics.from_data(a), statistics.GroupStatistics.from_data(b)
+        pooled = (stats_a.var() + stats_b.var()) / 2
+        df0, var0 = statistics._variance_prior(pooled, np.full(5000, 4.0))
+        self.assertAlmostEqual(df0, 4, delta=0.5)
+        self.assertAlmostEqual(var0, 2, delta=0.2)
+
+        scores, p_values = statistics.score_moderated_t_test(a, b)
+        self.assertEqual(scores.shape, (5000,))
+        # p-values are uniform under the null hypothesis
+        self.assertAlmostEqual(np.mean(p_values < 0.05), 0.05, delta=0.01)
+
+        _, greater = statistics.score_moderated_t_test(a, b, alternative=statistics.ALT_GREATER)
+        _, less = statistics.score_moderated_t_test(a, b, alternative=statistics.ALT_LESS)
+        np.testing.assert_allclose(greater + less, 1)
+
+    def test_log_factorial_table(self):
+        prob = statistics.Hypergeometric()
+        size = len(statistics.LogBin._lookup)
+        self.assertAlmostEqual(prob._logbin(size + 10, 7), math.log(comb(size + 10, 7, exact=True)))
+        self.assertGreaterEqual(len(statistics.LogBin._lookup), 2 * size)
+        np.testing.assert_allclose(
+            prob._logbin_array([10, 20, 5], [3, 0, 7]), [math.log(comb(10, 3, exact=True)), 0.0, 0.0], atol=1e-12
+        )
+
+    def test_vectorized_p_values(self):
+        """ Vectorized p-values must match scalar ones, including tails that need the exact sum. """
+        random_state = np.random.RandomState(0)
+        N = random_state.randint(20, 2000, 300)
+        m = (random_state.rand(300) * N).astype(int)
+        n = (random_state.rand(300) * N).astype(int)
+        k = (random_state.rand(300) * np.minimum(m, n) * 1.5).astype(int)
+        k[:3] = 0
+        m[3], m[4] = 0, N[4]
+
+        for prob in (statistics.Binomial(), statistics.Hypergeometric()):
+            expected = [prob.p_value(*args) for args in zip(k, N, m, n)]
+            np.testing.assert_allclose(prob.p_values(k, N, m, n), expected, rtol=1e-10, atol=1e-15)
+            self.assertEqual(prob.p_values(k[:6].reshape(2, 3), N[0], m[0], n[0]).shape, (2, 3))
+            self.assertEqual(len(prob.p_values([], 10, [], 5)), 0)
+
+    def test_fdr(self):
+        p_values = [0.04, 0.01, 0.03, 0.01, 0.5]
+        # Benjamini-Hochberg adjusted p-values computed by hand
+        expected = [0.05, 0.025, 0.05, 0.025, 0.5]
+
+        fdr = statistics.FDR(p_values)
+        self.assertIsInstance(fdr, list)
+        np.testing.assert_almost_equal(fdr, expected)
+
+        fdr = statistics.FDR(np.array(p_values))
+        self.assertIsInstance(fdr, np.ndarray)
+        np.testing.assert_almost_equal(fdr, expected)
+
+        harmonic = 1 + 1 / 2 + 1 / 3 + 1 / 4 + 1 / 5
+        np.testing.assert_almost_equal(statistics.FDR(p_values, dependent=True), np.array(expected) * harmonic)
+        np.testing.assert_almost_equal(statistics.FDR(sorted(p_values), ordered=True), sorted(expected))
+        self.assertEqual(statistics.FDR([]), [])
+
+        fdr = statistics.FDR([0.04, np.nan, 0.01, 0.5])
+        self.assertTrue(np.isnan(fdr[1]))
+        np.testing.assert_almost_equal(np.delete(fdr, 1), statistics.FDR([0.04, 0.01, 0.5], m=4))
+
+    def test_streaming_statistics(self):
+        random_state = np.random.RandomState(0)
+        x = random_state.poisson(1.2, (500, 30)).astype(float)
+        labels = random_state.randint(0, 3, 500)
+        a, b = x[labels == 0], x[labels > 0]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'x.npy')
+            np.save(path, x)
+            stats = statistics.StreamingGroupStatistics.from_matrix(
+                np.load(path, mmap_mode='r'), labels, chunk_size=64
+            )
+
+        for alt in statistics.ALTERNATIVES:
+            np.testing.assert_allclose(stats.t_test(0, [1, 2], alt), statistics.score_t_test(a, b, alternative=alt))
+            np.testing.assert_allclose(
+                stats.hypergeometric_test(0, [1, 2], alt), statistics.score_hypergeometric_test(a, b, alternative=alt)
+            )
+        np.testing.assert_allclose(
+            stats.fold_change(0, [1, 2], log=True), statistics.score_fold_change(a, b, log=True)
+        )
+
+        # sparse blocks with unknown values; all values are expressed with threshold 0
+        x[random_state.rand(*x.shape) < 0.05] = np.nan
+        chunks = [(csr_matrix(x[i : i + 77]), labels[i : i + 77]) for i in range(0, len(x), 77)]
+        sparse = statistics.StreamingGroupStatistics.from_chunks(chunks, 3, threshold=0)
+        dense = statistics.StreamingGroupStatistics.from_matrix(x, labels, threshold=0)
+        for name in ('samples', 'n', 'sums', 'squares', 'expressed'):
+            np.testing.assert_allclose(getattr(sparse, name), getattr(dense, name))
+        np.testing.assert_allclose(dense.expressed.sum(axis=0), (~np.isnan(x)).sum(axis=0))
+        np.testing.assert_allclose(
+            dense.fold_change(0, 1), statistics.score_fold_change(x[labels == 0], x[labels == 1])
+        )
+
+    def test_bonferroni(self):
+        self.assertEqual(statistics.Bonferroni([0.1, 0.2]), [0.05, 0.1])
+        np.testing.assert_almost_equal(statistics.Bonferroni(np.array([0.1, 0.2]), m=4), [0.025, 0.05])
+        self.assertEqual(statistics.Bonferroni([]), [])
+
 
 if __name__ == '__main__':
     unittest.main()
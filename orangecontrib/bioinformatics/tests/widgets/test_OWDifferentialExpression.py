@@ -1,43 +1,25 @@
 import unittest
 
 import numpy as np
-import scipy.stats
+import scipy.sparse as sp
 
-from orangecontrib.bioinformatics.widgets.OWDifferentialExpression import f_oneway
+from Orange.data import Table, Domain, DiscreteVariable, ContinuousVariable
 
+from orangecontrib.bioinformatics.widgets.OWDifferentialExpression import copy_variable, select_columns
 
-class TestFOneWay(unittest.TestCase):
-    def test_f_oneway(self):
-        g1 = np.array([0.1, -0.1, 0.2, -0.2])
-        g2 = g1 + 1
-        g3 = g1
 
-        f1, p1 = scipy.stats.f_oneway(g1, g2)
-        f, p = f_oneway(g1, g2)
-        np.testing.assert_almost_equal([f, p], [f1, p1])
+class TestSelectColumns(unittest.TestCase):
+    def test_select_columns(self):
+        x = sp.random(6, 5, density=0.5, format='csr', random_state=0)
+        domain = Domain(
+            [ContinuousVariable('g{}'.format(i)) for i in range(5)], DiscreteVariable('c', values=('a', 'b'))
+        )
+        data = Table.from_numpy(domain, x, np.array([0, 1, 0, 1, 0, 1]))
+        attrs = [copy_variable(var) for var in domain.attributes]
 
-        f, p = f_oneway(np.c_[g1], np.c_[g2], axis=0)
-        np.testing.assert_almost_equal([f[0], p[0]], [f1, p1])
-
-        f1, p1 = scipy.stats.f_oneway(g1, g2, g3)
-        f, p = f_oneway(g1, g2, g3)
-        np.testing.assert_almost_equal([f, p], [f1, p1])
-
-        g1 = np.random.normal(size=(10, 30))
-        g2 = np.random.normal(loc=1, size=(10, 20))
-        g3 = np.random.normal(loc=2, size=(10, 10))
-
-        f, p = f_oneway(g1, g2, g3, axis=1)
-        self.assertEqual(f.shape, (10,))
-        self.assertEqual(p.shape, (10,))
-
-        fp1 = [scipy.stats.f_oneway(g1, g2, g3) for g1, g2, g3 in zip(g1, g2, g3)]
-
-        f1 = [f for f, _ in fp1]
-        p1 = [p for _, p in fp1]
-        np.testing.assert_almost_equal(f1, f)
-        np.testing.assert_almost_equal(p1, p)
-
-        f, p = f_oneway(g1.T, g2.T, g3.T, axis=0)
-        np.testing.assert_almost_equal(f1, f)
-        np.testing.assert_almost_equal(p1, p)
+        subset = select_columns(data, attrs, [1, 3])
+        self.assertTrue(sp.issparse(subset.X))
+        self.assertEqual([var.name for var in subset.domain.attributes], ['g1', 'g3'])
+        np.testing.assert_equal(subset.X.toarray(), x[:, [1, 3]].toarray())
+        np.testing.assert_equal(subset.Y, data.Y)
+        np.testing.assert_equal(subset.ids, data.ids)
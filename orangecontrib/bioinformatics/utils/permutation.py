@@ -0,0 +1,302 @@
+""" Scores of features under permutations of sample labels """
+import os
+import multiprocessing
+from typing import List, Tuple, Union, Callable, Iterator, Optional, Sequence
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import scipy.sparse as sp
+
+from orangecontrib.bioinformatics.utils.statistics import ALT_TWO, ALT_LESS, ALT_GREATER, ALTERNATIVES, GroupStatistics
+
+#: Permutations are scored in blocks with about this many group statistics (permutations x groups x features).
+PERMUTATION_BLOCK_ELEMENTS = 2 ** 22
+
+#: Number of permutations in a task with its own random stream. Tasks do not depend on the number
+#: of workers, so results are reproducible for any ``n_jobs``.
+PERMUTATIONS_PER_TASK = 100
+
+#: Data of worker processes, set once by the pool initializer
+_worker_data = {}
+
+
+def permuted_labels(labels, n_permutations, random_state):
+    # type: (np.ndarray, int, np.random.RandomState) -> np.ndarray
+    """ Return a (permutations x samples) matrix whose rows are random permutations of labels. """
+    order = np.argsort(random_state.random_sample((n_permutations, len(labels))), axis=1)
+    return np.asarray(labels)[order]
+
+
+def one_hot_design(labels, n_groups):
+    # type: (np.ndarray, int) -> sp.csr_matrix
+    """Return a sparse ((permutations * groups) x samples) indicator matrix of labels (permutations x samples).
+
+    Row ``p * n_groups + g`` selects the samples in group ``g`` of permutation ``p``.
+    """
+    n_permutations, n_samples = labels.shape
+    rows = (np.arange(n_permutations)[:, None] * n_groups + labels).ravel()
+    columns = np.tile(np.arange(n_samples), n_permutations)
+    return sp.csr_matrix(
+        (np.ones(len(rows)), (rows, columns)), shape=(n_permutations * n_groups, n_samples), dtype=float
+    )
+
+
+class PermutationGroupStatistics:
+    """Statistics of features in groups of samples for blocks of label permutations.
+
+    Sums and sums of squares of all groups of all permutations in a block are computed with
+    a single product of the one-hot design of the block with the data. Unknown values are skipped.
+    """
+
+    def __init__(self, x):
+        # type: (Union[np.ndarray, sp.spmatrix]) -> None
+        """
+        :param x: data (samples x features); sparse matrices are not densified
+        """
+        if sp.issparse(x):
+            x = sp.csr_matrix(x, dtype=float, copy=True)
+            nans = np.isnan(x.data)
+            unknown = sp.csr_matrix((nans.astype(float), x.indices, x.indptr), shape=x.shape) if nans.any() else None
+            x.data[nans] = 0
+            squares = x.multiply(x).tocsr()
+        else:
+            x = np.asarray(x, dtype=float)
+            nans = np.isnan(x)
+            unknown = nans.astype(float) if nans.any() else None
+            x = np.where(nans, 0, x)
+            squares = x * x
+
+        self.x, self.squares = x, squares
+        #: indicator of unknown values, or None if all values are known
+        self.unknown = unknown
+
+    def __call__(self, labels, n_groups):
+        # type: (np.ndarray, int) -> List[GroupStatistics]
+        """Statistics of groups for each permutation of labels (permutations x samples).
+
+        :return: statistics of each group with arrays of shape (permutations, features)
+        """
+        design = one_hot_design(labels, n_groups)
+        shape = (len(labels), n_groups, self.x.shape[1])
+
+        def group_sums(matrix):
+            result = design @ matrix
+            return (result.toarray() if sp.issparse(result) else np.asarray(result)).reshape(shape)
+
+        group_sizes = np.asarray(design.sum(axis=1)).reshape(shape[:2] + (1,))
+        n = np.broadcast_to(group_sizes, shape)
+        if self.unknown is not None:
+            n = n - group_sums(self.unknown)
+        sums, squares = group_sums(self.x), group_sums(self.squares)
+        return [GroupStatistics(n[:, g], sums[:, g], squares[:, g]) for g in range(n_groups)]
+
+
+def permutation_score_blocks(
+    x,  # type: Union[np.ndarray, sp.spmatrix]
+    group_indices,  # type: Sequence[np.ndarray]
+    n_permutations,  # type: int
+    statistic=None,  # type: Optional[Callable[..., np.ndarray]]
+    score=None,  # type: Optional[Callable[..., np.ndarray]]
+    random_state=None,  # type: Optional[np.random.RandomState]
+    block_size=None,  # type: Optional[int]
+):
+    # type: (...) -> Iterator[np.ndarray]
+    """Scores of features under random permutations of samples between groups, in blocks of permutations.
+
+    Labels of a whole block of permutations are drawn at once. Scores given as a ``statistic`` of
+    group statistics (:obj:`GroupStatistics` with arrays of shape (permutations, features)) are computed
+    for the whole block from a single matrix product. Other scores are computed from rows of groups
+    with ``score(*arrays)`` for each permutation.
+
+    :param x: data (samples x features)
+    :param group_indices: indices of rows of x in each group; other rows are not permuted
+    :param statistic: score of features from group statistics, ``statistic(*groups)``
+    :param score: score of features from data of groups, ``score(*arrays)``, if statistic is not given
+    :param block_size: number of permutations in a block; chosen from data size by default
+    :return: iterator over arrays of scores of shape (permutations in block, features)
+
+    Example
+    --------
+        >>> blocks = permutation_score_blocks(x, [a_rows, b_rows], 1000, statistic=lambda a, b: a.mean - b.mean)
+        >>> null = np.vstack(list(blocks))
+    """
+    if (statistic is None) == (score is None):
+        raise ValueError('Either statistic or score must be given')
+    if random_state is None:
+        random_state = np.random.RandomState(0)
+
+    rows = np.hstack(group_indices)
+    labels = np.repeat(np.arange(len(group_indices)), [len(ind) for ind in group_indices])
+    if block_size is None:
+        block_size = max(1, PERMUTATION_BLOCK_ELEMENTS // (len(group_indices) * x.shape[1] or 1))
+
+    if statistic is not None:
+        group_statistics = PermutationGroupStatistics(x[rows])
+    for start in range(0, n_permutations, block_size):
+        labels_block = permuted_labels(labels, min(block_size, n_permutations - start), random_state)
+        if statistic is not None:
+            yield np.asarray(statistic(*group_statistics(labels_block, len(group_indices))))
+        else:
+            yield np.array(
+                [score(*[x[rows[permuted == g]] for g in range(len(group_indices))]) for permuted in labels_block]
+            )
+
+
+class PermutationPValues:
+    """Empirical p-values of features and Westfall-Young step-down max-T adjusted p-values
+    (family-wise error rate), updated with blocks of scores under permutations.
+
+    Only counts of permutations with more extreme scores are kept, so memory does not
+    depend on the number of permutations. Unknown scores are never more extreme.
+
+    Example
+    --------
+        >>> p_values = PermutationPValues(scores, alternative=ALT_TWO)
+        >>> for _, null_scores in permutation_scores(x, group_indices, 1000, statistic=statistic):
+        ...     p_values.update(null_scores)
+        >>> p_values.p_values, p_values.adjusted_p_values
+    """
+
+    def __init__(self, scores, alternative=ALT_TWO):
+        # type: (np.ndarray, str) -> None
+        """
+        :param scores: observed scores of features
+        :param alternative: direction of extreme scores; ALT_GREATER for high, ALT_LESS for low
+                            and ALT_TWO for scores with high absolute values
+        """
+        assert alternative in ALTERNATIVES
+        self.alternative = alternative
+        self.scores = np.asarray(scores, dtype=float)
+        self._observed = self._extremeness(self.scores)
+        # features from the most to the least extreme
+        self._order = np.argsort(-self._observed, kind='mergesort')
+
+        self.n_permutations = 0
+        self._exceeding = np.zeros(len(self.scores), dtype=int)
+        self._exceeding_max = np.zeros(len(self.scores), dtype=int)
+
+    def _extremeness(self, scores):
+        # type: (np.ndarray) -> np.ndarray
+        """ Transform scores so that higher values are more extreme. """
+        if self.alternative == ALT_GREATER:
+            extremeness = np.array(scores, dtype=float)
+        elif self.alternative == ALT_LESS:
+            extremeness = -np.asarray(scores, dtype=float)
+        else:
+            extremeness = np.abs(scores)
+        extremeness[np.isnan(extremeness)] = -np.inf
+        return extremeness
+
+    def update(self, null_scores):
+        # type: (np.ndarray) -> None
+        """ Add scores of features under permutations (permutations x features). """
+        null = self._extremeness(np.atleast_2d(null_scores))
+        # features with unknown observed scores are not tested
+        null[:, np.isnan(self.scores)] = -np.inf
+        self._exceeding += np.count_nonzero(null >= self._observed, axis=0)
+
+        # step-down max-T: compare each feature with the maximum over it and all less extreme features
+        successive_max = np.maximum.accumulate(null[:, self._order[::-1]], axis=1)[:, ::-1]
+        self._exceeding_max[self._order] += np.count_nonzero(successive_max >= self._observed[self._order], axis=0)
+        self.n_permutations += len(null)
+
+    @property
+    def p_values(self):
+        # type: () -> np.ndarray
+        """ Empirical p-values of features. """
+        p_values = (self._exceeding + 1) / (self.n_permutations + 1)
+        p_values[np.isnan(self.scores)] = np.nan
+        return p_values
+
+    @property
+    def adjusted_p_values(self):
+        # type: () -> np.ndarray
+        """ Westfall-Young step-down max-T adjusted p-values. """
+        adjusted = np.empty(len(self.scores))
+        adjusted[self._order] = np.maximum.accumulate(
+            (self._exceeding_max[self._order] + 1) / (self.n_permutations + 1)
+        )
+        adjusted[np.isnan(self.scores)] = np.nan
+        return adjusted
+
+
+def _task_random_states(seed, n_permutations):
+    # type: (int, int) -> List[Tuple[int, int, np.random.RandomState]]
+    """ Split permutations into tasks of (first permutation, number of permutations, random state). """
+    starts = range(0, n_permutations, PERMUTATIONS_PER_TASK)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    return [
+        (start, min(PERMUTATIONS_PER_TASK, n_permutations - start), np.random.RandomState(np.random.MT19937(ss)))
+        for start, ss in zip(starts, seeds)
+    ]
+
+
+def _score_task(x, group_indices, n_permutations, statistic, score, random_state):
+    blocks = permutation_score_blocks(
+        x, group_indices, n_permutations, statistic=statistic, score=score, random_state=random_state
+    )
+    return np.vstack(list(blocks))
+
+
+def _init_worker(x, group_indices):
+    _worker_data.update(x=x, group_indices=group_indices)
+
+
+def _score_task_in_worker(n_permutations, statistic, score, random_state):
+    return _score_task(
+        _worker_data['x'], _worker_data['group_indices'], n_permutations, statistic, score, random_state
+    )
+
+
+def permutation_scores(
+    x,  # type: Union[np.ndarray, sp.spmatrix]
+    group_indices,  # type: Sequence[np.ndarray]
+    n_permutations,  # type: int
+    statistic=None,  # type: Optional[Callable[..., np.ndarray]]
+    score=None,  # type: Optional[Callable[..., np.ndarray]]
+    seed=0,  # type: int
+    n_jobs=1,  # type: Optional[int]
+):
+    # type: (...) -> Iterator[Tuple[int, np.ndarray]]
+    """Scores of features under random permutations of samples between groups, computed in parallel.
+
+    Permutations are split into tasks of :data:`PERMUTATIONS_PER_TASK` permutations with independent
+    random streams, so scores do not depend on ``n_jobs``. Tasks are scored in worker processes, which
+    receive the data once, and their scores are yielded as soon as they are done, so partial null
+    distributions can be used while the remaining permutations are scored.
+
+    ``statistic`` and ``score`` are the same as in :obj:`permutation_score_blocks`; with ``n_jobs > 1``
+    they must be picklable (for example module-level functions or partials of them).
+
+    :param seed: seed of the random number generator
+    :param n_jobs: number of worker processes (``None`` or ``-1`` for all processors)
+    :return: iterator over (index of the first permutation, scores of shape (permutations in task, features))
+    """
+    if (statistic is None) == (score is None):
+        raise ValueError('Either statistic or score must be given')
+    if n_jobs is None or n_jobs < 0:
+        n_jobs = os.cpu_count() or 1
+
+    tasks = _task_random_states(seed, n_permutations)
+    if n_jobs == 1 or len(tasks) < 2:
+        for start, n_task, random_state in tasks:
+            yield start, _score_task(x, group_indices, n_task, statistic, score, random_state)
+        return
+
+    executor = ProcessPoolExecutor(
+        max_workers=min(n_jobs, len(tasks)),
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(x, group_indices),
+    )
+    futures = {}
+    try:
+        for start, n_task, random_state in tasks:
+            futures[executor.submit(_score_task_in_worker, n_task, statistic, score, random_state)] = start
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # pending tasks are cancelled when the consumer stops early (e.g. on cancellation)
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
@@ -1,22 +1,213 @@
 import math
 import threading
-from typing import Tuple, Union
+from typing import List, Tuple, Union, Iterable, Iterator, Optional, Sequence, NamedTuple
 
 import numpy as np
 import scipy
+import scipy.sparse as sp
 from scipy.stats import hypergeom
+from scipy.special import fdtrc, chdtrc, digamma, gammaln, polygamma
 
 ALT_TWO = "two-sided"
 ALT_LESS = "less"
 ALT_GREATER = "greater"
 ALTERNATIVES = [ALT_GREATER, ALT_TWO, ALT_LESS]
 
+#: Features are ranked in blocks of about this many values to bound memory use.
+RANK_BLOCK_ELEMENTS = 2 ** 22
+
+
+class GroupStatistics(NamedTuple):
+    """ Sufficient statistics of a group of samples: numbers of values, sums and sums of squares of features.
+
+    Statistics of disjoint groups can be merged, and t-tests are computed from them without the data.
+    """
+
+    n: np.ndarray
+    sums: np.ndarray
+    squares: np.ndarray
+
+    @classmethod
+    def from_data(cls, x, axis=0, ignore_nan=False):
+        # type: (Union[np.ndarray, sp.spmatrix], int, bool) -> GroupStatistics
+        """ Compute statistics of features in one pass over x; sparse matrices are not densified.
+
+        :param x: samples along axis
+        :param ignore_nan: skip unknown values instead of propagating them
+        """
+        n = np.full(x.shape[1 - axis], x.shape[axis], dtype=float)
+        if sp.issparse(x):
+            x = sp.csr_matrix(x, dtype=float)
+            nans = np.isnan(x.data)
+            if ignore_nan and nans.any():
+                nan_matrix = x.copy()
+                nan_matrix.data = nans.astype(float)
+                n -= np.asarray(nan_matrix.sum(axis=axis)).ravel()
+                x = x.copy()
+                x.data[nans] = 0
+            sums = np.asarray(x.sum(axis=axis)).ravel()
+            squares = np.asarray(x.multiply(x).sum(axis=axis)).ravel()
+        else:
+            x = np.asarray(x, dtype=float)
+            if ignore_nan:
+                n -= np.isnan(x).sum(axis=axis)
+                x = np.where(np.isnan(x), 0, x)
+            sums = x.sum(axis=axis)
+            squares = np.einsum('ij,ij->j' if axis == 0 else 'ij,ij->i', x, x)
+        return cls(n, sums, squares)
+
+    def merge(self, other):
+        # type: (GroupStatistics) -> GroupStatistics
+        """ Statistics of the union of two disjoint groups. """
+        return GroupStatistics(self.n + other.n, self.sums + other.sums, self.squares + other.squares)
+
+    @property
+    def mean(self):
+        # type: () -> np.ndarray
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.sums / self.n
+
+    def var(self, ddof=1):
+        # type: (int) -> np.ndarray
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.maximum(self.squares - self.sums ** 2 / self.n, 0) / (self.n - ddof)
+
+
+def nanmean(x, axis=0):
+    # type: (Union[np.ndarray, sp.spmatrix], int) -> np.ndarray
+    """ Like :obj:`numpy.nanmean`, but also for sparse matrices, which are not densified. """
+    if not sp.issparse(x):
+        return np.nanmean(x, axis=axis)
+    return GroupStatistics.from_data(x, axis, ignore_nan=True).mean
+
+
+def nanstd(x, axis=0, ddof=0):
+    # type: (Union[np.ndarray, sp.spmatrix], int, int) -> np.ndarray
+    """ Like :obj:`numpy.nanstd`, but also for sparse matrices, which are not densified. """
+    if not sp.issparse(x):
+        return np.nanstd(x, axis=axis, ddof=ddof)
+    return np.sqrt(GroupStatistics.from_data(x, axis, ignore_nan=True).var(ddof))
+
+
+def _t_p_values(scores, df, alternative):
+    # type: (np.ndarray, np.ndarray, str) -> np.ndarray
+    if alternative == ALT_GREATER:
+        return scipy.stats.t.sf(scores, df)
+    elif alternative == ALT_LESS:
+        return scipy.stats.t.cdf(scores, df)
+    else:
+        return 2 * scipy.stats.t.sf(np.abs(scores), df)
+
+
+def t_test_from_statistics(a, b, alternative=ALT_TWO, equal_var=True):
+    # type: (GroupStatistics, GroupStatistics, str, bool) -> Tuple[np.ndarray, np.ndarray]
+    """ Student's (pooled variance) or Welch's t-test from statistics of two groups.
+
+    :return: (statistics, p_values)
+    """
+    assert alternative in ALTERNATIVES
+    var_a, var_b = a.var(), b.var()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if equal_var:
+            df = a.n + b.n - 2
+            se = np.sqrt(((a.n - 1) * var_a + (b.n - 1) * var_b) / df * (1 / a.n + 1 / b.n))
+        else:
+            se_a, se_b = var_a / a.n, var_b / b.n
+            se = np.sqrt(se_a + se_b)
+            df = (se_a + se_b) ** 2 / (se_a ** 2 / (a.n - 1) + se_b ** 2 / (b.n - 1))
+        scores = (a.mean - b.mean) / se
+    return scores, _t_p_values(scores, df, alternative)
+
+
+def _trigamma_inverse(x):
+    # type: (float) -> float
+    """ Solve trigamma(y) = x for y with Newton's method (Smyth, 2004). """
+    if x > 1e7:
+        return 1 / np.sqrt(x)
+    if x < 1e-6:
+        return 1 / x
+    y = 0.5 + 1 / x
+    for _ in range(50):
+        tri = polygamma(1, y)
+        step = tri * (1 - tri / x) / polygamma(2, y)
+        y += step
+        if -step / y < 1e-8:
+            break
+    return y
+
+
+def _variance_prior(variances, df):
+    # type: (np.ndarray, np.ndarray) -> Tuple[float, float]
+    """ Estimate degrees of freedom and scale of the scaled inverse chi-square prior of variances
+    by matching moments of log variances (Smyth, 2004).
+    """
+    valid = np.isfinite(variances) & (variances > 0) & (df > 0)
+    if not valid.any():
+        return 0.0, 0.0
+    variances, df = variances[valid], df[valid]
+    log_var = np.log(variances) - digamma(df / 2) + np.log(df / 2)
+    mean = log_var.mean()
+    excess = np.var(log_var, ddof=1) - polygamma(1, df / 2).mean() if len(log_var) > 1 else 0
+    if excess > 0:
+        df0 = 2 * _trigamma_inverse(excess)
+        return df0, float(np.exp(mean + digamma(df0 / 2) - np.log(df0 / 2)))
+    else:
+        return np.inf, float(np.exp(mean))
+
+
+def moderated_variance(a, b):
+    # type: (GroupStatistics, GroupStatistics) -> Tuple[np.ndarray, np.ndarray]
+    """ Pooled variances of features shrunk towards the prior estimated from all features (Smyth, 2004).
+
+    :return: (posterior variances, degrees of freedom)
+    """
+    df = a.n + b.n - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pooled_var = ((a.n - 1) * a.var() + (b.n - 1) * b.var()) / df
+    df0, var0 = _variance_prior(pooled_var, df)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if np.isinf(df0):
+            return np.full_like(pooled_var, var0), np.full_like(df, np.inf)
+        return (df0 * var0 + df * pooled_var) / (df0 + df), df0 + df
+
+
+def moderated_t_test_from_statistics(a, b, alternative=ALT_TWO):
+    # type: (GroupStatistics, GroupStatistics, str) -> Tuple[np.ndarray, np.ndarray]
+    """ Moderated t-test (Smyth, 2004): pooled variances of features are shrunk towards a common prior
+    estimated from all features, which stabilizes scores of features with few samples or small variances.
+
+    :return: (statistics, p_values)
+    """
+    assert alternative in ALTERNATIVES
+    posterior_var, df_total = moderated_variance(a, b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = (a.mean - b.mean) / np.sqrt(posterior_var * (1 / a.n + 1 / b.n))
+    return scores, _t_p_values(scores, df_total, alternative)
+
+
+def f_oneway_from_statistics(groups):
+    # type: (Sequence[GroupStatistics]) -> Tuple[np.ndarray, np.ndarray]
+    """ One-way ANOVA from statistics of groups.
+
+    :return: (F statistics, p_values)
+    """
+    n = sum(g.n for g in groups)
+    sums = sum(g.sums for g in groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = sum(g.sums ** 2 / g.n for g in groups) - sums ** 2 / n
+        within = sum(g.squares for g in groups) - sums ** 2 / n - between
+        df_between, df_within = len(groups) - 1, n - len(groups)
+        f = (between / df_between) / (within / df_within)
+    return f, fdtrc(df_between, df_within, f)
+
 
 def score_t_test(a, b, axis=0, alternative=ALT_TWO):
     # type: (np.array, np.array, int, str) -> Tuple[Union[float, np.array], Union[float, np.array]]
     """ Run t-test. Enable setting different alternative hypothesis.
     Probabilities are exact due to symmetry of the test.
 
+    Sparse matrices are not densified.
+
     :return: (statistics, p_values)
 
     See also
@@ -26,7 +217,12 @@ def score_t_test(a, b, axis=0, alternative=ALT_TWO):
     """
     # alt = kwargs.get("alternative", ALT_TWO)
     assert alternative in ALTERNATIVES
-    scores, pvalues = scipy.stats.ttest_ind(a, b, axis=axis)
+    if sp.issparse(a) or sp.issparse(b):
+        scores, pvalues = t_test_from_statistics(
+            GroupStatistics.from_data(a, axis), GroupStatistics.from_data(b, axis)
+        )
+    else:
+        scores, pvalues = scipy.stats.ttest_ind(a, b, axis=axis)
 
     if alternative == ALT_TWO:
         return scores, pvalues
@@ -41,9 +237,147 @@ def score_t_test(a, b, axis=0, alternative=ALT_TWO):
         return scores, 1.0 - pvalues
 
 
+def score_welch_t_test(a, b, axis=0, alternative=ALT_TWO):
+    # type: (np.array, np.array, int, str) -> Tuple[np.array, np.array]
+    """ Run Welch's t-test, which does not assume equal variances of groups.
+
+    :return: (statistics, p_values)
+    """
+    return t_test_from_statistics(
+        GroupStatistics.from_data(a, axis), GroupStatistics.from_data(b, axis), alternative, equal_var=False
+    )
+
+
+def score_moderated_t_test(a, b, axis=0, alternative=ALT_TWO):
+    # type: (np.array, np.array, int, str) -> Tuple[np.array, np.array]
+    """ Run moderated t-test with empirical Bayes shrinkage of variances across features.
+
+    :return: (statistics, p_values)
+
+    See also
+    --------
+    moderated_t_test_from_statistics
+    """
+    return moderated_t_test_from_statistics(
+        GroupStatistics.from_data(a, axis), GroupStatistics.from_data(b, axis), alternative
+    )
+
+
+def _ranked_block(x):
+    """ Rank values in each column of a dense or sparse block in increasing order; ties get average ranks.
+
+    Implicit zeros of sparse blocks are not ranked one by one: all zeros of a column share a rank.
+    Unknown values get unknown ranks.
+
+    :return: (rows, columns, ranks) of explicit values, ranks of zeros, numbers of implicit zeros
+        and tie terms ``sum(t**3 - t)`` of columns
+    """
+    n_rows, n_cols = x.shape
+    if sp.issparse(x):
+        x = sp.csc_matrix(x, dtype=float, copy=True)
+        x.sum_duplicates()
+        x.eliminate_zeros()
+        counts = np.diff(x.indptr)
+        cols = np.repeat(np.arange(n_cols), counts)
+        order = np.lexsort((x.data, cols))
+        values, rows = x.data[order], x.indices[order]
+    else:
+        x = np.asarray(x, dtype=float)
+        order = np.argsort(x, axis=0, kind='mergesort')
+        values = np.take_along_axis(x, order, axis=0).T.ravel()
+        rows = order.T.ravel()
+        counts = np.full(n_cols, n_rows)
+        cols = np.repeat(np.arange(n_cols), n_rows)
+
+    n_zeros = n_rows - counts
+    position = np.arange(len(values)) - (np.cumsum(counts) - counts)[cols]
+    # positive values come after all (implicit) zeros of the column
+    position += np.where(values > 0, n_zeros[cols], 0)
+
+    tie_terms = n_zeros.astype(float) ** 3 - n_zeros
+    ranks = position.astype(float)
+    if len(values):
+        group_start = np.flatnonzero(np.r_[True, (cols[1:] != cols[:-1]) | (values[1:] != values[:-1])])
+        group_size = np.diff(np.r_[group_start, len(values)]).astype(float)
+        ranks = np.repeat(position[group_start] + (group_size + 1) / 2, group_size.astype(int))
+        tie_terms += np.bincount(cols[group_start], weights=group_size ** 3 - group_size, minlength=n_cols)
+        ranks[np.isnan(values)] = np.nan
+
+    zero_ranks = np.bincount(cols[values < 0], minlength=n_cols) + (n_zeros + 1) / 2
+    return rows, cols, ranks, zero_ranks, n_zeros, tie_terms
+
+
+def _rank_sums(x, labels, n_groups):
+    # type: (Union[np.ndarray, sp.spmatrix], np.ndarray, int) -> Tuple[np.ndarray, np.ndarray]
+    """ Rank values in each column of x (samples x features) and sum the ranks within groups of samples.
+
+    Columns are ranked in blocks of about :data:`RANK_BLOCK_ELEMENTS` values; sparse matrices are
+    not densified.
+
+    :param labels: group index of each sample
+    :return: (rank sums of shape (n_groups, features), tie terms ``sum(t**3 - t)`` of features)
+    """
+    n_rows, n_cols = x.shape
+    if sp.issparse(x):
+        x = sp.csc_matrix(x)
+
+    group_sizes = np.bincount(labels, minlength=n_groups)
+    rank_sums = np.empty((n_groups, n_cols))
+    tie_terms = np.empty(n_cols)
+    block_size = max(1, RANK_BLOCK_ELEMENTS // max(n_rows, 1))
+    for start in range(0, n_cols, block_size):
+        end = min(start + block_size, n_cols)
+        rows, cols, ranks, zero_ranks, _, block_ties = _ranked_block(x[:, start:end])
+
+        index = labels[rows] * (end - start) + cols
+        explicit = np.bincount(index, minlength=n_groups * (end - start)).reshape(n_groups, -1)
+        sums = np.bincount(index, weights=ranks, minlength=n_groups * (end - start)).reshape(n_groups, -1)
+        rank_sums[:, start:end] = sums + (group_sizes[:, None] - explicit) * zero_ranks
+        tie_terms[start:end] = block_ties
+    return rank_sums, tie_terms
+
+
+def _mann_whitney_exact_cdf(n1, n2):
+    # type: (int, int) -> np.ndarray
+    """ Null distribution of U without ties: ``P(U <= u)`` for ``u`` in ``0 ... n1 * n2``.
+
+    Frequencies of U are coefficients of the Gaussian binomial coefficient
+    ``prod((1 - q**(m + i)) / (1 - q**i) for i in 1 ... k)`` with ``k = min(n1, n2)`` and ``m = max(n1, n2)``.
+    """
+    k, m = min(n1, n2), max(n1, n2)
+    size = k * m + 1
+    counts = np.zeros(size)
+    counts[0] = 1
+    for i in range(1, k + 1):
+        # divide by (1 - q**i): cumulative sums over every i-th coefficient
+        padded = np.zeros(-(-size // i) * i)
+        padded[:size] = counts
+        counts = padded.reshape(-1, i).cumsum(axis=0).ravel()[:size]
+    for i in range(m + 1, m + k + 1):
+        # multiply by (1 - q**i)
+        if i < size:
+            counts[i:] -= counts[:-i].copy()
+    return np.cumsum(counts) / counts.sum()
+
+
 def score_mann_whitney(a, b, **kwargs):
+    """ Run Mann-Whitney U test on all features at once. Enable setting different alternative hypothesis.
+
+    Each feature is ranked once (sparse matrices without densification) and p-values are computed with
+    the normal approximation with tie and continuity corrections. As in :obj:`scipy.stats.mannwhitneyu`,
+    exact p-values are used when one of the groups has at most 8 samples and the feature has no ties.
+
+    :return: (U statistics of the first sample, p_values)
+
+    See also
+    --------
+    scipy.stats.mannwhitneyu
+    """
     axis = kwargs.get('axis', 0)
-    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    if not sp.issparse(a):
+        a = np.asarray(a, dtype=float)
+    if not sp.issparse(b):
+        b = np.asarray(b, dtype=float)
 
     if not 0 <= axis < 2:
         raise ValueError("Axis")
@@ -54,21 +388,113 @@ def score_mann_whitney(a, b, **kwargs):
     if axis >= a.ndim:
         raise ValueError
 
-    if axis == 0:
+    if a.ndim == 1:
+        a, b = a[:, None], b[:, None]
+    elif axis == 1:
         a, b = a.T, b.T
 
     alt = kwargs.get("alternative", ALT_TWO)
     assert alt in ALTERNATIVES
-    statistics = np.zeros((a.shape[0]))
-    p_values = np.zeros((a.shape[0]))
-    for i, (a_, b_) in enumerate(zip(a, b)):
-        try:
-            s, p = scipy.stats.mannwhitneyu(a_, b_, alternative=alt)
-        except ValueError:
-            s, p = (0, 1)
-        statistics[i] = s
-        p_values[i] = p
-    return np.array(statistics), np.array(p_values)
+
+    n1, n2 = a.shape[0], b.shape[0]
+    if not n1 or not n2:
+        return np.zeros(a.shape[1]), np.ones(a.shape[1])
+
+    x = sp.vstack([a, b]) if sp.issparse(a) or sp.issparse(b) else np.vstack([a, b])
+    labels = np.r_[np.zeros(n1, dtype=int), np.ones(n2, dtype=int)]
+    rank_sums, tie_terms = _rank_sums(x, labels, 2)
+    return mann_whitney_from_rank_sums(rank_sums[0], n1, n2, tie_terms, alt)
+
+
+def mann_whitney_from_rank_sums(rank_sums, n1, n2, tie_terms, alternative=ALT_TWO):
+    # type: (np.ndarray, int, int, np.ndarray, str) -> Tuple[np.ndarray, np.ndarray]
+    """ Mann-Whitney U test from sums of ranks of the first sample within both samples.
+
+    :param tie_terms: ``sum(t**3 - t)`` over groups of tied values of each feature
+    :return: (U statistics of the first sample, p_values)
+    """
+    alt = alternative
+    assert alt in ALTERNATIVES
+    u1 = rank_sums - n1 * (n1 + 1) / 2
+    u2 = n1 * n2 - u1
+    u = {ALT_GREATER: u1, ALT_LESS: u2, ALT_TWO: np.maximum(u1, u2)}[alt]
+
+    n = n1 + n2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_terms / (n * (n - 1))))
+        p_values = scipy.stats.norm.sf((u - n1 * n2 / 2 - 0.5) / sigma)
+
+    exact = (tie_terms == 0) & np.isfinite(u)
+    if min(n1, n2) <= 8 and exact.any():
+        # P(U >= u) = P(U <= n1 * n2 - u) by symmetry
+        p_values[exact] = _mann_whitney_exact_cdf(n1, n2)[(n1 * n2 - u[exact]).astype(int)]
+
+    if alt == ALT_TWO:
+        p_values = np.minimum(2 * p_values, 1.0)
+    return u1, p_values
+
+
+def score_kruskal_wallis(*arrays, axis=0):
+    # type: (Union[np.ndarray, sp.spmatrix], int) -> Tuple[np.ndarray, np.ndarray]
+    """ Run Kruskal-Wallis H test on all features at once.
+
+    Each feature is ranked once over samples of all groups (sparse matrices without densification),
+    and p-values are computed with the chi-square approximation with tie correction.
+
+    :return: (H statistics, p_values)
+
+    See also
+    --------
+    scipy.stats.kruskal
+    """
+    if axis == 1:
+        arrays = [a.T for a in arrays]
+    x = sp.vstack(arrays) if any(sp.issparse(a) for a in arrays) else np.vstack(arrays)
+    sizes = np.array([a.shape[0] for a in arrays])
+    labels = np.repeat(np.arange(len(arrays)), sizes)
+    rank_sums, tie_terms = _rank_sums(x, labels, len(arrays))
+    return kruskal_wallis_from_rank_sums(rank_sums, sizes, tie_terms)
+
+
+def kruskal_wallis_from_rank_sums(rank_sums, sizes, tie_terms):
+    # type: (np.ndarray, np.ndarray, np.ndarray) -> Tuple[np.ndarray, np.ndarray]
+    """ Kruskal-Wallis H test from sums of ranks of groups within all samples.
+
+    :param rank_sums: sums of ranks of features in each group, of shape (groups, features)
+    :param sizes: numbers of samples in groups
+    :param tie_terms: ``sum(t**3 - t)`` over groups of tied values of each feature
+    :return: (H statistics, p_values)
+    """
+    sizes = np.asarray(sizes, dtype=float)
+    n = sizes.sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h = 12 / (n * (n + 1)) * np.sum(rank_sums ** 2 / sizes[:, None], axis=0) - 3 * (n + 1)
+        h /= 1 - tie_terms / (n ** 3 - n)
+    return h, chdtrc(len(sizes) - 1, h)
+
+
+def _count_at_least(x, threshold):
+    # type: (Union[np.ndarray, sp.spmatrix], float) -> np.ndarray
+    """ Count values greater or equal to threshold in each column of x (samples x features).
+
+    Only explicit values of sparse matrices are compared, and dense matrices are compared in blocks
+    of rows, so no dense boolean copy of x is made.
+    """
+    n_rows, n_cols = x.shape
+    if sp.issparse(x):
+        x = sp.csr_matrix(x)
+        x.sum_duplicates()
+        counts = np.bincount(x.indices[x.data >= threshold], minlength=n_cols)
+        if threshold <= 0:
+            # implicit zeros are above the threshold too
+            counts += n_rows - x.getnnz(axis=0)
+        return counts
+
+    counts = np.zeros(n_cols, dtype=int)
+    block_size = max(1, RANK_BLOCK_ELEMENTS // max(n_cols, 1))
+    for start in range(0, n_rows, block_size):
+        counts += np.count_nonzero(x[start : start + block_size] >= threshold, axis=0)
+    return counts
 
 
 def score_hypergeometric_test(a, b, threshold=1, **kwargs):
@@ -77,25 +503,54 @@ def score_hypergeometric_test(a, b, threshold=1, **kwargs):
     with the symmetric distribution with more extreme of the tails.
     """
     # type: (np.ndarray, np.ndarray, float) -> np.ndarray
-
-    # Binary expression matrices
-    _a = (a >= threshold).astype(int)
-    _b = (b >= threshold).astype(int)
     alt = kwargs.get("alternative", ALT_TWO)
     assert alt in ALTERNATIVES
 
+    return hypergeometric_test_from_counts(
+        _count_at_least(a, threshold), a.shape[0], _count_at_least(b, threshold), b.shape[0], alt
+    )
+
+
+def stratified_z_test(deviations, variances, alternative=ALT_TWO):
+    # type: (np.ndarray, np.ndarray, str) -> Tuple[np.ndarray, np.ndarray]
+    """ Combine independent strata (e.g. batches) like the Cochran-Mantel-Haenszel test: deviations of
+    statistics from their expectations under the null hypothesis and their variances are summed over
+    strata, and the standardized sum is compared with the normal distribution.
+
+    :param deviations: sums of deviations over strata for each feature
+    :param variances: sums of variances over strata for each feature
+    :return: (z statistics, p_values)
+    """
+    assert alternative in ALTERNATIVES
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = deviations / np.sqrt(variances)
+    if alternative == ALT_GREATER:
+        return z, scipy.stats.norm.sf(z)
+    elif alternative == ALT_LESS:
+        return z, scipy.stats.norm.cdf(z)
+    else:
+        return z, 2 * scipy.stats.norm.sf(np.abs(z))
+
+
+def hypergeometric_test_from_counts(expressed_a, n_a, expressed_b, n_b, alternative=ALT_TWO):
+    # type: (np.ndarray, int, np.ndarray, int, str) -> Tuple[np.ndarray, np.ndarray]
+    """ Hypergeometric test from numbers of samples that express each feature in the two groups.
+
+    :return: (scores, p_values)
+    """
+    alt = alternative
+    assert alt in ALTERNATIVES
+
     # Test Parameters
-    m = len(_a) + len(_b)
-    n = len(_a)
-    n_expr = _a.sum(axis=0) + _b.sum(axis=0)  # Number of cells expressing genes (overall)
-    n_expr_clust = _a.sum(axis=0)  # Number of cells expressing genes (in cluster)
+    m = n_a + n_b
+    n = n_a
+    n_expr_clust = expressed_a  # Number of cells expressing genes (in cluster)
+    n_expr = expressed_a + expressed_b  # Number of cells expressing genes (overall)
 
     # Test results --- both tails
     # Note: cumulatives do sum to >1 due to overlap at 1 point
-    under = np.fromiter(map(lambda t: hypergeom.cdf(k=t[1], n=t[0], M=m, N=n), zip(n_expr, n_expr_clust)), dtype=float)
-    over = np.fromiter(
-        map(lambda t: hypergeom.sf(k=t[1] - 1, n=t[0], M=m, N=n), zip(n_expr, n_expr_clust)), dtype=float
-    )
+    under = hypergeom.cdf(k=n_expr_clust, n=n_expr, M=m, N=n)
+    over = hypergeom.sf(k=n_expr_clust - 1, n=n_expr, M=m, N=n)
     signs = np.sign(under - over)
     if alt == ALT_TWO:
         pvalues = np.minimum(1.0, 2.0 * np.minimum(under, over))
@@ -111,15 +566,15 @@ def score_fold_change(a, b, axis=0, log=False):
     # type: (np.array, np.array, int, bool) -> np.array
     """ Calculate the fold change between `a` and `b` samples.
 
-    :param a: Array containing the samples
-    :param b: Array containing the samples
+    :param a: Array or sparse matrix containing the samples
+    :param b: Array or sparse matrix containing the samples
     :param axis: Axis over which to compute the scores
     :param log: Return the log2(scores).
 
     :return: The fold change scores
     """
 
-    scores = np.nanmean(a, axis=axis) / np.nanmean(b, axis=axis)
+    scores = nanmean(a, axis=axis) / nanmean(b, axis=axis)
 
     # TODO: Properly handle this warrning in widgets
     # "Negative fold change scores were ignored. You should use another scoring method."
@@ -129,25 +584,197 @@ def score_fold_change(a, b, axis=0, log=False):
     return np.log2(scores) if log else scores
 
 
-def _lngamma(z):
-    x = 0
-    x += 0.1659470187408462e-06 / (z + 7)
-    x += 0.9934937113930748e-05 / (z + 6)
-    x -= 0.1385710331296526 / (z + 5)
-    x += 12.50734324009056 / (z + 4)
-    x -= 176.6150291498386 / (z + 3)
-    x += 771.3234287757674 / (z + 2)
-    x -= 1259.139216722289 / (z + 1)
-    x += 676.5203681218835 / z
-    x += 0.9999999999995183
+def score_fold_change_t_test(a, b, axis=0, alternative=ALT_TWO):
+    # type: (np.array, np.array, int, str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]
+    """ Compute log2 fold change and Student's t-test between `a` and `b` samples from
+    statistics computed in a single pass over each group; sparse matrices are not densified.
 
-    return math.log(x) - 5.58106146679532777 - z + (z - 0.5) * math.log(z + 6.5)
+    Fold changes, like :obj:`score_fold_change`, skip unknown values, while t-test
+    statistics, like :obj:`score_t_test`, are unknown for features with unknown values.
+
+    :return: (log2 fold changes, statistics, p_values)
+    """
+    assert alternative in ALTERNATIVES
+    a_stats = GroupStatistics.from_data(a, axis, ignore_nan=True)
+    b_stats = GroupStatistics.from_data(b, axis, ignore_nan=True)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fold_change = a_stats.mean / b_stats.mean
+        fold_change[fold_change < 0] = np.nan
+        fold_change = np.log2(fold_change)
+
+    scores, p_values = t_test_from_statistics(a_stats, b_stats, alternative)
+    unknown = (a_stats.n < a.shape[axis]) | (b_stats.n < b.shape[axis])
+    scores[unknown] = np.nan
+    p_values[unknown] = np.nan
+    return fold_change, scores, p_values
+
+
+def iter_row_chunks(x, chunk_size=10000):
+    # type: (Union[np.ndarray, sp.spmatrix], int) -> Iterator[Union[np.ndarray, sp.spmatrix]]
+    """Yield consecutive blocks of at most ``chunk_size`` rows of x.
+
+    Only one block is read at a time from memory-mapped arrays (``np.load(path, mmap_mode='r')``)
+    and HDF5 datasets (``h5py.File(path)[name]``), so x does not need to fit in memory.
+    """
+    for start in range(0, x.shape[0], chunk_size):
+        yield x[start : start + chunk_size]
+
+
+class StreamingGroupStatistics:
+    """Statistics of features in groups of samples accumulated in one pass over blocks of rows.
+
+    For each group it keeps the number of samples, and for each feature the number of known
+    values, their sums and sums of squares and the number of samples that express the feature
+    (with values of at least ``threshold``). Unknown values are skipped. Memory does not depend
+    on the number of samples, so data larger than memory can be scored block by block.
+
+    Groups to compare are given as a group index or a list of indices, whose statistics are merged.
+
+    Example
+    --------
+        >>> data = np.load('atlas.npy', mmap_mode='r')
+        >>> stats = StreamingGroupStatistics.from_matrix(data, cell_types, n_groups=3)
+        >>> scores, p_values = stats.t_test(0, [1, 2], alternative=ALT_GREATER)
+    """
+
+    def __init__(self, n_groups, n_features, threshold=1):
+        # type: (int, int, float) -> None
+        self.threshold = threshold
+        self.samples = np.zeros(n_groups, dtype=int)
+        self.n = np.zeros((n_groups, n_features))
+        self.sums = np.zeros((n_groups, n_features))
+        self.squares = np.zeros((n_groups, n_features))
+        self.expressed = np.zeros((n_groups, n_features))
+
+    @classmethod
+    def from_chunks(cls, chunks, n_groups, threshold=1):
+        # type: (Iterable[Tuple[Union[np.ndarray, sp.spmatrix], np.ndarray]], int, float) -> StreamingGroupStatistics
+        """ Accumulate statistics from an iterable of (block of rows, group indices of rows). """
+        stats = None
+        for x, labels in chunks:
+            if stats is None:
+                stats = cls(n_groups, x.shape[1], threshold)
+            stats.update(x, labels)
+        if stats is None:
+            raise ValueError('No data')
+        return stats
+
+    @classmethod
+    def from_matrix(cls, x, labels, n_groups=None, threshold=1, chunk_size=10000):
+        # type: (Union[np.ndarray, sp.spmatrix], np.ndarray, Optional[int], float, int) -> StreamingGroupStatistics
+        """Accumulate statistics of a (possibly memory-mapped or HDF5) matrix in blocks of rows.
+
+        :param labels: group indices of rows; rows with negative indices are skipped
+        """
+        labels = np.asarray(labels)
+        if n_groups is None:
+            n_groups = int(labels.max()) + 1
+        chunks = zip(iter_row_chunks(x, chunk_size), iter_row_chunks(labels, chunk_size))
+        return cls.from_chunks(chunks, n_groups, threshold)
+
+    def update(self, x, labels):
+        # type: (Union[np.ndarray, sp.spmatrix], np.ndarray) -> None
+        """ Add a block of rows with group indices of rows; rows with negative indices are skipped. """
+        labels = np.asarray(labels, dtype=int)
+        rows = np.flatnonzero(labels >= 0)
+        n_groups = len(self.samples)
+        # groups x rows
+        indicator = sp.csr_matrix((np.ones(len(rows)), (labels[rows], rows)), shape=(n_groups, x.shape[0]))
+
+        def group_sums(matrix):
+            result = indicator @ matrix
+            return result.toarray() if sp.issparse(result) else np.asarray(result)
+
+        if sp.issparse(x):
+            x = sp.csr_matrix(x, dtype=float, copy=True)
+            x.sum_duplicates()
+            # implicit zeros are known values, and are expressed if threshold <= 0
+            group_rows = np.asarray(indicator.sum(axis=1))
+            nans = np.isnan(x.data)
+            known = group_rows - group_sums(sp.csr_matrix((nans.astype(float), x.indices, x.indptr), shape=x.shape))
+            expressed = group_sums(
+                sp.csr_matrix(((x.data >= self.threshold).astype(float), x.indices, x.indptr), shape=x.shape)
+            )
+            if self.threshold <= 0:
+                stored = sp.csr_matrix((np.ones_like(x.data), x.indices, x.indptr), shape=x.shape)
+                expressed += group_rows - group_sums(stored)
+            x.data[nans] = 0
+            sums, squares = group_sums(x), group_sums(x.multiply(x))
+        else:
+            x = np.asarray(x, dtype=float)
+            nans = np.isnan(x)
+            known = group_sums((~nans).astype(float))
+            expressed = group_sums((x >= self.threshold).astype(float))
+            x = np.where(nans, 0, x)
+            sums, squares = group_sums(x), group_sums(x * x)
+
+        self.samples += np.bincount(labels[rows], minlength=n_groups)
+        self.n += known
+        self.sums += sums
+        self.squares += squares
+        self.expressed += expressed
+
+    def merge(self, other):
+        # type: (StreamingGroupStatistics) -> None
+        """ Add statistics accumulated from other samples (for example, in another process). """
+        self.samples += other.samples
+        self.n += other.n
+        self.sums += other.sums
+        self.squares += other.squares
+        self.expressed += other.expressed
+
+    def _groups(self, groups):
+        # type: (Union[int, Sequence[int]]) -> List[int]
+        return [groups] if np.isscalar(groups) else list(groups)
+
+    def group(self, groups):
+        # type: (Union[int, Sequence[int]]) -> GroupStatistics
+        """ Statistics of features in the union of groups. """
+        groups = self._groups(groups)
+        return GroupStatistics(
+            self.n[groups].sum(axis=0), self.sums[groups].sum(axis=0), self.squares[groups].sum(axis=0)
+        )
+
+    def t_test(self, a, b, alternative=ALT_TWO, equal_var=True):
+        # type: (Union[int, Sequence[int]], Union[int, Sequence[int]], str, bool) -> Tuple[np.ndarray, np.ndarray]
+        """Student's or Welch's t-test between groups a and b.
+
+        :return: (statistics, p_values)
+        """
+        return t_test_from_statistics(self.group(a), self.group(b), alternative, equal_var=equal_var)
+
+    def fold_change(self, a, b, log=False):
+        # type: (Union[int, Sequence[int]], Union[int, Sequence[int]], bool) -> np.ndarray
+        """Fold change of means of groups a and b.
+
+        :param log: Return the log2(scores).
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = self.group(a).mean / self.group(b).mean
+        scores[scores < 0] = np.nan
+        return np.log2(scores) if log else scores
+
+    def hypergeometric_test(self, a, b, alternative=ALT_TWO):
+        # type: (Union[int, Sequence[int]], Union[int, Sequence[int]], str) -> Tuple[np.ndarray, np.ndarray]
+        """Hypergeometric test of expression in groups a and b.
+
+        :return: (scores, p_values)
+        """
+        a, b = self._groups(a), self._groups(b)
+        return hypergeometric_test_from_counts(
+            self.expressed[a].sum(axis=0),
+            self.samples[a].sum(),
+            self.expressed[b].sum(axis=0),
+            self.samples[b].sum(),
+            alternative,
+        )
 
 
 class LogBin(object):
-    _max = 2
-    _lookup = [0.0, 0.0]
-    _max_factorial = 1
+    #: Natural logarithms of factorials, ``_lookup[i] == log(i!)``. The array is never modified in place;
+    #: a larger one replaces it, so readers need no locking.
+    _lookup = np.zeros(2)
     _lock = threading.Lock()
 
     def __init__(self, max=1000):
@@ -156,30 +783,71 @@ class LogBin(object):
     @staticmethod
     def _extend(max):
         with LogBin._lock:
-            if max <= LogBin._max:
+            size = len(LogBin._lookup)
+            if max <= size:
                 return
-            for i in range(LogBin._max, max):
-                if i > 1000:  # an arbitrary cuttof
-                    LogBin._lookup.append(LogBin._logfactorial(i))
-                else:
-                    LogBin._max_factorial *= i
-                    LogBin._lookup.append(math.log(LogBin._max_factorial))
-            LogBin._max = max
+            # grow geometrically to amortize rebuilding the table
+            LogBin._lookup = gammaln(np.arange(1, np.maximum(max, 2 * size) + 1, dtype=float))
+
+    @staticmethod
+    def _table(size):
+        """ Return the table of log factorials with at least size entries. """
+        lookup = LogBin._lookup
+        if size > len(lookup):
+            LogBin._extend(size)
+            lookup = LogBin._lookup
+        return lookup
 
     def _logbin(self, n, k):
-        if n >= self._max:
-            self._extend(n + 100)
+        lookup = self._table(n + 1)
         if n > k >= 0:
-            return self._lookup[n] - self._lookup[n - k] - self._lookup[k]
+            return float(lookup[n] - lookup[n - k] - lookup[k])
         else:
             return 0.0
 
+    def _logbin_array(self, n, k):
+        """ Vectorized :obj:`_logbin` over integer arrays n and k. """
+        n, k = np.broadcast_arrays(np.asarray(n, dtype=int), np.asarray(k, dtype=int))
+        lookup = self._table(int(n.max()) + 1 if n.size else 0)
+        valid = (n > k) & (k >= 0)
+        n, k = np.where(valid, n, 0), np.where(valid, k, 0)
+        return np.where(valid, lookup[n] - lookup[n - k] - lookup[k], 0.0)
+
     @staticmethod
     def _logfactorial(n):
         if n <= 1:
             return 0.0
         else:
-            return _lngamma(n + 1)
+            return float(gammaln(n + 1))
+
+    def _p_values(self, k, N, m, n, last):  # noqa: N803
+        """
+        Vectorized p_value. Summation ranges and the fallback for small
+        values are the same as in p_value; last is the largest possible k.
+        Subclasses define the probabilities of values in `_terms`.
+        """
+        k, N, m, n, last = (np.ravel(a).astype(int) for a in np.broadcast_arrays(k, N, m, n, last))
+
+        def tail_sums(lo, hi, index):
+            # sum of terms for i in range(lo, hi), for each element of index
+            counts = np.maximum(hi - lo, 0)
+            segment = np.repeat(index, counts)
+            offsets = np.cumsum(counts) - counts
+            i = np.arange(counts.sum()) - np.repeat(offsets, counts) + np.repeat(lo, counts)
+            terms = self._terms(i, N[segment], m[segment], n[segment])
+            return np.bincount(np.repeat(np.arange(len(index)), counts), weights=terms, minlength=len(index))
+
+        # starting from k gives the shorter list of values
+        upper = last - k + 1 <= k
+        index = np.arange(len(k))
+        values = tail_sums(np.where(upper, k, 0), np.where(upper, last + 1, k), index)
+        values[~upper] = 1.0 - values[~upper]
+
+        # if the value is small it is probably inexact due to the limited
+        # precision of floats, so compute the result without substraction
+        inexact = np.flatnonzero(~upper & (values < 1e-3))
+        values[inexact] = tail_sums(k[inexact], last[inexact] + 1, inexact)
+        return values
 
 
 class Binomial(LogBin):
@@ -228,6 +896,27 @@ class Binomial(LogBin):
             else:
                 return value
 
+    def _terms(self, i, N, m, n):  # noqa: N803
+        """ Vectorized :obj:`__call__`; i is an array of k and N, m and n are broadcast to it. """
+        p = m / N
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            log_p = np.log(np.where((p > 0) & (p < 1), p, 0.5))
+            log_q = np.log(np.where((p > 0) & (p < 1), 1.0 - p, 0.5))
+            terms = np.minimum(np.exp(self._logbin_array(n, i) + i * log_p + (n - i) * log_q), 1.0)
+        terms = np.where(p == 0.0, (i == 0).astype(float), terms)
+        return np.where(p == 1.0, (i == n).astype(float), terms)
+
+    def p_values(self, k, N, m, n):  # noqa: N803
+        """
+        Vectorized :obj:`p_value`: k, N, m and n are broadcast arrays of integers.
+
+        Example
+        --------
+            >>> Binomial().p_values([3, 5], 100, [10, 20], 20)
+            array([0.32307319, 0.37035174])
+        """
+        return self._p_values(k, N, m, n, n).reshape(np.broadcast(k, N, m, n).shape)
+
 
 class Hypergeometric(LogBin):
     """ `Hypergeometric distribution <http://en.wikipedia.org/wiki/Hypergeometric_distribution>`_ is
@@ -268,72 +957,79 @@ class Hypergeometric(LogBin):
             else:
                 return value
 
+    def _terms(self, i, N, m, n):  # noqa: N803
+        """ Vectorized :obj:`__call__`; i is an array of k and N, m and n are broadcast to it. """
+        support = (i >= np.maximum(0, n + m - N)) & (i <= np.minimum(n, m))
+        log_terms = self._logbin_array(m, i) + self._logbin_array(N - m, n - i) - self._logbin_array(N, n)
+        with np.errstate(over='ignore'):
+            return np.where(support, np.minimum(np.exp(log_terms), 1.0), 0.0)
 
-# to speed-up FDR, calculate ahead sum([1/i for i in range(1, m+1)]), for m in [1,100000].
-# For higher values of m use an approximation, with error less or equal to
-# 4.99999157277e-006. (sum([1/i for i in range(1, m+1)])  ~ log(m) + 0.5772..., 0.5572 is an Euler-Mascheroni constant)
-c = [1.0]
-for m in range(2, 100000):
-    c.append(c[-1] + 1.0 / m)
+    def p_values(self, k, N, m, n):  # noqa: N803
+        """
+        Vectorized :obj:`p_value`: k, N, m and n are broadcast arrays of integers.
+
+        Example
+        --------
+            >>> Hypergeometric().p_values([3, 5], 100, [10, 20], 20)
+            array([0.31877994, 0.36468301])
+        """
+        return self._p_values(k, N, m, n, np.minimum(n, m)).reshape(np.broadcast(k, N, m, n).shape)
 
 
-def is_sorted(l):
-    return all(l[i] <= l[i + 1] for i in range(len(l) - 1))
+def _harmonic(m):
+    """ Return the m-th harmonic number, ``sum([1/i for i in range(1, m+1)])``. """
+    return float(digamma(m + 1) + np.euler_gamma)
 
 
 def FDR(p_values, dependent=False, m=None, ordered=False):  # noqa: N802
     """ `False Discovery Rate <http://en.wikipedia.org/wiki/False_discovery_rate>`_ correction on a list of p-values.
 
-    :param p_values: a list of p-values.
+    :param p_values: a list or an array of p-values.
     :param dependent: use correction for dependent hypotheses (default False).
     :param m: number of hypotheses tested (default ``len(p_values)``).
     :param ordered: prevent sorting of p-values if they are already sorted (default False).
+    :return: an array if p_values is an array, a list otherwise.
     """
-
-    if not ordered:
-        ordered = is_sorted(p_values)
-
-    if not ordered:
-        joined = [(v, i) for i, v in enumerate(p_values)]
-        joined.sort()
-        p_values = [p[0] for p in joined]
-        indices = [p[1] for p in joined]
+    is_array = isinstance(p_values, np.ndarray)
+    p_values = np.asarray(p_values, dtype=float)
+    shape, p_values = p_values.shape, p_values.ravel()
 
     if not m:
         m = len(p_values)
-    if m <= 0 or not p_values:
-        return []
+    if m <= 0 or not len(p_values):
+        return np.array([]) if is_array else []
 
     if dependent:  # correct q for dependent tests
-        k = c[m - 1] if m <= len(c) else math.log(m) + 0.57721566490153286060651209008240243104215933593992
-        m = m * k
+        m = m * _harmonic(m)
+
+    if not ordered:
+        # stable sort keeps the order of equal p-values
+        order = np.argsort(p_values, kind='mergesort')
+        p_values = p_values[order]
 
-    tmp_fdrs = [p * m / (i + 1.0) for (i, p) in enumerate(p_values)]
-    fdrs = []
-    cmin = tmp_fdrs[-1]
-    for f in reversed(tmp_fdrs):
-        cmin = min(f, cmin)
-        fdrs.append(cmin)
-    fdrs.reverse()
+    fdrs = p_values * m / np.arange(1, len(p_values) + 1)
+    # unknown p-values (sorted last) stay unknown and do not change the others
+    fdrs = np.fmin.accumulate(fdrs[::-1])[::-1]
 
     if not ordered:
-        new = [None] * len(fdrs)
-        for v, i in zip(fdrs, indices):
-            new[i] = v
-        fdrs = new
+        unsorted = np.empty_like(fdrs)
+        unsorted[order] = fdrs
+        fdrs = unsorted
 
-    return fdrs
+    return fdrs.reshape(shape) if is_array else fdrs.tolist()
 
 
 def Bonferroni(p_values, m=None):  # noqa: N802
     """ `Bonferroni correction <http://en.wikipedia.org/wiki/Bonferroni_correction>`_ correction on a list of p-values.
 
-    :param p_values: a list of p-values.
+    :param p_values: a list or an array of p-values.
     :param m: number of hypotheses tested (default ``len(p_values)``).
+    :return: an array if p_values is an array, a list otherwise.
     """
+    is_array = isinstance(p_values, np.ndarray)
     if not m:
         m = len(p_values)
     if m == 0:
-        return []
-    m = float(m)
-    return [p / m for p in p_values]
+        return np.array([]) if is_array else []
+    corrected = np.asarray(p_values, dtype=float) / float(m)
+    return corrected if is_array else corrected.tolist()
@@ -3,6 +3,7 @@ import sys
 import itertools
 
 import numpy as np
+import scipy.sparse as sp
 from scipy.stats import rankdata
 
 from AnyQt.QtCore import Qt, QSize
@@ -10,14 +11,31 @@ from AnyQt.QtWidgets import QSplitter, QTableView, QHBoxLayout, QHeaderView, QLi
 
 from Orange.data import Table, Domain, StringVariable, DiscreteVariable, ContinuousVariable
 from Orange.widgets import settings
-from Orange.widgets.gui import spin, vBox, comboBox, listView, widgetBox, doubleSpin, auto_commit, widgetLabel
+from Orange.widgets.gui import (
+    spin,
+    vBox,
+    checkBox,
+    comboBox,
+    listView,
+    widgetBox,
+    doubleSpin,
+    auto_commit,
+    widgetLabel,
+    radioButtons,
+)
 from Orange.widgets.utils import itemmodels
 from Orange.widgets.widget import Msg, OWWidget
 from Orange.widgets.settings import Setting, ContextSetting, PerfectDomainContextHandler, vartype
 from Orange.widgets.utils.signals import Input, Output
 
 from orangecontrib.bioinformatics.geneset.utils import GeneSetException
-from orangecontrib.bioinformatics.cluster_analysis import DISPLAY_GENE_SETS_COUNT, Cluster, ClusterModel
+from orangecontrib.bioinformatics.cluster_analysis import (
+    AGGREGATE_MAX,
+    AGGREGATE_STRATIFIED,
+    DISPLAY_GENE_SETS_COUNT,
+    Cluster,
+    ClusterModel,
+)
 from orangecontrib.bioinformatics.ncbi.gene.config import ENTREZ_ID
 from orangecontrib.bioinformatics.utils.statistics import score_hypergeometric_test
 from orangecontrib.bioinformatics.widgets.utils.gui import HTMLDelegate, GeneScoringWidget, GeneSetsSelection
@@ -28,6 +46,11 @@ from orangecontrib.bioinformatics.widgets.utils.data import (
     GENE_AS_ATTRIBUTE_NAME,
 )
 
+#: Clusters are scored in worker processes only if the data, times the number of clusters, has at
+#: least this many values; smaller jobs are scored in a thread, which avoids starting processes
+#: and copying the data to them
+PROCESS_POOL_MIN_VALUES = 10 ** 8
+
 
 class ClusterAnalysisContextHandler(PerfectDomainContextHandler):
     def encode_setting(self, context, setting, value):
@@ -77,6 +100,8 @@ class OWClusterAnalysis(OWWidget):
     settingsHandler = ClusterAnalysisContextHandler()
     cluster_indicators = ContextSetting([])
     batch_indicator = ContextSetting(None)
+    use_pseudobulk = Setting(False)
+    batch_aggregation = Setting(0)
     stored_gene_sets_selection = ContextSetting(())
 
     scoring_method_selection = ContextSetting(0)
@@ -169,6 +194,22 @@ class OWClusterAnalysis(OWWidget):
             sendSelectedValue=True,
             callback=self.batch_indicator_changed,
         )
+        checkBox(
+            box,
+            self,
+            'use_pseudobulk',
+            'Sum cells of clusters within batches (pseudobulk)',
+            callback=self.batch_indicator_changed,
+            tooltip='Score genes of summed counts (log2 CPM) of each cluster in each batch; batches are replicates',
+        )
+        radioButtons(
+            box,
+            self,
+            'batch_aggregation',
+            ['Max p-value over batches', 'Test stratified by batches'],
+            callback=self.batch_indicator_changed,
+            label='Combine batches',
+        )
 
         # Gene scoring
         box = widgetBox(self.controlArea, 'Gene Scoring')
@@ -441,12 +482,26 @@ class OWClusterAnalysis(OWWidget):
         design = bool(self.gene_scoring.get_selected_desig())  # if true cluster vs. cluster else cluster vs rest
         test_type = self.gene_scoring.get_selected_test_type()
         method = self.gene_scoring.get_selected_method()
+        pseudobulk = self.use_pseudobulk and self.rows_by_batch is not None
         try:
             if method.score_function == score_hypergeometric_test:
-                values = set(np.unique(self.input_data.X))
+                if pseudobulk:
+                    raise ValueError('Hypergeometric test cannot score pseudobulk samples')
+                X = self.input_data.X
+                if sp.issparse(X):
+                    values = set(np.unique(X.data))
+                    if X.nnz < X.shape[0] * X.shape[1]:
+                        values.add(0)
+                else:
+                    values = set(np.unique(X))
                 if (0 not in values) or (len(values) != 2):
                     raise ValueError('Binary data expected (use Preprocess)')
 
+            # pseudobulk samples are few, so they are always scored in a thread
+            n_rows, n_columns = self.input_data.X.shape
+            n_values = n_rows * n_columns * len(self.cluster_info_model.get_rows())
+            n_jobs = -1 if not pseudobulk and n_values >= PROCESS_POOL_MIN_VALUES else 1
+
             self.cluster_info_model.score_genes(
                 design=design,
                 table_x=self.input_data.X,
@@ -454,6 +509,9 @@ class OWClusterAnalysis(OWWidget):
                 rows_by_batch=self.rows_by_batch,
                 method=method,
                 alternative=test_type,
+                n_jobs=n_jobs,
+                pseudobulk=pseudobulk,
+                aggregation=(AGGREGATE_MAX, AGGREGATE_STRATIFIED)[self.batch_aggregation],
             )
         except ValueError as e:
             self.Warning.gene_enrichment(str(e), 'p-values are set to 1')
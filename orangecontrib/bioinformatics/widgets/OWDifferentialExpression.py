@@ -4,8 +4,6 @@ from types import SimpleNamespace as namespace
 
 import numpy as np
 import pyqtgraph as pg
-import scipy.stats
-import scipy.special
 
 from AnyQt.QtGui import QPen, QStandardItemModel
 from AnyQt.QtCore import Qt, QSize, QLineF, QRectF
@@ -18,8 +16,27 @@ from Orange.preprocess import transformation
 from Orange.widgets.utils import concurrent
 from Orange.widgets.utils.datacaching import data_hints
 
+from orangecontrib.bioinformatics.de import column_labels, variable_labels
+from orangecontrib.bioinformatics.de.scoring import (
+    LabelStatistics,
+    score_groups,
+    score_anova_f,
+    score_anova_p,
+    score_ttest_p,
+    score_ttest_t,
+    permutation_test,
+    score_fold_change,
+    score_welch_ttest_t,
+    score_mann_whitney_u,
+    score_log_fold_change,
+    score_signal_to_noise,
+    score_kruskal_wallis_h,
+    score_kruskal_wallis_p,
+    score_moderated_ttest_t,
+    hypergeometric_test_score,
+)
 from orangecontrib.bioinformatics.widgets.utils import gui as guiutils
-from orangecontrib.bioinformatics.utils.statistics import score_hypergeometric_test
+from orangecontrib.bioinformatics.utils.statistics import ALT_TWO, ALT_LESS, ALT_GREATER
 from orangecontrib.bioinformatics.widgets.utils.data import (
     TAX_ID,
     GENE_ID_COLUMN,
@@ -28,192 +45,10 @@ from orangecontrib.bioinformatics.widgets.utils.data import (
 )
 from orangecontrib.bioinformatics.widgets.utils.settings import SetContextHandler
 
-
-def score_fold_change(a, b, **kwargs):
-    """
-    Calculate the fold change between `a` and `b` samples.
-
-    Parameters
-    ----------
-    a, b : array
-        Arrays containing the samples
-    axis : int
-        Axis over which to compute the FC
-
-    Returns
-    -------
-    FC : array
-        The FC scores
-    """
-    axis = kwargs.get('axis', 0)
-
-    mean_a = np.nanmean(a, axis=axis)
-    mean_b = np.nanmean(b, axis=axis)
-    res = mean_a / mean_b
-    warning = None
-    if np.any(res < 0):
-        res[res < 0] = float("nan")
-        warning = "Negative fold change scores were ignored. You should use another scoring method."
-    return res, warning
-
-
-def score_log_fold_change(a, b, **kwargs):
-    """
-    Return the log2(FC).
-
-    See Also
-    --------
-    score_fold_change
-
-    """
-    axis = kwargs.get('axis', 0)
-    s, w = score_fold_change(a, b, axis=axis)
-    return np.log2(s), w
-
-
-def score_ttest(a, b, **kwargs):
-    axis = kwargs.get('axis', 0)
-    T, P = scipy.stats.ttest_ind(a, b, axis=axis)
-    return T, P
-
-
-def score_ttest_t(a, b, **kwargs):
-    axis = kwargs.get('axis', 0)
-    T, _ = score_ttest(a, b, axis=axis)
-    return T
-
-
-def score_ttest_p(a, b, **kwargs):
-    axis = kwargs.get('axis', 0)
-    _, P = score_ttest(a, b, axis=axis)
-    return P
-
-
-def score_anova(*arrays, **kwargs):
-    axis = kwargs.get('axis', 0)
-    F, P = f_oneway(*arrays, axis=axis)
-    return F, P
-
-
-def score_anova_(*arrays, **kwargs):
-    axis = kwargs.get('axis', 0)
-    arrays = [np.asarray(arr, dtype=float) for arr in arrays]
-
-    if not len(arrays) > 1:
-        raise TypeError("Need at least 2 positional arguments")
-
-    if not 0 <= axis < 2:
-        raise ValueError("0 <= axis < 2")
-
-    if not all(arrays[i].ndim == arrays[i + 1].ndim for i in range(len(arrays) - 2)):
-        raise ValueError("All arrays must have the same number of dimensions")
-
-    if axis >= arrays[0].ndim:
-        raise ValueError()
-
-    if axis == 0:
-        arrays = [arr.T for arr in arrays]
-
-    scores = [scipy.stats.f_oneway(*ars) for ars in zip(*arrays)]
-    F, P = zip(*scores)
-    return np.array(F, dtype=float), np.array(P, dtype=float)
-
-
-def f_oneway(*arrays, **kwargs):
-    """
-    Perform a 1-way ANOVA
-
-    Like `scipy.stats.f_oneway` but accept 2D arrays, with `axis`
-    specifying over which axis to operate (in which axis the samples
-    are stored).
-
-    Parameters
-    ----------
-    A1, A2, ... : array_like
-        The samples for each group.
-    axis : int
-        The axis which contain the samples.
-
-    Returns
-    -------
-    F : array
-        F scores
-    P : array
-        P values
-
-    See also
-    --------
-    scipy.stats.f_oneway
-    """
-    axis = kwargs.get('axis', 0)
-    arrays = [np.asarray(a, dtype=float) for a in arrays]
-    alldata = np.concatenate(arrays, axis)
-    bign = alldata.shape[axis]
-    sstot = np.sum(alldata ** 2, axis) - (np.sum(alldata, axis) ** 2) / bign
-
-    ssarrays = [(np.sum(a, axis, keepdims=True) ** 2) / a.shape[axis] for a in arrays]
-    ssbn = np.sum(np.concatenate(ssarrays, axis), axis)
-    ssbn -= (np.sum(alldata, axis) ** 2) / bign
-    assert sstot.shape == ssbn.shape
-
-    sswn = sstot - ssbn
-    dfbn = len(arrays) - 1
-    dfwn = bign - len(arrays)
-    msb = ssbn / dfbn
-    msw = sswn / dfwn
-    f = msb / msw
-    prob = scipy.special.fdtrc(dfbn, dfwn, f)
-    return f, prob
-
-
-def score_anova_f(*arrays, **kwargs):
-    axis = kwargs.get('axis', 0)
-    F, _ = score_anova(*arrays, axis=axis)
-    return F
-
-
-def score_anova_p(*arrays, **kwargs):
-    axis = kwargs.get('axis', 0)
-    _, P = score_anova(*arrays, axis=axis)
-    return P
-
-
-def score_signal_to_noise(a, b, **kwargs):
-    axis = kwargs.get('axis', 0)
-    mean_a = np.nanmean(a, axis=axis)
-    mean_b = np.nanmean(b, axis=axis)
-
-    std_a = np.nanstd(a, axis=axis, ddof=1)
-    std_b = np.nanstd(b, axis=axis, ddof=1)
-
-    return (mean_a - mean_b) / (std_a + std_b)
-
-
-def score_mann_whitney(a, b, **kwargs):
-    axis = kwargs.get('axis', 0)
-    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
-
-    if not 0 <= axis < 2:
-        raise ValueError("Axis")
-
-    if a.ndim != b.ndim:
-        raise ValueError
-
-    if axis >= a.ndim:
-        raise ValueError
-
-    if axis == 0:
-        a, b = a.T, b.T
-
-    res = [scipy.stats.mannwhitneyu(a_, b_) for a_, b_ in zip(a, b)]
-    U, P = zip(*res)
-    return np.array(U), np.array(P)
-
-
-def score_mann_whitney_u(a, b, **kwargs):
-    axis = kwargs.get('axis', 0)
-    U, _ = score_mann_whitney(a, b, axis=axis)
-    return U
+#: Permutations of scores that are not computed from group statistics are scored in worker
+#: processes only if they score at least this many values; smaller jobs are scored in-process,
+#: which avoids starting processes and copying the data to them
+PROCESS_POOL_MIN_VALUES = 10 ** 8
 
 
 class InfiniteLine(pg.InfiniteLine):
@@ -230,13 +65,6 @@ class InfiniteLine(pg.InfiniteLine):
         painter.restore()
 
 
-def hypergeometric_test_score(*args, **kwargs):
-
-    expression_treshold = kwargs.get('treshold', None)
-    scores, _ = score_hypergeometric_test(*args, expression_treshold)
-    return scores
-
-
 class Histogram(pg.PlotWidget):
     """
     A histogram plot with interactive 'tail' selection
@@ -559,6 +387,10 @@ class OWDifferentialExpression(widget.OWWidget):
         ("Signal to Noise Ratio", TwoTail, TwoSampleTest, score_signal_to_noise),
         ("Mann-Whitney", LowTail, TwoSampleTest, score_mann_whitney_u),
         ('Hypergeometric Test', TwoTail, TwoSampleTest, hypergeometric_test_score),
+        ("Welch T-test", TwoTail, TwoSampleTest, score_welch_ttest_t),
+        ("Moderated T-test", TwoTail, TwoSampleTest, score_moderated_ttest_t),
+        ("Kruskal-Wallis", HighTail, VarSampleTest, score_kruskal_wallis_h),
+        ("Kruskal-Wallis P-value", LowTail, VarSampleTest, score_kruskal_wallis_p),
     ]
 
     settingsHandler = SetContextHandler()
@@ -584,6 +416,8 @@ class OWDifferentialExpression(widget.OWWidget):
             "T-test P-value": (0.01, 0.01),
             "ANOVA": (0, 3),
             "ANOVA P-value": (0, 0.01),
+            "Kruskal-Wallis": (0, 6),
+            "Kruskal-Wallis P-value": (0, 0.01),
         }
     )
 
@@ -612,6 +446,12 @@ class OWDifferentialExpression(widget.OWWidget):
         self.scores = None
         #: The computed scores from label permutations
         self.nulldist = None
+        #: Empirical and max-T adjusted p-values of scores from label permutations
+        self.permutation_p_values = None
+        #: Statistics of label values of the data for each target group
+        self.__label_statistics = {}
+        #: Outputs with scores of all genes, reused while only the selection changes
+        self.__scored_outputs_cache = None
 
         self.__scores_future = self.__scores_state = None
 
@@ -702,7 +542,7 @@ class OWDifferentialExpression(widget.OWWidget):
             self,
             "permutations_count",
             minv=1,
-            maxv=50,
+            maxv=10000,
             label="Permutations:",
             callback=self.update_scores,
             callbackOnReturn=True,
@@ -743,6 +583,9 @@ class OWDifferentialExpression(widget.OWWidget):
         self.targets = []
         self.stored_selections = []
         self.nulldist = None
+        self.permutation_p_values = None
+        self.__label_statistics = {}
+        self.__scored_outputs_cache = None
         self.scores = None
         self.label_selection_widget.clear()
         self.clear_plot()
@@ -841,6 +684,7 @@ class OWDifferentialExpression(widget.OWWidget):
         self.clear_plot()
         self.scores = None
         self.nulldist = None
+        self.permutation_p_values = None
         self.error(0)
 
         grp, split_selection = self.selected_split()
@@ -850,37 +694,34 @@ class OWDifferentialExpression(widget.OWWidget):
 
         _, side, test_type, score_func = self.Scores[self.score_index]
 
-        def compute_scores(X, group_indices, warn=False):
-            arrays = [X[ind] for ind in group_indices]
-            ss = score_func(*arrays, axis=0, treshold=self.expression_threshold_value)
-
-            return ss[0] if isinstance(ss, tuple) and not warn else ss
-
-        def permute_indices(group_indices, random_state=None):
-            assert all(ind.dtype.kind == "i" for ind in group_indices)
-            assert all(ind.ndim == 1 for ind in group_indices)
-            if random_state is None:
-                random_state = np.random
-            joined = np.hstack(group_indices)
-            random_state.shuffle(joined)
-            split_ind = np.cumsum([len(ind) for ind in group_indices])
-            return np.split(joined, split_ind[:-1])
-
         if isinstance(grp, guiutils.RowGroup):
             axis = 0
         else:
             axis = 1
 
+        X = self.data.X
+        if axis == 1:
+            X = X.T
+
+        # statistics of label values are kept until the data changes
+        key = self.targets.index(grp)
+        if key not in self.__label_statistics:
+            if isinstance(grp, guiutils.RowGroup):
+                labels, _ = variable_labels(self.data, grp.var)
+            else:
+                labels, _ = column_labels(self.data, grp.key)
+            self.__label_statistics[key] = LabelStatistics(X, labels, len(grp.values))
+        statistics = self.__label_statistics[key]
+
         if test_type == OWDifferentialExpression.TwoSampleTest:
-            G1 = guiutils.group_selection_mask(self.data, grp, split_selection)
-            G2 = ~G1
-            indices = [np.flatnonzero(G1), np.flatnonzero(G2)]
+            others = [i for i in range(len(grp.values) + 1) if i not in split_selection]
+            groups = [list(split_selection), others]
 
         elif test_type == OWDifferentialExpression.VarSampleTest:
-            indices = [guiutils.group_selection_mask(self.data, grp, [i]) for i in range(len(grp.values))]
-            indices = [np.flatnonzero(ind) for ind in indices]
+            groups = [[i] for i in range(len(grp.values))]
         else:
             assert False
+        indices = [statistics.indices(values) for values in groups]
 
         if not all(ind.size > 0 for ind in indices):
             self.error(0, "Target labels most exclude/include at least one " "value.")
@@ -889,45 +730,57 @@ class OWDifferentialExpression(widget.OWWidget):
             self.update_data_info_label()
             return
 
-        X = self.data.X
-        if axis == 1:
-            X = X.T
-
         # TODO: Check that each label has more than one measurement,
         # raise warning otherwise.
 
-        def compute_scores_with_perm(X, indices, nperm=0, rstate=None, progress_advance=None):
-            warning = None
-            scores = compute_scores(X, indices, warn=True)
-            if isinstance(scores, tuple):
-                scores, warning = scores
+        alternative = {
+            OWDifferentialExpression.LowTail: ALT_LESS,
+            OWDifferentialExpression.HighTail: ALT_GREATER,
+            OWDifferentialExpression.TwoTail: ALT_TWO,
+        }[side]
+
+        threshold = self.expression_threshold_value
 
+        def compute_scores_with_perm(X, indices, nperm=0, seed=0, progress_advance=None, partial_results=None):
+            scores, warning = score_groups(statistics, score_func, groups, threshold)
             if progress_advance is not None:
-                progress_advance()
-            null_scores = []
-            if nperm > 0:
-                if rstate is None:
-                    rstate = np.random.RandomState(0)
-
-                for i in range(nperm):
-                    p_indices = permute_indices(indices, rstate)
-                    assert all(pind.shape == ind.shape for pind, ind in zip(indices, p_indices))
-                    pscore = compute_scores(X, p_indices)
-                    assert pscore.shape == scores.shape
-                    null_scores.append(pscore)
-                    if progress_advance is not None:
-                        progress_advance()
-
-            return scores, null_scores, warning
+                progress_advance(1)
+            if nperm == 0:
+                return scores, None, warning, None
+
+            def partial_null_scores(null_scores):
+                if partial_results is not None:
+                    partial_results((scores, null_scores))
+
+            n_jobs = -1 if nperm * X.shape[0] * X.shape[1] >= PROCESS_POOL_MIN_VALUES else 1
+            null_scores, p_values, adjusted_p_values = permutation_test(
+                X,
+                indices,
+                score_func,
+                scores,
+                nperm,
+                alternative,
+                threshold,
+                seed=seed,
+                n_jobs=n_jobs,
+                callback=progress_advance,
+                partial_results=partial_null_scores,
+            )
+            return scores, null_scores, warning, (p_values, adjusted_p_values)
 
         p_advance = concurrent.methodinvoke(self, "progressBarAdvance", (float,))
         state = namespace(cancelled=False, advance=p_advance)
 
-        def progress():
+        def progress(count):
             if state.cancelled:
                 raise concurrent.CancelledError
             else:
-                state.advance(100 / (nperm + 1))
+                state.advance(100 * count / (nperm + 1))
+
+        set_partial_scores = concurrent.methodinvoke(self, "__set_partial_score_results", (object, object))
+
+        def partial_results(results):
+            set_partial_scores(state, results)
 
         self.progressBarInit()
         set_scores = concurrent.methodinvoke(self, "__set_score_results", (concurrent.Future,))
@@ -935,7 +788,7 @@ class OWDifferentialExpression(widget.OWWidget):
         nperm = self.permutations_count if self.compute_null else 0
         self.__scores_state = state
         self.__scores_future = self._executor.submit(
-            compute_scores_with_perm, X, indices, nperm, progress_advance=progress
+            compute_scores_with_perm, X, indices, nperm, progress_advance=progress, partial_results=partial_results
         )
         self.__scores_future.add_done_callback(set_scores)
 
@@ -973,18 +826,30 @@ class OWDifferentialExpression(widget.OWWidget):
             self.histogram.setUpdatesEnabled(True)
             self.progressBarFinished()
 
+    @Slot(object, object)
+    def __set_partial_score_results(self, state, results):
+        # show the null distribution of permutations scored so far
+        if state is self.__scores_state and not state.cancelled:
+            scores, null_scores = results
+            self.scores, self.nulldist = scores, null_scores
+            self.clear_plot()
+            self.setup_plot(self.score_index, scores, null_scores)
+            self.update_selected_info_label()
+
     def __cancel_pending(self):
         if self.__scores_future is not None:
             self.__scores_future.cancel()
             self.__scores_state.cancelled = True
             self.__scores_state = self.__scores_future = None
 
-    def set_scores(self, scores, null_scores=None, warning=None):
+    def set_scores(self, scores, null_scores=None, warning=None, permutation_p_values=None):
+        self.clear_plot()
         self.scores = scores
         self.nulldist = null_scores
+        self.permutation_p_values = permutation_p_values
 
-        if null_scores:
-            nulldist = np.array(null_scores, dtype=float)
+        if null_scores is not None and len(null_scores):
+            nulldist = np.asarray(null_scores, dtype=float)
         else:
             nulldist = None
 
@@ -1180,7 +1045,7 @@ class OWDifferentialExpression(widget.OWWidget):
         self._invalidate_selection()
 
     def select_p_best(self):
-        if not self.nulldist:
+        if self.nulldist is None or not len(self.nulldist):
             return
 
         _, side, _, _ = self.Scores[self.score_index]
@@ -1259,60 +1124,80 @@ class OWDifferentialExpression(widget.OWWidget):
         indices = np.flatnonzero(selected)
         remaining = np.flatnonzero(~selected)
 
-        domain = self.data.domain
+        score_columns = [(score_name, scores)]
+        if self.permutation_p_values is not None:
+            p_values, adjusted_p_values = self.permutation_p_values
+            score_columns += [("Permutation p-value", p_values), ("FWER (max-T)", adjusted_p_values)]
+
+        outputs = self.__scored_outputs(axis, score_columns)
         if axis == 0:
             # Select rows
-            score_var = Orange.data.ContinuousVariable(score_name)
-            domain_selected_genes = Orange.data.Domain([], metas=domain.metas + (score_var,))
+            data, table_selected_genes = outputs
+            subsetdata = data[indices]
+            remainingdata = data[remaining]
+        else:
+            # select columns
+            attrs, table_selected_genes = outputs
+            subsetdata = select_columns(self.data, attrs, indices)
+            remainingdata = select_columns(self.data, attrs, remaining)
 
-            domain = Orange.data.Domain(domain.attributes, domain.class_vars, domain.metas + (score_var,))
+        self.send("Selected genes", table_selected_genes[indices])
+        self.send("Data subset", subsetdata)
+        self.send("Remaining data subset", remainingdata)
 
-            data = self.data.from_table(domain, self.data)
-            table_selected_genes = self.data.from_table(domain_selected_genes, self.data)
+    def __scored_outputs(self, axis, score_columns):
+        """
+        Return the data and the table of genes with scores of all genes.
 
-            data[:, score_var] = np.c_[scores]
-            table_selected_genes[:, score_var] = np.c_[scores]
+        They only change with the scores and are reused while the selection
+        changes. Rows of genes in columns are returned as variables with
+        scores in their attributes instead of a table.
+        """
+        key = (self.data, axis) + tuple(values for _, values in score_columns)
+        names = [name for name, _ in score_columns]
+        if self.__scored_outputs_cache is not None:
+            cached_key, cached_names, outputs = self.__scored_outputs_cache
+            if cached_names == names and len(cached_key) == len(key) and all(a is b for a, b in zip(cached_key, key)):
+                return outputs
 
-            subsetdata = data[indices]
-            remainingdata = data[remaining]
+        domain = self.data.domain
+        score_vars = tuple(Orange.data.ContinuousVariable(name) for name in names)
+        if axis == 0:
+            domain_selected_genes = Orange.data.Domain([], metas=domain.metas + score_vars)
+            domain = Orange.data.Domain(domain.attributes, domain.class_vars, domain.metas + score_vars)
+
+            data = self.data.from_table(domain, self.data)
+            table_selected_genes = self.data.from_table(domain_selected_genes, self.data)
 
-            self.send("Selected genes", table_selected_genes[indices])
+            for score_var, (_, values) in zip(score_vars, score_columns):
+                data[:, score_var] = np.c_[values]
+                table_selected_genes[:, score_var] = np.c_[values]
+            outputs = data, table_selected_genes
         else:
             gene_ids = self.data.attributes[GENE_ID_ATTRIBUTE]
             domain_selected_genes = Orange.data.Domain(
-                [],
-                metas=[
-                    Orange.data.StringVariable('genes'),
-                    Orange.data.StringVariable(gene_ids),
-                    Orange.data.ContinuousVariable(score_name),
-                ],
+                [], metas=(Orange.data.StringVariable('genes'), Orange.data.StringVariable(gene_ids)) + score_vars
             )
-            data_selected_genes = []
 
-            # select columns
             attrs = [copy_variable(var) for var in domain.attributes]
-            for var, score in zip(attrs, scores):
-                var.attributes[score_name] = str(score)
-                data_selected_genes.append([var.name, var.attributes.get(gene_ids, ''), score])
-
-            table_selected_genes = Orange.data.Table(domain_selected_genes, data_selected_genes)
+            metas = np.empty((len(attrs), 2 + len(score_columns)), dtype=object)
+            metas[:, 0] = [var.name for var in attrs]
+            metas[:, 1] = [var.attributes.get(gene_ids, '') for var in attrs]
+            for j, (name, values) in enumerate(score_columns):
+                metas[:, 2 + j] = values
+                for var, value in zip(attrs, values):
+                    var.attributes[name] = str(value)
+
+            table_selected_genes = Orange.data.Table.from_numpy(
+                domain_selected_genes, np.empty((len(attrs), 0)), metas=metas
+            )
             table_selected_genes.attributes[GENE_AS_ATTRIBUTE_NAME] = False
             table_selected_genes.attributes[GENE_ID_COLUMN] = gene_ids
             table_selected_genes.attributes[TAX_ID] = self.data.attributes[TAX_ID]
+            outputs = attrs, table_selected_genes
 
-            selected_attrs = [attrs[i] for i in indices]
-            remaining_attrs = [attrs[i] for i in remaining]
-
-            domain = Orange.data.Domain(selected_attrs, domain.class_vars, domain.metas)
-            subsetdata = self.data.from_table(domain, self.data)
-
-            domain = Orange.data.Domain(remaining_attrs, domain.class_vars, domain.metas)
-            remainingdata = self.data.from_table(domain, self.data)
-
-            self.send("Selected genes", table_selected_genes[indices])
-
-        self.send("Data subset", subsetdata)
-        self.send("Remaining data subset", remainingdata)
+        self.__scored_outputs_cache = key, names, outputs
+        return outputs
 
     def send_report(self):
         self.report_plot()
@@ -1343,6 +1228,21 @@ def copy_variable(var):
     return clone
 
 
+def select_columns(data, attrs, indices):
+    """
+    Return a table with the given columns of data, with variables `attrs`
+    (copies of all attributes of data). Columns are selected by index, so
+    sparse data stays sparse and other columns are not copied.
+    """
+    domain = Orange.data.Domain([attrs[i] for i in indices], data.domain.class_vars, data.domain.metas)
+    weights = data.W if data.has_weights() else None
+    table = Orange.data.Table.from_numpy(
+        domain, data.X[:, indices], data.Y, data.metas, weights, attributes=data.attributes, ids=data.ids
+    )
+    table.name = data.name
+    return table
+
+
 if __name__ == "__main__":
 
     def main(argv=None):
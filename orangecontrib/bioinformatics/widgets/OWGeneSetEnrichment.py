@@ -26,7 +26,7 @@ from Orange.widgets.settings import Setting, SettingProvider
 from Orange.widgets.utils.signals import Input, Output
 from Orange.widgets.utils.concurrent import TaskState, ConcurrentWidgetMixin
 
-from orangecontrib.bioinformatics.geneset import GeneSets
+from orangecontrib.bioinformatics.geneset import GeneSet, GeneSets, reference_counts
 from orangecontrib.bioinformatics.ncbi.gene import GeneInfo
 from orangecontrib.bioinformatics.utils.statistics import FDR
 from orangecontrib.bioinformatics.widgets.utils.gui import FilterProxyModel, NumericalColumnDelegate
@@ -43,6 +43,7 @@ def run(
 ) -> Results:
     results = Results()
     items = []
+    gene_sets = gene_sets.select(selected_gene_sets)
     step, steps = 0, len(gene_sets)
 
     def set_progress():
@@ -55,19 +56,19 @@ def run(
 
     state.set_status('Calculating...')
 
-    for gene_set in sorted(gene_sets):
-        set_progress()
+    reference_genes = [] if reference_genes is None else reference_genes
+    query_genes = genes.intersection(reference_genes)
+    ref_counts = reference_counts(gene_sets, reference_genes)
 
-        if gene_set.hierarchy not in selected_gene_sets:
-            continue
+    for gene_set in sorted(gene_sets, key=GeneSet.sort_key):
+        set_progress()
 
         if state.is_interruption_requested():
             return results
 
-        reference_genes = [] if reference_genes is None else reference_genes
-        enrichemnt_result = gene_set.set_enrichment(reference_genes, genes.intersection(reference_genes))
+        query, p_value, enrichment = gene_set.count_enrichment(len(reference_genes), ref_counts[gene_set], query_genes)
 
-        if len(enrichemnt_result.query) > 0:
+        if len(query) > 0:
             category_column = QStandardItem()
             term_column = QStandardItem()
             count_column = QStandardItem()
@@ -85,19 +86,19 @@ def run(
                 term_column.setData(gene_set.link, LinkRole)
                 term_column.setForeground(QColor(Qt.blue))
 
-            count_column.setData(len(enrichemnt_result.query), Qt.DisplayRole)
-            count_column.setData(set(enrichemnt_result.query), Qt.UserRole)
+            count_column.setData(len(query), Qt.DisplayRole)
+            count_column.setData(query, Qt.UserRole)
 
             genes_column.setData(len(gene_set.genes), Qt.DisplayRole)
             genes_column.setData(set(gene_set.genes), Qt.UserRole)  # store genes to get then on output on selection
 
-            ref_column.setData(len(enrichemnt_result.reference), Qt.DisplayRole)
+            ref_column.setData(ref_counts[gene_set], Qt.DisplayRole)
 
-            pval_column.setData(enrichemnt_result.p_value, Qt.DisplayRole)
-            pval_column.setData(enrichemnt_result.p_value, Qt.ToolTipRole)
+            pval_column.setData(p_value, Qt.DisplayRole)
+            pval_column.setData(p_value, Qt.ToolTipRole)
 
-            enrichment_column.setData(enrichemnt_result.enrichment_score, Qt.DisplayRole)
-            enrichment_column.setData(enrichemnt_result.enrichment_score, Qt.ToolTipRole)
+            enrichment_column.setData(enrichment, Qt.DisplayRole)
+            enrichment_column.setData(enrichment, Qt.ToolTipRole)
 
             items.append(
                 [
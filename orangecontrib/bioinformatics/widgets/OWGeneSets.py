@@ -16,7 +16,7 @@ from Orange.widgets.settings import Setting, SettingProvider
 from Orange.widgets.utils.signals import Input, Output
 from Orange.widgets.utils.concurrent import TaskState, ConcurrentWidgetMixin
 
-from orangecontrib.bioinformatics.geneset import GeneSets
+from orangecontrib.bioinformatics.geneset import GeneSet, GeneSets
 from orangecontrib.bioinformatics.widgets.utils.gui import FilterProxyModel, NumericalColumnDelegate
 from orangecontrib.bioinformatics.widgets.components import GeneSetSelection
 from orangecontrib.bioinformatics.widgets.utils.data import TableAnnotation, check_table_annotation
@@ -29,6 +29,7 @@ class Results(SimpleNamespace):
 def run(gene_sets: GeneSets, selected_gene_sets: List[Tuple[str, ...]], genes, state: TaskState) -> Results:
     results = Results()
     items = []
+    gene_sets = gene_sets.select(selected_gene_sets)
     step, steps = 0, len(gene_sets)
 
     if not genes:
@@ -36,15 +37,12 @@ def run(gene_sets: GeneSets, selected_gene_sets: List[Tuple[str, ...]], genes, s
 
     state.set_status('Calculating...')
 
-    for gene_set in sorted(gene_sets):
+    for gene_set in sorted(gene_sets, key=GeneSet.sort_key):
 
         step += 1
         if step % (steps / 10) == 0:
             state.set_progress_value(100 * step / steps)
 
-        if gene_set.hierarchy not in selected_gene_sets:
-            continue
-
         if state.is_interruption_requested():
             return results
 
@@ -5,7 +5,7 @@ from Orange.widgets.widget import Msg
 from Orange.widgets.settings import SettingProvider
 from Orange.widgets.visualize.owscatterplot import OWScatterPlotBase, OWDataProjectionWidget
 
-from orangecontrib.bioinformatics.utils.statistics import score_t_test, score_fold_change
+from orangecontrib.bioinformatics.utils.statistics import score_fold_change_t_test
 from orangecontrib.bioinformatics.widgets.utils.gui import label_selection
 from orangecontrib.bioinformatics.widgets.utils.data import GENE_ID_COLUMN, GENE_AS_ATTRIBUTE_NAME
 
@@ -45,6 +45,7 @@ class OWVolcanoPlot(OWDataProjectionWidget):
     current_group_index = settings.ContextSetting(0)
 
     def __init__(self):
+        self.__embeddings = {}
         super().__init__()
 
     def _add_controls(self):
@@ -63,37 +64,50 @@ class OWVolcanoPlot(OWDataProjectionWidget):
         group, target_indices = self.group_selection_widget.selected_split()
 
         if self.data and group is not None and target_indices:
-            X = self.data.X
-            I1 = label_selection.group_selection_mask(self.data, group, target_indices)
-            I2 = ~I1
+            # statistics depend only on the data and the target selection; changes
+            # of plot settings reuse them
+            key = (self.group_selection_widget.currentGroupIndex(), tuple(target_indices))
+            if key not in self.__embeddings:
+                self.__embeddings[key] = self.__compute_embedding(group, target_indices)
+
+            embedding, valid_data, insufficient_data, negative_values = self.__embeddings[key]
+            if embedding is None:
+                self.Error.exclude_error()
+                return
+            if insufficient_data:
+                self.Warning.insufficient_data()
+            if negative_values:
+                self.Error.negative_values()
 
-            # print(group)
-            if isinstance(group, label_selection.RowGroup):
-                X = X.T
+            self.valid_data = valid_data
+            return embedding
 
-            N1, N2 = np.count_nonzero(I1), np.count_nonzero(I2)
+    def __compute_embedding(self, group, target_indices):
+        X = self.data.X
+        I1 = label_selection.group_selection_mask(self.data, group, target_indices)
+        I2 = ~I1
 
-            if not N1 or not N2:
-                self.Error.exclude_error()
-                return
+        if isinstance(group, label_selection.RowGroup):
+            X = X.T
 
-            if N1 < 2 and N2 < 2:
-                self.Warning.insufficient_data()
+        N1, N2 = np.count_nonzero(I1), np.count_nonzero(I2)
 
-            X1, X2 = X[:, I1], X[:, I2]
+        if not N1 or not N2:
+            return None, None, False, False
 
-            if np.any(X1 < 0.0) or np.any(X2 < 0):
-                self.Error.negative_values()
-                X1 = np.full_like(X1, np.nan)
-                X2 = np.full_like(X2, np.nan)
+        X1, X2 = X[:, I1], X[:, I2]
+
+        negative_values = bool(np.any(X1 < 0.0) or np.any(X2 < 0))
+        if negative_values:
+            X1 = np.full(X1.shape, np.nan)
+            X2 = np.full(X2.shape, np.nan)
 
-            with np.errstate(divide="ignore", invalid="ignore"):
-                fold = score_fold_change(X1, X2, axis=1, log=True)
-                _, p_values = score_t_test(X1, X2, axis=1)
-                log_p_values = np.log10(p_values)
+        fold, _, p_values = score_fold_change_t_test(X1, X2, axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_p_values = np.log10(p_values)
 
-            self.valid_data = np.isfinite(fold) & np.isfinite(p_values)
-            return np.array([fold, -log_p_values]).T
+        valid_data = np.isfinite(fold) & np.isfinite(p_values)
+        return np.array([fold, -log_p_values]).T, valid_data, N1 < 2 and N2 < 2, negative_values
 
     def setup_plot(self):
         super().setup_plot()
@@ -113,6 +127,7 @@ class OWVolcanoPlot(OWDataProjectionWidget):
     def set_data(self, data):
         self.Warning.clear()
         self.Error.clear()
+        self.__embeddings = {}
         super().set_data(data)
         self.group_selection_widget.set_data(self, self.data)
 
@@ -56,6 +56,11 @@ class GeneSetSelection(OWComponent, QObject):
     def gene_sets(self):
         return self._gene_sets
 
+    @property
+    def selected_gene_sets(self) -> GeneSets:
+        """ Return gene sets from selected hierarchies """
+        return self._gene_sets.select(tuple(hierarchy) for hierarchy in self.selection)
+
     @property
     def tax_id(self) -> Optional[str]:
         if self.data:
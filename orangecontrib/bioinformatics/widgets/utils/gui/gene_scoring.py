@@ -13,6 +13,8 @@ from orangecontrib.bioinformatics.utils.statistics import (
     ALTERNATIVES,
     score_t_test,
     score_mann_whitney,
+    score_welch_t_test,
+    score_moderated_t_test,
     score_hypergeometric_test,
 )
 
@@ -34,6 +36,8 @@ class GeneScoringWidget(QWidget):
         gene_scoring_method('T-test', score_t_test, TwoTail, TwoSampleTest),
         gene_scoring_method('Mann-Whitney', score_mann_whitney, LowTail, TwoSampleTest),
         gene_scoring_method('Hypergeometric Test', score_hypergeometric_test, TwoTail, TwoSampleTest),
+        gene_scoring_method('Welch T-test', score_welch_t_test, TwoTail, TwoSampleTest),
+        gene_scoring_method('Moderated T-test', score_moderated_t_test, TwoTail, TwoSampleTest),
     ]
 
     def __init__(self, box, parent, **kwargs):
@@ -15,8 +15,8 @@ if __name__ == '__main__':
             'serverfiles',
             'resdk',
             'genesis-pyapi',
-            # Versions are determined by Orange
-            'numpy',
+            # Versions are determined by Orange; 1.17 adds numpy.random.Generator and SeedSequence
+            'numpy>=1.17',
         ],
         extras_require={
             'doc': ['sphinx', 'recommonmark'],